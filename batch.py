@@ -0,0 +1,198 @@
+"""
+Batch.
+
+Runs convert.py and save_me_money.py on many partslists and carts at once.
+Separate runs each redo their own cache checks, request the designs, store
+lots and element IDs they share with the others again, and fight over the
+database file when run side by side. A batch instead takes the union of the
+keys of every input, requests each missing key exactly once on one fetch
+engine, and then sorts every input into its own output files, written next to
+it as the scripts would.
+
+Partslists (.xml) go through Steps 7 and 8 of convert.py, and carts (.cart)
+through those of save_me_money.py. The whole batch is journaled as one run,
+so --resume continues it, and a part chosen for once at the Step 7.3 prompt
+is not asked about again for another partslist.
+"""
+
+import os
+import logging
+import argparse
+import metrics
+from database import *
+from parse import iter_xml, parse_cart
+from log_setup import setup_logger, get_level, summarize, TRACE
+from datetime import datetime
+from convert import export_partslist, prompt_for_option
+from save_me_money import compare_and_export_cart
+from request_session import FetchEngine, open_parse_pool, DEFAULT_CONCURRENCY, DEFAULT_PARSE_WORKERS
+from response_cache import ResponseCache, DEFAULT_CACHE_FILE
+from request_bricklink import get_webpage_for_part_async, parse_color_dict_from_page
+from import_catalog import import_catalog
+from journal import RunJournal
+from lookups import get_part_and_price_for_cart_lot_async, insert_store_lots, insert_designs, insert_element_ids
+from request_lego_store import get_lego_store_results_for_element_ids_async, split_into_batches
+
+
+def run_batch(input_files, database, engine, journal, parse_workers=DEFAULT_PARSE_WORKERS, condition='X', choose_option=prompt_for_option,
+              parse_pool=None):
+    """
+    Look up the union of the keys of every partslist and cart once, then export each of them.
+
+    Args:
+        input_files (list of str): Paths to the BrickLink XML partslists and cart files. The output files are written next to each.
+        database (DatabaseManager): The database to cache the lookups in.
+        engine (request_session.FetchEngine): The engine to make the requests with.
+        journal (journal.RunJournal): The journal recording the progress of the run.
+        parse_workers (int): Number of processes parsing BrickLink pages.
+        condition (str): The condition of the parts the partslists export back to BrickLink XML, 'N', 'U' or 'X'.
+        choose_option (callable): Chooses between two equally priced elements for a part, given the part and the
+            elements. Asks the user by default.
+        parse_pool (concurrent.futures.ProcessPoolExecutor): A running pool to parse the BrickLink pages in, instead of a new one.
+
+    Returns:
+        int: The number of lots in all of the inputs.
+    """
+    # Step 0 - Parse every input
+    partslists = {}
+    carts = {}
+    with metrics.timer('step_seconds', step='0'):
+        for input_file in input_files:
+            if input_file.endswith('.cart'):
+                carts[input_file] = parse_cart(input_file)
+            else:
+                partslists[input_file] = list(iter_xml(input_file))
+    logging.info(f"Step 0 complete - Parsed {len(partslists)} partslists and {len(carts)} carts")
+
+    # Step 1 - Take the union of the design IDs of the partslists and the store lots of the carts, and find the missing ones
+    partslist_keys = {part.key for parts in partslists.values() for part in parts}
+    cart_store_lots = {cart_lot.key for cart_lots in carts.values() for cart_lot in cart_lots}
+    with metrics.timer('step_seconds', step='1'):
+        request_cart_lots = journal.get_keys('2', lambda: database.get_missing_store_lots(cart_store_lots))
+        request_design_ids = journal.get_keys('3', lambda: database.get_missing_design_ids({design_id for design_id, _ in partslist_keys}))
+    logging.info("Step 1 complete - request store lots %s", summarize(request_cart_lots))
+    logging.info("Step 1 complete - request design IDs of the partslists %s", summarize(request_design_ids))
+    logging.log(TRACE, "Step 1 request store lots: %s", request_cart_lots)
+    logging.log(TRACE, "Step 1 request design IDs of the partslists: %s", request_design_ids)
+
+    # Steps 2 and 3 - Request the store lots while the designs of the partslists are fetched, they do not depend on each other
+    step_timer = metrics.timer('step_seconds', step='2')
+    store_lot_tasks = {engine.submit(get_part_and_price_for_cart_lot_async, cart_lot): cart_lot for cart_lot in request_cart_lots}
+    with open_parse_pool(parse_workers, parse_pool) as parse_pool:
+        design_insertions = insert_designs(database, journal, '3', engine.map_pipeline(
+            get_webpage_for_part_async, parse_color_dict_from_page, request_design_ids, parse_pool, parse_workers))
+        store_lot_insertions = insert_store_lots(database, journal, '2', engine.iter_completed(store_lot_tasks))
+        logging.info(f"Step 2 and 3 complete - Inserted {store_lot_insertions} store lots and {design_insertions} element IDs "
+                     f"in {metrics.format_duration(step_timer.stop())}")
+
+        # Step 4 - Fetch the designs of the carts that the partslists did not already bring in
+        step_timer = metrics.timer('step_seconds', step='4')
+        cart_design_ids = {entry[3] for entry in database.get_bricklink_cart_entries_by_store_and_lot_ids(cart_store_lots).values()}
+        request_design_ids = journal.get_keys('4', lambda: database.get_missing_design_ids(cart_design_ids))
+        logging.info("Step 4 - request design IDs of the carts %s", summarize(request_design_ids))
+        design_insertions = insert_designs(database, journal, '4', engine.map_pipeline(
+            get_webpage_for_part_async, parse_color_dict_from_page, request_design_ids, parse_pool, parse_workers))
+    logging.info(f"Step 4 complete - Inserted {design_insertions} element IDs in {metrics.format_duration(step_timer.stop())}")
+
+    # Step 5 - Take the union of the element IDs of every input, and find the missing ones
+    with metrics.timer('step_seconds', step='5'):
+        master_element_ids = database.get_element_ids_by_design_id_and_color_code_pairs(partslist_keys)
+        master_element_ids |= database.get_element_ids_by_store_and_lot_ids(cart_store_lots)
+        request_element_ids = journal.get_keys('6', lambda: database.get_missing_element_ids(master_element_ids))
+    logging.info("Step 5 complete - Master element IDs %s", summarize(master_element_ids))
+    logging.info("Step 5 complete - Request element IDs %s", summarize(request_element_ids))
+    logging.log(TRACE, "Step 5 request element IDs: %s", request_element_ids)
+
+    # Step 6 - Request every missing element ID once, in full batches across the inputs
+    step_timer = metrics.timer('step_seconds', step='6')
+    database_insertions = insert_element_ids(database, journal, '6', engine.map_unordered(
+        get_lego_store_results_for_element_ids_async, split_into_batches(request_element_ids)))
+    logging.info(f"Step 6 complete - database insertions: {database_insertions}, time taken: {metrics.format_duration(step_timer.stop())}")
+
+    # Steps 7 and 8 - Sort each input into its own output files from the database
+    for input_file in input_files:
+        if input_file in carts:
+            compare_and_export_cart(input_file, carts[input_file], database, journal)
+        else:
+            export_partslist(input_file, partslists[input_file], database, journal, condition, choose_option)
+        logging.info(f"Exported {input_file}")
+    return sum(map(len, partslists.values())) + sum(map(len, carts.values()))
+
+
+def main():
+    """
+    Parse command-line arguments, set up logging, and run the batch.
+    """
+    parser = argparse.ArgumentParser(description='Process many BrickLink XML partslists and cart files at once, requesting each lookup once.')
+    parser.add_argument('input_files', nargs='+', help='Paths to the input XML partslists and .cart files')
+    parser.add_argument('-ld', '--log_dir', default='logs', help='Path to the folder where log files will be created')
+    parser.add_argument('-db', '--database_file', default='part_info.db', help='Path to the SQLite database file')
+    parser.add_argument('-new', '--bricklink_new', action='store_true', help='Set part condition to NEW for unavailable items exported back to BrickLink XML')
+    parser.add_argument('-used', '--bricklink_used', action='store_true',
+                        help='Set part condition to USED for unavailable items exported back to BrickLink XML')
+    parser.add_argument('-w', '--workers', type=int, default=DEFAULT_CONCURRENCY, help='Maximum number of web requests in flight at once')
+    parser.add_argument('-pw', '--parse_workers', type=int, default=DEFAULT_PARSE_WORKERS, help='Number of processes parsing BrickLink pages')
+    parser.add_argument('-hc', '--http_cache_file', default=DEFAULT_CACHE_FILE, help='Path to the SQLite file caching raw web responses')
+    parser.add_argument('-nc', '--no_http_cache', action='store_true', help='Do not cache raw web responses')
+    parser.add_argument('-cf', '--catalog_file', help='BrickLink catalog codes file (Codes.txt or XML) to import before scraping')
+    parser.add_argument('--debug', action='store_true', help='Enable debug logging')
+    parser.add_argument('--trace', action='store_true', help='Enable debug logging, and log every ID set in full')
+    parser.add_argument('-r', '--resume', action='store_true', help='Continue the last unfinished batch on the same inputs where it stopped')
+    parser.add_argument('-pm', '--prometheus_file', help='Also write the metrics of the run to this file in the Prometheus text format')
+    args = parser.parse_args()
+
+    # The outputs are named after their inputs, so two inputs must not share a name
+    input_files = list(dict.fromkeys(args.input_files))
+    basenames = [os.path.splitext(input_file)[0] for input_file in input_files]
+    if len(set(basenames)) != len(basenames):
+        parser.error("Two input files would write to the same output files, rename one of them")
+
+    timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
+    logfile_name = os.path.join(args.log_dir, f"batch_{timestamp}.txt")
+    metrics_file_name = os.path.join(args.log_dir, f"batch_{timestamp}_metrics.json")
+
+    logger = setup_logger(logfile_name, get_level(args.debug, args.trace))
+    metrics.reset()
+
+    database = DatabaseManager(args.database_file, logger)
+
+    # Pre-seed the bricklink database table from the catalog download, so only designs missing from it are scraped
+    if args.catalog_file:
+        import_catalog(database, args.catalog_file)
+
+    http_cache = None if args.no_http_cache else ResponseCache(args.http_cache_file)
+    engine = FetchEngine(args.workers, http_cache)
+
+    condition = None
+    if args.bricklink_new:
+        condition = 'N'
+    elif args.bricklink_used:
+        condition = 'U'
+    else:
+        condition = 'X'
+
+    # Steps 0 to 8 for every input, journaled as one run so that a batch that stops halfway can be resumed
+    journal = RunJournal(database, 'batch', input_files, args.resume)
+    try:
+        lots = run_batch(input_files, database, engine, journal, args.parse_workers, condition)
+    except BaseException:
+        journal.stop()
+        raise
+    else:
+        journal.finish()
+    finally:
+        # Step 9 - close the database, the web sessions and the response cache, whether or not the batch finished
+        database.close()
+        engine.close()
+        if http_cache:
+            http_cache.close()
+
+    # Write out the metrics of the run
+    metrics.registry.write_json(metrics_file_name, pipeline='batch', input_files=input_files, lots=lots)
+    if args.prometheus_file:
+        metrics.registry.write_prometheus(args.prometheus_file)
+    logger.info(f"Wrote the metrics of the run to {metrics_file_name}")
+
+
+if __name__ == '__main__':
+    main()
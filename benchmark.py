@@ -0,0 +1,412 @@
+"""
+Benchmark.
+
+Runs convert.py and save_me_money.py end to end on synthetic partslists and
+carts, against a local fixture server that stands in for BrickLink and LEGO.
+The server answers catalog color pages, store item.ajax lookups and batched
+Pick-a-Brick GraphQL queries in the same formats as the real sites, built
+deterministically from the requested IDs, so every run sees the same data.
+
+Each run happens in its own subprocess with a fresh database and response
+cache, and reports its wall time, requests per second, time spent in the
+database and peak RSS. Compare the results before and after a change to see
+whether it made things faster or slower.
+
+With --startup it instead checks how quickly the scripts start: each entry
+module is imported in a fresh interpreter under python -X importtime, which
+reports its cumulative import time and whether curl_cffi, BeautifulSoup or
+lxml were loaded. They must only be loaded once a request is made or a page
+parsed, so the check fails if any of them is imported at startup.
+"""
+
+import os
+import sys
+import json
+import time
+import hashlib
+import argparse
+import resource
+import tempfile
+import threading
+import subprocess
+from urllib.parse import urlsplit, parse_qs
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from records import Part, CartLot
+from export import export_xml, export_cart
+from colors import colors_by_id
+
+# Number of lots in the synthetic inputs, by default
+DEFAULT_SIZES = (100, 1000, 10000)
+
+# Colors each synthetic design comes in
+COLOR_IDS = (1, 5, 11, 86)
+
+# Request rate allowed per host in the benchmark runs, high enough not to pace the local server
+DEFAULT_REQUESTS_PER_SECOND = 10000.0
+
+# Entry modules whose startup is checked
+STARTUP_MODULES = ('cli', 'convert', 'save_me_money', 'batch', 'merge', 'cache', 'server')
+
+# Packages that must not be imported at startup
+HEAVY_PACKAGES = ('curl_cffi', 'bs4', 'lxml', 'requests')
+
+
+def get_design_id(index):
+    """
+    Get the synthetic design ID of a lot.
+
+    Args:
+        index (int): The index of the lot.
+
+    Returns:
+        str: The design ID. Every design is used for one lot per color.
+    """
+    return str(10000 + index // len(COLOR_IDS))
+
+
+def get_element_ids(design_id, color_id):
+    """
+    Get the synthetic element IDs of a design in a color.
+
+    Every seventh design has a second element ID in its first color, so the
+    two-option path of convert.py gets exercised too.
+
+    Args:
+        design_id (str): The design ID.
+        color_id (int): The BrickLink color ID.
+
+    Returns:
+        list of str: The element IDs.
+    """
+    element_ids = [f"{design_id}{color_id:03d}0"]
+    if color_id == COLOR_IDS[0] and int(design_id) % 7 == 0:
+        element_ids.append(f"{design_id}{color_id:03d}1")
+    return element_ids
+
+
+def get_fraction(key):
+    """
+    Get a deterministic pseudo-random number for a key.
+
+    Args:
+        key (str): The key.
+
+    Returns:
+        float: A number between 0 and 1.
+    """
+    return int(hashlib.md5(key.encode('utf-8')).hexdigest()[:8], 16) / 0xFFFFFFFF
+
+
+def build_catalog_page(design_id):
+    """
+    Build the catalog colors page of a synthetic design, laid out like the real one.
+
+    Args:
+        design_id (str): The design ID.
+
+    Returns:
+        bytes: The page.
+    """
+    rows = []
+    for color_id in COLOR_IDS:
+        for element_id in get_element_ids(design_id, color_id):
+            rows.append(f'<TR><TD>&nbsp;</TD><TD><IMG SRC="//img.bricklink.com/P/{color_id}/{design_id}.gif"></TD>'
+                        f'<TD ALIGN="CENTER"><FONT SIZE="2">{color_id}</FONT></TD>'
+                        f'<TD><FONT SIZE="2">&nbsp;{colors_by_id[color_id]}&nbsp;</FONT></TD>'
+                        f'<TD><FONT SIZE="2">&nbsp;{element_id}&nbsp;</FONT></TD></TR>')
+    return (f'<HTML><HEAD><TITLE>BrickLink Reference Catalog - Part {design_id} Known Colors</TITLE></HEAD><BODY><CENTER>'
+            f'<TABLE WIDTH="100%"><TR><TD>BrickLink : Catalog : Parts</TD></TR></TABLE>'
+            f'<P><FONT SIZE="2"><B>Part {design_id}</B> appears in the following colors:</FONT></P>'
+            f'<TABLE WIDTH="100%"><TR><TD COLSPAN="3"><B>Color</B></TD><TD><B>Name</B></TD><TD><B>Element ID</B></TD></TR>'
+            f'{"".join(rows)}</TABLE></CENTER></BODY></HTML>').encode('utf-8')
+
+
+def build_store_item(store_id, lot_id):
+    """
+    Build the item.ajax answer for a synthetic store lot.
+
+    Args:
+        store_id (str): The store ID.
+        lot_id (str): The lot ID, which is the index of the lot in the synthetic cart.
+
+    Returns:
+        dict: The item data.
+    """
+    index = int(lot_id)
+    price = 0.02 + get_fraction(f"{store_id}:{lot_id}") * 0.3
+    return {'itemNo': get_design_id(index), 'colorID': COLOR_IDS[index % len(COLOR_IDS)], 'nativePrice': f"US ${price:.4f}", 'itemType': 'P'}
+
+
+def build_store_result(element_id):
+    """
+    Build the Pick-a-Brick search results for a synthetic element ID.
+
+    Args:
+        element_id (str): The element ID.
+
+    Returns:
+        list of dict: The search results, empty if LEGO does not sell the element.
+    """
+    fraction = get_fraction(element_id)
+    if fraction < 0.3:
+        return []
+    # The second element ID of a design and color is always a cent dearer, so convert.py never has to ask which to pick
+    price = 0.05 + get_fraction(element_id[:-1]) * 0.25 + 0.01 * int(element_id[-1])
+    return [{
+        'id': element_id,
+        'maxOrderQuantity': 200,
+        'deliveryChannel': 'pab' if fraction < 0.7 else 'bap',
+        'price': {'formattedAmount': f"${price:.2f}", 'currencyCode': 'USD'},
+    }]
+
+
+class FixtureHandler(BaseHTTPRequestHandler):
+    """Answers the BrickLink and LEGO requests of a benchmark run from the synthetic data."""
+
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        """Answer a catalog colors page or a store item.ajax lookup."""
+        url = urlsplit(self.path)
+        query = parse_qs(url.query)
+        if url.path.endswith('/catalogColors.asp'):
+            self.send_body(build_catalog_page(query['itemNo'][0]), 'text/html')
+        elif url.path.endswith('/item.ajax'):
+            self.send_body(json.dumps(build_store_item(query['sid'][0], query['invID'][0])).encode('utf-8'), 'application/json')
+        else:
+            self.send_body(b'Not found', 'text/plain', 404)
+
+    def do_POST(self):
+        """Answer a batched Pick-a-Brick GraphQL query."""
+        body = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+        data = {}
+        for name, variables in body['variables'].items():
+            alias = 'e' + name[len('input'):] if name != 'input' else 'searchElements'
+            data[alias] = {'results': build_store_result(variables['query'])}
+        self.send_body(json.dumps({'data': data}).encode('utf-8'), 'application/json')
+
+    def send_body(self, body, content_type, status=200):
+        """Send a response with a body and count it."""
+        self.server.request_count += 1
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        """Keep the benchmark output quiet."""
+
+
+def start_fixture_server():
+    """
+    Start the fixture server on a free local port, in a background thread.
+
+    Returns:
+        ThreadingHTTPServer: The running server, with a request_count attribute.
+    """
+    server = ThreadingHTTPServer(('127.0.0.1', 0), FixtureHandler)
+    server.daemon_threads = True
+    server.request_count = 0
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def write_partslist(path, size):
+    """
+    Write a synthetic BrickLink XML partslist.
+
+    Args:
+        path (str): The path of the XML file.
+        size (int): The number of lots.
+    """
+    parts = [Part('P', get_design_id(i), COLOR_IDS[i % len(COLOR_IDS)], 1 + i % 5) for i in range(size)]
+    export_xml(parts, path)
+
+
+def write_cart(path, size):
+    """
+    Write a synthetic BrickLink .cart file, spread over a few stores.
+
+    Args:
+        path (str): The path of the .cart file.
+        size (int): The number of lots.
+    """
+    export_cart([CartLot('1', 1000 + i % 10, i, 1 + i % 5) for i in range(size)], path)
+
+
+def run_child(pipeline, input_file, work_dir, base_url, requests_per_second, workers, stream, result_file):
+    """
+    Run one pipeline inside the benchmark subprocess, and write its measurements to a JSON file.
+
+    Args:
+        pipeline (str): 'convert' or 'save_me_money'.
+        input_file (str): The synthetic partslist or cart.
+        work_dir (str): The directory for the database, response cache and logs.
+        base_url (str): The URL of the fixture server.
+        requests_per_second (float): The request rate allowed per host.
+        workers (int): The maximum number of requests in flight at once.
+        stream (bool): Whether to run convert.py in streaming mode.
+        result_file (str): The JSON file to write the measurements to.
+    """
+    import request_session
+    import request_bricklink
+    import request_bricklink_cart
+    import request_lego_store
+    request_bricklink.CATALOG_COLORS_URL = f"{base_url}/catalogColors.asp"
+    request_bricklink_cart.STORE_ITEM_URL = f"{base_url}/ajax/clone/store/item.ajax"
+    request_lego_store.URL = f"{base_url}/api/graphql/PickABrickQuery"
+    request_session.DEFAULT_REQUESTS_PER_SECOND = requests_per_second
+
+    database_file = os.path.join(work_dir, 'part_info.db')
+    http_cache_file = os.path.join(work_dir, 'http_cache.db')
+    log_dir = os.path.join(work_dir, 'logs')
+    os.makedirs(log_dir, exist_ok=True)
+    start = time.perf_counter()
+    if pipeline == 'convert':
+        import convert
+        sys.argv = ['convert.py', input_file, '-ld', log_dir, '-db', database_file, '-hc', http_cache_file, '-w', str(workers)]
+        if stream:
+            sys.argv.append('--stream')
+        convert.main()
+    else:
+        import save_me_money
+        save_me_money.process_cart_file(input_file, log_dir, database_file, False, False, workers, http_cache_file)
+    wall_seconds = time.perf_counter() - start
+
+    import metrics
+    with open(result_file, 'w') as file:
+        json.dump({'wall_seconds': wall_seconds, 'db_seconds': metrics.registry.total('db_query_seconds'),
+                   'max_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss}, file)
+
+
+def run_benchmark(server, pipeline, size, requests_per_second, workers, stream):
+    """
+    Run one pipeline on a synthetic input of a given size, in a subprocess.
+
+    Args:
+        server (ThreadingHTTPServer): The fixture server.
+        pipeline (str): 'convert' or 'save_me_money'.
+        size (int): The number of lots in the input.
+        requests_per_second (float): The request rate allowed per host.
+        workers (int): The maximum number of requests in flight at once.
+        stream (bool): Whether to run convert.py in streaming mode.
+
+    Returns:
+        dict: The measurements of the run.
+    """
+    with tempfile.TemporaryDirectory() as work_dir:
+        if pipeline == 'convert':
+            input_file = os.path.join(work_dir, f'partslist_{size}.xml')
+            write_partslist(input_file, size)
+        else:
+            input_file = os.path.join(work_dir, f'cart_{size}.cart')
+            write_cart(input_file, size)
+        result_file = os.path.join(work_dir, 'result.json')
+        request_count = server.request_count
+        command = [sys.executable, os.path.abspath(__file__), '--child', pipeline, input_file, work_dir,
+                   f"http://127.0.0.1:{server.server_port}", str(requests_per_second), str(workers), str(int(stream)), result_file]
+        subprocess.run(command, check=True, stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL)
+        with open(result_file) as file:
+            result = json.load(file)
+    result.update(pipeline=pipeline, size=size, requests=server.request_count - request_count)
+    result['requests_per_second'] = result['requests'] / result['wall_seconds'] if result['wall_seconds'] else 0.0
+    return result
+
+
+def measure_startup(module):
+    """
+    Import a module in a fresh interpreter under python -X importtime.
+
+    Args:
+        module (str): The name of the module.
+
+    Returns:
+        dict: The cumulative import time of the module in milliseconds, and the heavy packages it imported.
+    """
+    completed = subprocess.run([sys.executable, '-X', 'importtime', '-c', f'import {module}'], cwd=os.path.dirname(os.path.abspath(__file__)),
+                               check=True, capture_output=True, text=True)
+    import_us = 0
+    heavy = set()
+    # Each line reads "import time: <self us> | <cumulative us> | <indented module name>", after a header line
+    for line in completed.stderr.splitlines():
+        fields = line.split('|')
+        if not line.startswith('import time:') or len(fields) != 3 or not fields[1].strip().isdigit():
+            continue
+        name = fields[2].strip()
+        if name == module:
+            import_us = int(fields[1])
+        if name.split('.')[0] in HEAVY_PACKAGES:
+            heavy.add(name.split('.')[0])
+    return {'module': module, 'import_ms': import_us / 1000, 'heavy': sorted(heavy)}
+
+
+def check_startup(modules, max_import_ms=None):
+    """
+    Measure the startup of the entry modules, and print whether each of them passes.
+
+    Args:
+        modules (list of str): The names of the modules.
+        max_import_ms (float): The longest cumulative import time allowed, in milliseconds, or None for no limit.
+
+    Returns:
+        list of dict: The measurements of each module, with whether it passed.
+    """
+    results = []
+    print(f"{'module':<14} {'import ms':>10}  {'heavy packages imported':<24} result")
+    for module in modules:
+        result = measure_startup(module)
+        result['passed'] = not result['heavy'] and (max_import_ms is None or result['import_ms'] <= max_import_ms)
+        results.append(result)
+        print(f"{module:<14} {result['import_ms']:>10.1f}  {', '.join(result['heavy']) or '-':<24} {'ok' if result['passed'] else 'FAIL'}")
+    return results
+
+
+def main():
+    """
+    Parse command-line arguments, run the benchmarks and print their results.
+    """
+    if len(sys.argv) == 10 and sys.argv[1] == '--child':
+        pipeline, input_file, work_dir, base_url, requests_per_second, workers, stream, result_file = sys.argv[2:]
+        run_child(pipeline, input_file, work_dir, base_url, float(requests_per_second), int(workers), stream == '1', result_file)
+        return
+
+    parser = argparse.ArgumentParser(description='Benchmark convert.py and save_me_money.py against a local fixture server.')
+    parser.add_argument('-s', '--sizes', type=int, nargs='+', default=list(DEFAULT_SIZES), help='Numbers of lots in the synthetic inputs')
+    parser.add_argument('-p', '--pipelines', nargs='+', choices=['convert', 'save_me_money'], default=['convert', 'save_me_money'],
+                        help='Pipelines to benchmark')
+    parser.add_argument('-w', '--workers', type=int, default=16, help='Maximum number of web requests in flight at once')
+    parser.add_argument('-r', '--requests_per_second', type=float, default=DEFAULT_REQUESTS_PER_SECOND, help='Request rate allowed per host')
+    parser.add_argument('--stream', action='store_true', help='Run convert.py in streaming mode')
+    parser.add_argument('-o', '--output', help='Also write the results to this JSON file')
+    parser.add_argument('--startup', action='store_true', help='Check the import time of the entry modules instead, failing if they import '
+                                                                  'curl_cffi, BeautifulSoup or lxml')
+    parser.add_argument('--max_import_ms', type=float, help='With --startup, also fail if a module takes longer than this to import')
+    args = parser.parse_args()
+
+    if args.startup:
+        results = check_startup(STARTUP_MODULES, args.max_import_ms)
+        if args.output:
+            with open(args.output, 'w') as file:
+                json.dump(results, file, indent=4)
+        sys.exit(0 if all(result['passed'] for result in results) else 1)
+
+    server = start_fixture_server()
+    results = []
+    print(f"{'pipeline':<14} {'lots':>6} {'wall s':>8} {'requests':>9} {'req/s':>8} {'db s':>7} {'peak RSS MB':>12}")
+    try:
+        for pipeline in args.pipelines:
+            for size in args.sizes:
+                result = run_benchmark(server, pipeline, size, args.requests_per_second, args.workers, args.stream)
+                results.append(result)
+                print(f"{pipeline:<14} {size:>6} {result['wall_seconds']:>8.2f} {result['requests']:>9} {result['requests_per_second']:>8.1f} "
+                      f"{result['db_seconds']:>7.2f} {result['max_rss_kb'] / 1024:>12.1f}")
+    finally:
+        server.shutdown()
+    if args.output:
+        with open(args.output, 'w') as file:
+            json.dump(results, file, indent=4)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,107 @@
+"""
+Cache.
+
+Manage the caches of convert.py and save_me_money.py without running either:
+purge tables of the SQLite database or the raw web response cache so their
+lookups are requested again, import BrickLink catalog files into the database
+ahead of a run, or check that the hot queries of a freshly migrated database
+look their rows up through an index. None of this touches the network, so none
+of the request modules are imported.
+"""
+
+import sys
+import logging
+import argparse
+from database import DatabaseManager
+from import_catalog import import_catalog
+from response_cache import ResponseCache, DEFAULT_CACHE_FILE
+
+# Maps each purgeable cache to the DatabaseManager method purging it, or None for the response cache
+PURGE_TARGETS = {
+    'bricklink': 'purge_bricklink_table',
+    'lego_store': 'purge_lego_store_table',
+    'store_lots': 'purge_bricklink_store_lots',
+    'http': None,
+}
+
+# Tables the hot queries must never scan in full, as they grow with every design and store lot looked up
+INDEXED_TABLES = ('bricklink_entries', 'bricklink_store_lots')
+
+
+def purge(database_file, http_cache_file, targets, logger):
+    """
+    Purge caches, so the next run requests their lookups again.
+
+    Args:
+        database_file (str): Path to the SQLite database file.
+        http_cache_file (str): Path to the SQLite file caching raw web responses.
+        targets (list of str): The caches to purge, keys of PURGE_TARGETS, or 'all'.
+        logger (logging.Logger): The logger instance.
+    """
+    if 'all' in targets:
+        targets = list(PURGE_TARGETS)
+    database_targets = [target for target in targets if PURGE_TARGETS[target]]
+    if database_targets:
+        database = DatabaseManager(database_file, logger)
+        for target in database_targets:
+            getattr(database, PURGE_TARGETS[target])()
+        database.close()
+    if 'http' in targets:
+        http_cache = ResponseCache(http_cache_file)
+        http_cache.clear()
+        http_cache.close()
+
+
+def check_query_plans(logger):
+    """
+    Check the query plans of the hot queries against a fresh, fully migrated database.
+
+    Args:
+        logger (logging.Logger): The logger instance.
+
+    Returns:
+        list of tuple: The (query name, plan detail) of every full scan of one of INDEXED_TABLES.
+    """
+    database = DatabaseManager(':memory:', logger)
+    scans = [(name, detail) for name, detail in database.check_query_plans()
+             if any(detail.startswith(f'SCAN {table}') for table in INDEXED_TABLES)]
+    database.close()
+    for name, detail in scans:
+        logger.error(f"Query {name} scans a table: {detail}")
+    if not scans:
+        logger.info("Every hot query looks its rows up through an index")
+    return scans
+
+
+def main():
+    """
+    Parse command-line arguments and purge or pre-seed the caches.
+    """
+    parser = argparse.ArgumentParser(description='Purge or pre-seed the caches of BrickLink and LEGO lookups.')
+    parser.add_argument('-db', '--database_file', default='part_info.db', help='Path to the SQLite database file')
+    parser.add_argument('-hc', '--http_cache_file', default=DEFAULT_CACHE_FILE, help='Path to the SQLite file caching raw web responses')
+    subparsers = parser.add_subparsers(dest='action', required=True)
+    purge_parser = subparsers.add_parser('purge', help='Purge cached lookups, so the next run requests them again')
+    purge_parser.add_argument('targets', nargs='+', choices=list(PURGE_TARGETS) + ['all'], help='The caches to purge')
+    import_parser = subparsers.add_parser('import', help='Import BrickLink catalog codes (Codes.txt or XML) into the database')
+    import_parser.add_argument('catalog_files', nargs='+', help='Paths to the Codes.txt or XML catalog files')
+    import_parser.add_argument('-f', '--force', action='store_true', help='Import the files even if they are unchanged since their last import')
+    subparsers.add_parser('check', help='Check that the hot queries of a fresh database use index lookups, exiting with 1 if not')
+    args = parser.parse_args()
+
+    logging.basicConfig(stream=sys.stdout, level=logging.INFO, format='%(asctime)s [%(levelname)s] %(message)s')
+    logger = logging.getLogger()
+
+    if args.action == 'purge':
+        purge(args.database_file, args.http_cache_file, args.targets, logger)
+    elif args.action == 'check':
+        sys.exit(1 if check_query_plans(logger) else 0)
+    else:
+        database = DatabaseManager(args.database_file, logger)
+        for catalog_file in args.catalog_files:
+            import_catalog(database, catalog_file, args.force)
+        database.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,53 @@
+"""
+CLI.
+
+The bricklink-to-csv command, which runs each of the scripts as a subcommand:
+
+    bricklink-to-csv convert wanted.xml
+    bricklink-to-csv save my.cart
+    bricklink-to-csv batch first.xml second.xml my.cart
+    bricklink-to-csv merge merged.xml first.xml second.xml
+    bricklink-to-csv cache purge lego_store
+    bricklink-to-csv serve
+
+A subcommand takes the same arguments as its script. Only the module of the
+chosen subcommand is imported, and curl_cffi, BeautifulSoup and lxml only once
+a request is actually made or a page parsed, so a run that is purging a table
+or finds everything cached starts and finishes quickly.
+"""
+
+import sys
+import argparse
+import importlib
+
+# Maps each subcommand to the module that runs it and what it does
+COMMANDS = {
+    'convert': ('convert', 'Convert a BrickLink XML partslist into LEGO Pick-a-Brick orders'),
+    'save': ('save_me_money', 'Split a BrickLink cart into a cheaper cart and a LEGO Pick-a-Brick order'),
+    'batch': ('batch', 'Convert many partslists and carts at once, requesting each lookup once'),
+    'merge': ('merge', 'Merge BrickLink XML partslists into one'),
+    'cache': ('cache', 'Purge or pre-seed the caches of BrickLink and LEGO lookups'),
+    'serve': ('server', 'Run convert and save jobs from a local HTTP/JSON API'),
+}
+
+
+def main():
+    """
+    Parse the subcommand, then import its module and hand it the rest of the command line.
+    """
+    parser = argparse.ArgumentParser(prog='bricklink-to-csv', formatter_class=argparse.RawDescriptionHelpFormatter,
+                                     description='Convert BrickLink partslists and carts into LEGO Pick-a-Brick orders.',
+                                     epilog='commands:\n' + '\n'.join(f"  {name:<10}{description}" for name, (_, description) in COMMANDS.items()) +
+                                            "\n\nRun 'bricklink-to-csv <command> --help' for the arguments of a command.")
+    parser.add_argument('command', choices=COMMANDS, metavar='command', help='The command to run, one of ' + ', '.join(COMMANDS))
+    parser.add_argument('arguments', nargs=argparse.REMAINDER, help='The arguments of the command')
+    args = parser.parse_args()
+
+    module = importlib.import_module(COMMANDS[args.command][0])
+    # The scripts parse sys.argv themselves, so their usage is shown under the subcommand's name
+    sys.argv = [f"{parser.prog} {args.command}"] + args.arguments
+    module.main()
+
+
+if __name__ == '__main__':
+    main()
@@ -9,18 +9,23 @@ inevitably arise, particularly with larger builds.
 """
 
 import os
-import sys
 import math
 import logging
 import argparse
-import time
+import metrics
 from database import *
-import concurrent.futures
-from parse import parse_xml
+from parse import iter_xml
+from records import PickABrickLot
+from log_setup import setup_logger, get_level, summarize, flush_logging, TRACE
 from datetime import datetime
 from export import export_csv, export_json, export_xml
-from request_bricklink import get_color_dict_for_part
-from request_lego_store import get_lego_store_result_for_element_id
+from request_session import FetchEngine, open_parse_pool, DEFAULT_CONCURRENCY, DEFAULT_PARSE_WORKERS
+from response_cache import ResponseCache, DEFAULT_CACHE_FILE
+from request_bricklink import get_webpage_for_part_async, parse_color_dict_from_page
+from import_catalog import import_catalog
+from journal import RunJournal
+from lookups import insert_designs, insert_element_ids
+from request_lego_store import get_lego_store_results_for_element_ids_async, split_into_batches, BATCH_SIZE
 
 
 def split_array_into_equal_chunks(array, num_chunks):
@@ -39,259 +44,316 @@ def split_array_into_equal_chunks(array, num_chunks):
     return chunks
 
 
-def setup_logger(log_file):
+def run_staged_lookups(database, engine, journal, bricklink_xml_partslist, request_design_ids, parse_workers, parse_pool=None):
     """
-    Configure and return a logger instance.
+    Run Steps 3 to 6 one after the other, fetching every design before querying LEGO.
 
     Args:
-        log_file (str): The path to the log file.
-
-    Returns:
-        logging.Logger: Configured logger instance.
+        database (DatabaseManager): The database to store the results in.
+        engine (request_session.FetchEngine): The engine to make the requests with.
+        journal (journal.RunJournal): The journal recording which designs and element IDs are done.
+        bricklink_xml_partslist (list of Part): The parts of the input XML file.
+        request_design_ids (set): The design IDs missing from the database.
+        parse_workers (int): Number of processes parsing BrickLink pages.
+        parse_pool (concurrent.futures.ProcessPoolExecutor): A running pool to parse the pages in, instead of a new one.
     """
-    logger = logging.getLogger()
-    logger.setLevel(logging.DEBUG)
-
-    # File handler
-    file_handler = logging.FileHandler(log_file)
-    file_handler.setLevel(logging.DEBUG)
-    file_handler.setFormatter(logging.Formatter('%(asctime)s [%(levelname)s] %(message)s'))
-
-    # Stream handler (stdout)
-    stream_handler = logging.StreamHandler(sys.stdout)
-    stream_handler.setLevel(logging.DEBUG)
-    stream_handler.setFormatter(logging.Formatter('%(asctime)s [%(levelname)s] %(message)s'))
+    # Step 3 - Make the requests to bricklink for all the missing design IDs, parsing the pages in a process pool
+    step_timer = metrics.timer('step_seconds', step='3')
+    with open_parse_pool(parse_workers, parse_pool) as parse_pool:
+        database_insertions = insert_designs(database, journal, '3', engine.map_pipeline(
+            get_webpage_for_part_async, parse_color_dict_from_page, request_design_ids, parse_pool, parse_workers))
+    logging.info(f"Step 3 complete - database insertions: {database_insertions}, time taken: {metrics.format_duration(step_timer.stop())}")
 
-    # Add handlers to the logger
-    logger.addHandler(file_handler)
-    logger.addHandler(stream_handler)
+    # Step 4 - Create a master list of all potential element IDs
+    with metrics.timer('step_seconds', step='4'):
+        master_element_ids = database.get_element_ids_by_design_id_and_color_code_pairs(part.key for part in bricklink_xml_partslist)
+    logging.info("Step 4 complete - master element IDs %s", summarize(master_element_ids))
+    logging.log(TRACE, "Step 4 master element IDs: %s", master_element_ids)
 
-    return logger
+    # Step 5 - Find out which element IDs are not in the lego pick-a-brick database table, or are stale
+    with metrics.timer('step_seconds', step='5'):
+        request_element_ids = journal.get_keys('6', lambda: database.get_missing_element_ids(master_element_ids))
+    logging.info("Step 5 complete - request element IDs %s", summarize(request_element_ids))
+    logging.log(TRACE, "Step 5 request element IDs: %s", request_element_ids)
 
+    # Step 6 - Make the batched requests to lego pick-a-brick for all the missing element IDs
+    step_timer = metrics.timer('step_seconds', step='6')
+    database_insertions = insert_element_ids(database, journal, '6', engine.map_unordered(
+        get_lego_store_results_for_element_ids_async, split_into_batches(request_element_ids)))
+    logging.info(f"Step 6 complete - database insertions: {database_insertions}, time taken: {metrics.format_duration(step_timer.stop())}")
 
-def main():
-    """
-    Parse command-line arguments, set up logging, and process the XML file.
 
-    This function handles the main workflow of the script, including parsing
-    command-line arguments, setting up logging, and processing the input XML
-    file to export data to CSV or JSON.
+def run_streaming_lookups(database, engine, journal, bricklink_xml_partslist, request_design_ids, parse_workers, parse_pool=None):
     """
-    parser = argparse.ArgumentParser(description='Process XML and export to CSV or JSON.')
-    parser.add_argument('input_xml_file', help='Path to the input XML file')
-    parser.add_argument('-ld', '--log_dir', default='logs', help='Path to the folder where log files will be created')
-    parser.add_argument('-db', '--database_file', default='part_info.db', help='Path to the SQLite database file')
-    parser.add_argument('-pb', '--purge_bricklink', action='store_true', help='Purge the BrickLink table in the database before processing the XML')
-    parser.add_argument('-pl', '--purge_lego_store', action='store_true', help='Purge the LEGO Pick-a-Brick table in the database before processing the XML')
-    parser.add_argument('-new', '--bricklink_new', action='store_true', help='Set part condition to NEW for unavailable items exported back to BrickLink XML')
-    parser.add_argument('-used', '--bricklink_used', action='store_true', help='Set part condition to USED for unavailable items exported back to BrickLink XML')
-    args = parser.parse_args()
-
-    input_basename = os.path.splitext(os.path.basename(args.input_xml_file))[0]
-    timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
-    logfile_name = os.path.join(args.log_dir, f"convert_{input_basename}_{timestamp}.txt")
-
-    logger = setup_logger(logfile_name)
-
-    database = DatabaseManager(args.database_file, logger)
-
-    # Don't actually convert if purge is requested
-    if args.purge_bricklink:
-        database.purge_bricklink_table()
-        return
-    if args.purge_lego_store:
-        database.purge_lego_store_table()
-        return
-
-    # Step 0 - Parse input XML file
-    bricklink_xml_partslist = parse_xml(args.input_xml_file)
-    logging.info(f"Step 0 complete - bricklink XML partslist (length {len(bricklink_xml_partslist)}): {bricklink_xml_partslist}")
-
-    # Step 1 - round up all design IDs
-    unique_design_ids = {part['design_id'] for part in bricklink_xml_partslist}
-    logging.info(f"Step 1 complete - unique design IDs (length {len(unique_design_ids)}): {unique_design_ids}")
+    Run Steps 3 to 6 as one streaming pipeline, overlapping the BrickLink and LEGO requests.
 
-    # Step 2 - Find out which design IDs are NOT in the bricklink database table
-    request_design_ids = {design_id for design_id in unique_design_ids if not database.get_bricklink_entry_by_design_id(design_id)}
-    logging.info(f"Step 2 complete - request design IDs (length {len(request_design_ids)}): {request_design_ids}")
+    The element IDs of the designs already in the database are queued for LEGO
+    before the first BrickLink request is made. After that, as soon as the color
+    dict of a design arrives, the element IDs of the colors wanted for it join the
+    queue, and every full batch is sent to LEGO right away while the remaining
+    designs are still being fetched.
 
-    # Step 3 - Make the requests to bricklink for all the missing design IDs
-    start_time = time.time()
+    Args:
+        database (DatabaseManager): The database to store the results in.
+        engine (request_session.FetchEngine): The engine to make the requests with.
+        journal (journal.RunJournal): The journal recording which designs and element IDs are done.
+        bricklink_xml_partslist (list of Part): The parts of the input XML file.
+        request_design_ids (set): The design IDs missing from the database.
+        parse_workers (int): Number of processes parsing BrickLink pages.
+        parse_pool (concurrent.futures.ProcessPoolExecutor): A running pool to parse the pages in, instead of a new one.
+    """
+    step_timer = metrics.timer('step_seconds', step='3')
+    colors_by_design_id = {}
+    for part in bricklink_xml_partslist:
+        colors_by_design_id.setdefault(part.design_id, set()).add(part.color_id)
+
+    lego_tasks = {}
+    pending_element_ids = set()
+
+    def submit_batches(final):
+        # Only full batches are sent until the last design is in, the remainder waits for more element IDs
+        nonlocal pending_element_ids
+        if not pending_element_ids or (len(pending_element_ids) < BATCH_SIZE and not final):
+            return
+        request_element_ids = sorted(journal.add_keys('6', database.get_missing_element_ids(pending_element_ids)))
+        remainder = 0 if final else len(request_element_ids) % BATCH_SIZE
+        for batch in split_into_batches(request_element_ids[:len(request_element_ids) - remainder]):
+            lego_tasks[engine.submit(get_lego_store_results_for_element_ids_async, batch)] = batch
+        pending_element_ids = set(request_element_ids[len(request_element_ids) - remainder:])
+
+    # Step 4 and 5, for the designs already in the database
+    pending_element_ids.update(database.get_element_ids_by_design_id_and_color_code_pairs(
+        part.key for part in bricklink_xml_partslist if part.design_id not in request_design_ids))
+    submit_batches(final=False)
+    logging.info(f"Step 4 and 5 - queued {len(lego_tasks)} LEGO batches for the designs already in the database")
+
+    # Step 3, queueing the element IDs of each design for Step 6 as it arrives
     database_insertions = 0
-    with concurrent.futures.ThreadPoolExecutor() as executor:
-        future_to_design_id = {executor.submit(get_color_dict_for_part, design_id): design_id for design_id in request_design_ids}
-        for future in concurrent.futures.as_completed(future_to_design_id):
-            design_id = future_to_design_id[future]
+    with open_parse_pool(parse_workers, parse_pool) as parse_pool:
+        for design_id, task in engine.map_pipeline(get_webpage_for_part_async, parse_color_dict_from_page, request_design_ids,
+                                                   parse_pool, parse_workers):
             try:
-                data = future.result()
+                data = task.result()
                 for color_code, element_id_list in data.items():
                     for element_id in element_id_list:
                         database.insert_bricklink_entry(element_id, design_id, color_code)
                         database_insertions += 1
+                    if str(color_code) in colors_by_design_id[design_id]:
+                        pending_element_ids.update(element_id_list)
+                journal.mark_done('3', design_id)
             except Exception as exc:
                 logging.error(f"Step 3 - Design ID {design_id} generated an exception: {exc}")
-    end_time = time.time()
-    elapsed_time = end_time - start_time
-    minutes, seconds = divmod(int(elapsed_time), 60)
-    logging.info(f"Step 3 complete - database insertions: {database_insertions}, time taken: {minutes} minutes and {seconds} seconds")
+                journal.mark_failed('3', design_id)
+            submit_batches(final=False)
+    submit_batches(final=True)
+    database.commit_changes()
+    metrics.increment('database_insertions_total', database_insertions, step='3')
+    logging.info(f"Step 3 complete - database insertions: {database_insertions}, time taken: {metrics.format_duration(step_timer.stop())}, "
+                 f"{len(lego_tasks)} LEGO batches queued")
+
+    # Step 6, collecting the LEGO batches, most of which finished while the designs were being fetched
+    journal.begin_step('6')
+    step_timer = metrics.timer('step_seconds', step='6')
+    database_insertions = insert_element_ids(database, journal, '6', engine.iter_completed(lego_tasks))
+    logging.info(f"Step 6 complete - database insertions: {database_insertions}, time taken after Step 3: {metrics.format_duration(step_timer.stop())}")
+
+
+def prompt_for_option(part, options):
+    """
+    Ask the user which of the equally priced elements to order for a part.
 
-    # Step 4 - Create a master list of all potential element IDs
-    master_element_ids = set()
-    for part in bricklink_xml_partslist:
-        element_ids = [element_id for (element_id, _, _) in database.get_bricklink_entries_by_design_id_and_color_code(part['design_id'], part['color_id'])]
-        master_element_ids.update(element_ids)
-    logging.info(f"Step 4 complete - master element IDs (length {len(master_element_ids)}): {master_element_ids}")
+    Args:
+        part (Part): The part.
+        options (list of dict): The elements LEGO sells for the part.
 
-    # Step 5 - Find out which element IDs are not in the lego pick-a-brick database table
-    request_element_ids = {element_id for element_id in master_element_ids if not database.get_lego_store_entry_by_element_id(element_id)}
-    logging.info(f"Step 5 complete - request element IDs (length {len(request_element_ids)}): {request_element_ids}")
+    Returns:
+        dict: The chosen element.
+    """
+    # The prompt must not get mixed up with log records still waiting to be written
+    flush_logging()
+    print(f"You must choose one of the following options for {part}:")
+    for i, option in enumerate(options):
+        print(f"{i+1}. {option}")
+    while True:
+        try:
+            submitted = int(input("Which option would you like to choose? "))
+            if submitted < 1 or submitted > len(options):
+                print(f"Invalid option: {submitted}")
+            else:
+                return options[submitted - 1]
+        except ValueError as exc:
+            print(f"Invalid option: {exc}")
+
+
+def choose_highest_max_order_quantity(part, options):
+    """
+    Choose the element with the highest max order quantity for a part, without asking.
 
-    # Step 6 - Make the requests to lego pick-a-brick for all the missing element IDs
-    start_time = time.time()
-    database_insertions = 0
-    with concurrent.futures.ThreadPoolExecutor() as executor:
-        future_to_element_id = {executor.submit(get_lego_store_result_for_element_id, element_id): element_id for element_id in request_element_ids}
-        for future in concurrent.futures.as_completed(future_to_element_id):
-            element_id = future_to_element_id[future]
-            try:
-                data = future.result()
-                if data is None:
-                    database.insert_lego_store_entry(element_id, lego_sells=False, bestseller=None, price=None, max_order_quantity=None)
-                    database_insertions += 1
-                else:
-                    if data['deliveryChannel'] not in ['pab', 'bap']:
-                        raise ValueError(f"Invalid delivery channel: {data['deliveryChannel']}")
-                    database.insert_lego_store_entry(element_id,
-                                                     lego_sells=True,
-                                                     bestseller=(data['deliveryChannel'] == 'pab'),
-                                                     price=data['price']['centAmount'],
-                                                     max_order_quantity=data['maxOrderQuantity'])
-                    database_insertions += 1
-            except Exception as exc:
-                logging.error(f"Step 6 - Element ID {element_id} generated an exception: {exc}")
-    end_time = time.time()
-    elapsed_time = end_time - start_time
-    minutes, seconds = divmod(int(elapsed_time), 60)
-    logging.info(f"Step 6 complete - database insertions: {database_insertions}, time taken: {minutes} minutes and {seconds} seconds")
+    Used where nobody is there to answer the prompt, such as the server. Ties go to the first element.
+
+    Args:
+        part (Part): The part.
+        options (list of dict): The elements LEGO sells for the part.
+
+    Returns:
+        dict: The chosen element.
+    """
+    return max(options, key=lambda option: option['maxOrderQuantity'] or 0)
+
+
+def convert_partslist(input_xml_file, database, engine, journal, parse_workers=DEFAULT_PARSE_WORKERS, stream=False, condition='X',
+                      choose_option=prompt_for_option, parse_pool=None):
+    """
+    Convert a BrickLink XML partslist into Pick-a-Brick orders, and export the parts LEGO does not sell back to XML.
+
+    Args:
+        input_xml_file (str): Path to the input XML file. The output files are written next to it.
+        database (DatabaseManager): The database to cache the lookups in.
+        engine (request_session.FetchEngine): The engine to make the requests with.
+        journal (journal.RunJournal): The journal recording the progress of the run.
+        parse_workers (int): Number of processes parsing BrickLink pages.
+        stream (bool): Whether to overlap the BrickLink and LEGO requests in one streaming pipeline.
+        condition (str): The condition of the parts exported back to BrickLink XML, 'N', 'U' or 'X'.
+        choose_option (callable): Chooses between two equally priced elements for a part, given the part and the
+            elements. Asks the user by default.
+        parse_pool (concurrent.futures.ProcessPoolExecutor): A running pool to parse the BrickLink pages in, instead of a new one.
+
+    Returns:
+        int: The number of lots in the partslist.
+    """
+    # Step 0 and 1 - Stream the input XML file, rounding up all design IDs as the parts go by
+    bricklink_xml_partslist = []
+    unique_design_ids = set()
+    with metrics.timer('step_seconds', step='0'):
+        for part in iter_xml(input_xml_file):
+            bricklink_xml_partslist.append(part)
+            unique_design_ids.add(part.design_id)
+    logging.info("Step 0 complete - bricklink XML partslist %s", summarize(bricklink_xml_partslist))
+    logging.log(TRACE, "Step 0 bricklink XML partslist: %s", bricklink_xml_partslist)
+    logging.info("Step 1 complete - unique design IDs %s", summarize(unique_design_ids))
+    logging.log(TRACE, "Step 1 unique design IDs: %s", unique_design_ids)
+
+    # Step 2 - Find out which design IDs are NOT in the bricklink database table, or are stale
+    with metrics.timer('step_seconds', step='2'):
+        request_design_ids = journal.get_keys('3', lambda: database.get_missing_design_ids(unique_design_ids))
+    logging.info("Step 2 complete - request design IDs %s", summarize(request_design_ids))
+    logging.log(TRACE, "Step 2 request design IDs: %s", request_design_ids)
+
+    # Steps 3 to 6 - Fetch the missing designs from bricklink, and the missing element IDs from lego pick-a-brick
+    if stream:
+        run_streaming_lookups(database, engine, journal, bricklink_xml_partslist, request_design_ids, parse_workers, parse_pool)
+    else:
+        run_staged_lookups(database, engine, journal, bricklink_xml_partslist, request_design_ids, parse_workers, parse_pool)
+
+    # Steps 7 and 8 - Sort the parts into orders and export them
+    export_partslist(input_xml_file, bricklink_xml_partslist, database, journal, condition, choose_option)
+    return len(bricklink_xml_partslist)
 
+
+def export_partslist(input_xml_file, bricklink_xml_partslist, database, journal, condition='X', choose_option=prompt_for_option):
+    """
+    Run Steps 7 and 8, sorting the parts of a partslist into Pick-a-Brick orders from the database and exporting them.
+
+    Args:
+        input_xml_file (str): Path to the input XML file. The output files are written next to it.
+        bricklink_xml_partslist (list of Part): The parts of the input XML file, all looked up already.
+        database (DatabaseManager): The database holding the lookups.
+        journal (journal.RunJournal): The journal recording the progress of the run.
+        condition (str): The condition of the parts exported back to BrickLink XML, 'N', 'U' or 'X'.
+        choose_option (callable): Chooses between two equally priced elements for a part, given the part and the
+            elements. Asks the user by default.
+    """
     # Step 7 - Resolve all potential issues with the data
+    journal.begin_step('7')
+    step_timer = metrics.timer('step_seconds', step='7')
 
     not_available_final_list = []
     not_available_total_count = 0
     bucket_one_available = []
     bucket_two_available = []
 
-    # Step 7.1 - For each part in the original list, find out how many elements it has that LEGO sells
-    LEGO_SELLS_COLUMN = 4
+    # Step 7.1 - For each part in the original list, find out which elements LEGO sells, all in one query
+    sellable_elements = database.get_sellable_elements_by_design_id_and_color_code_pairs(part.key for part in bricklink_xml_partslist)
     for part in bricklink_xml_partslist:
-        available_elements = 0
-        element_results = database.match_bricklink_entries_to_lego_store_entries(part['design_id'], part['color_id'])
-
-        for element_result in element_results:
-            if element_result[LEGO_SELLS_COLUMN]:
-                available_elements += 1
+        options = [dict(element, quantity=part.quantity) for element in sellable_elements.get(part.key, [])]
 
-        if available_elements == 0:
+        if len(options) == 0:
             not_available_final_list.append(part)
-            not_available_total_count += int(part['quantity'])
-        elif available_elements == 1:
-            bucket_one_available.append(part)
-        elif available_elements == 2:
-            bucket_two_available.append(part)
+            not_available_total_count += part.quantity
+        elif len(options) == 1:
+            bucket_one_available.append((part, options))
+        elif len(options) == 2:
+            bucket_two_available.append((part, options))
         else:
-            logging.error(f"Part {part} has {available_elements} available elements from the store")
+            logging.error(f"Part {part} has {len(options)} available elements from the store")
 
-    logging.info(f"Step 7.1 complete - bucket not available (length {len(not_available_final_list)}): {not_available_final_list}")
-    logging.info(f"Step 7.1 complete - bucket one available (length {len(bucket_one_available)}): {bucket_one_available}")
-    logging.info(f"Step 7.1 complete - bucket two available (length {len(bucket_two_available)}): {bucket_two_available}")
+    logging.info("Step 7.1 complete - bucket not available %s", summarize(not_available_final_list))
+    logging.info("Step 7.1 complete - bucket one available %s", summarize([part for part, _ in bucket_one_available]))
+    logging.info("Step 7.1 complete - bucket two available %s", summarize([part for part, _ in bucket_two_available]))
+    if logging.getLogger().isEnabledFor(TRACE):
+        logging.log(TRACE, "Step 7.1 bucket not available: %s", not_available_final_list)
+        logging.log(TRACE, "Step 7.1 bucket one available: %s", [part for part, _ in bucket_one_available])
+        logging.log(TRACE, "Step 7.1 bucket two available: %s", [part for part, _ in bucket_two_available])
 
     # Step 7.2 - Find out how many "one available" options are bestseller vs not
-    BESTSELLER_COLUMN = 5
-
     bestseller_final_list = []
     bestseller_total_count = 0
 
     non_bestseller_final_list = []
     non_bestseller_total_count = 0
 
-    for part in bucket_one_available:
-        element_results = database.match_bricklink_entries_to_lego_store_entries(part['design_id'], part['color_id'])
-
-        for element_result in element_results:
-            if element_result[LEGO_SELLS_COLUMN]:
-                if element_result[BESTSELLER_COLUMN]:
-                    bestseller_final_list.append({'elementId': element_result[0], 'quantity': part['quantity']})
-                    bestseller_total_count += int(part['quantity'])
-                else:
-                    non_bestseller_final_list.append({'elementId': element_result[0], 'quantity': part['quantity']})
-                    non_bestseller_total_count += int(part['quantity'])
+    for part, (option,) in bucket_one_available:
+        if option['bestseller']:
+            bestseller_final_list.append(PickABrickLot(option['elementId'], part.quantity))
+            bestseller_total_count += part.quantity
+        else:
+            non_bestseller_final_list.append(PickABrickLot(option['elementId'], part.quantity))
+            non_bestseller_total_count += part.quantity
 
     logging.info(f"Step 7.2 complete - In the 'one available' bucket, bestseller has {len(bestseller_final_list)} lots \
                    and {bestseller_total_count} total parts, non-bestseller has {len(non_bestseller_final_list)} lots \
                    and {non_bestseller_total_count} total parts")
 
     # Step 7.3 - Compare prices and max order quantity for each of the "two available" parts
-    PRICE_COLUMN = 6
-    MAX_ORDER_QUANTITY_COLUMN = 7
-
-    for part in bucket_two_available:
-        element_results = database.match_bricklink_entries_to_lego_store_entries(part['design_id'], part['color_id'])
-
-        options = []
-
-        for element_result in element_results:
-            if element_result[LEGO_SELLS_COLUMN]:
-                options.append({
-                    'elementId': element_result[0],
-                    'quantity': part['quantity'],
-                    'price': element_result[PRICE_COLUMN],
-                    'maxOrderQuantity': element_result[MAX_ORDER_QUANTITY_COLUMN],
-                    'bestseller': element_result[BESTSELLER_COLUMN]
-                })
-                logger.info(f"Comparing part {part} with element ID {element_result[0]} - Max Order Quantity: {element_result[MAX_ORDER_QUANTITY_COLUMN]}, \
-                              BestSeller = {element_result[BESTSELLER_COLUMN]}, Price: {element_result[PRICE_COLUMN]} cents")
-
-        print("You must choose one of the following options:")
-        for i, option in enumerate(options):
-            print(f"{i+1}. {option}")
+    for part, options in bucket_two_available:
+        for option in options:
+            logging.info("Comparing part %s with element ID %s - Max Order Quantity: %s, BestSeller = %s, Price: %s cents",
+                        part, option['elementId'], option['maxOrderQuantity'], option['bestseller'], option['price'])
+
         option = None
         if options[0]['price'] != options[1]['price']:
             option = options[0] if options[0]['price'] < options[1]['price'] else options[1]
-        while option is None:
-            try:
-                submitted = int(input("Which option would you like to choose? "))
-                if submitted < 1 or submitted > len(options):
-                    print(f"Invalid option: {submitted}")
-                else:
-                    option = options[submitted - 1]
-            except ValueError as exc:
-                print(f"Invalid option: {exc}")
-                option = None
+        # A resumed run does not ask again about the parts the user already chose for
+        choice = journal.get_choice(part.key)
+        if option is None and choice is not None:
+            option = next((candidate for candidate in options if str(candidate['elementId']) == choice), None)
+        if option is None:
+            option = choose_option(part, options)
+            journal.record_choice(part.key, str(option['elementId']))
 
         if option['bestseller']:
-            bestseller_final_list.append({'elementId': option['elementId'], 'quantity': option['quantity']})
-            bestseller_total_count += int(part['quantity'])
+            bestseller_final_list.append(PickABrickLot(option['elementId'], option['quantity']))
+            bestseller_total_count += part.quantity
         else:
-            non_bestseller_final_list.append({'elementId': option['elementId'], 'quantity': option['quantity']})
-            non_bestseller_total_count += int(part['quantity'])
+            non_bestseller_final_list.append(PickABrickLot(option['elementId'], option['quantity']))
+            non_bestseller_total_count += part.quantity
 
-        logging.info(f"User chose option {option}")
+        logging.info("Chose option %s", option)
 
-    logger.info(f"Step 7.3 complete - Price and max order quantity comparison complete; bestseller now has {len(bestseller_final_list)} lots \
+    logging.info(f"Step 7.3 complete - Price and max order quantity comparison complete; bestseller now has {len(bestseller_final_list)} lots \
                   and {bestseller_total_count} total parts, non-bestseller has {len(non_bestseller_final_list)} lots \
                   and {non_bestseller_total_count} total parts")
+    step_timer.stop()
+    metrics.increment('lots_total', len(not_available_final_list), destination='not_available')
+    metrics.increment('lots_total', len(bestseller_final_list), destination='bestseller')
+    metrics.increment('lots_total', len(non_bestseller_final_list), destination='non_bestseller')
 
     # Step 8 - export the data to the output file
+    journal.begin_step('8')
+    step_timer = metrics.timer('step_seconds', step='8')
 
     # Step 8.1 - export the not available parts
-    not_available_filename = os.path.splitext(args.input_xml_file)[0] + '_not_available.xml'
-    condition = None
-    if args.bricklink_new:
-        condition = 'N'
-    elif args.bricklink_used:
-        condition = 'U'
-    else:
-        condition = 'X'
+    not_available_filename = os.path.splitext(input_xml_file)[0] + '_not_available.xml'
     export_xml(not_available_final_list, not_available_filename, condition)
 
     # Step 8.2 - Break lists into sub-lists to keep each under 200 lots
@@ -313,14 +375,14 @@ def main():
         num_non_bestseller_chunks = 1
         non_bestseller_chunks = [non_bestseller_final_list]
 
-    logger.info(f"Step 8.2 complete - bestseller list will be written in {num_bestseller_chunks} chunks, non-bestseller list \
+    logging.info(f"Step 8.2 complete - bestseller list will be written in {num_bestseller_chunks} chunks, non-bestseller list \
                   will be written in {num_non_bestseller_chunks} chunks")
 
     # Step 8.3 - export all parts to CSV or JSON, breaking up the individual lists to be under 200 lots per delivery
     for export_function in [export_csv, export_json]:
         file_extension = export_function.__name__.split('_')[1]
         for i in range(0, max(num_bestseller_chunks, num_non_bestseller_chunks)):
-            output_filename = os.path.splitext(args.input_xml_file)[0] + f'_order{i+1}.' + file_extension
+            output_filename = os.path.splitext(input_xml_file)[0] + f'_order{i+1}.' + file_extension
             bestseller_chunk = []
             non_bestseller_chunk = []
             if i < num_bestseller_chunks:
@@ -328,11 +390,93 @@ def main():
             if i < num_non_bestseller_chunks:
                 non_bestseller_chunk = non_bestseller_chunks[i]
             export_function(bestseller_chunk + non_bestseller_chunk, output_filename)
-            logger.info(f"Wrote {len(bestseller_chunk)} + {len(non_bestseller_chunk)} = {len(bestseller_chunk + non_bestseller_chunk)} \
+            logging.info(f"Wrote {len(bestseller_chunk)} + {len(non_bestseller_chunk)} = {len(bestseller_chunk + non_bestseller_chunk)} \
                           entries to {output_filename}")
 
-    # Step 9 - close the database
+    step_timer.stop()
+
+
+def main():
+    """
+    Parse command-line arguments, set up logging, and process the XML file.
+
+    This function handles the main workflow of the script, including parsing
+    command-line arguments, setting up logging, and processing the input XML
+    file to export data to CSV or JSON.
+    """
+    parser = argparse.ArgumentParser(description='Process XML and export to CSV or JSON.')
+    parser.add_argument('input_xml_file', help='Path to the input XML file')
+    parser.add_argument('-ld', '--log_dir', default='logs', help='Path to the folder where log files will be created')
+    parser.add_argument('-db', '--database_file', default='part_info.db', help='Path to the SQLite database file')
+    parser.add_argument('-pb', '--purge_bricklink', action='store_true', help='Purge the BrickLink table in the database before processing the XML')
+    parser.add_argument('-pl', '--purge_lego_store', action='store_true', help='Purge the LEGO Pick-a-Brick table in the database before processing the XML')
+    parser.add_argument('-new', '--bricklink_new', action='store_true', help='Set part condition to NEW for unavailable items exported back to BrickLink XML')
+    parser.add_argument('-used', '--bricklink_used', action='store_true',
+                        help='Set part condition to USED for unavailable items exported back to BrickLink XML')
+    parser.add_argument('-w', '--workers', type=int, default=DEFAULT_CONCURRENCY, help='Maximum number of web requests in flight at once')
+    parser.add_argument('-pw', '--parse_workers', type=int, default=DEFAULT_PARSE_WORKERS, help='Number of processes parsing BrickLink pages')
+    parser.add_argument('-hc', '--http_cache_file', default=DEFAULT_CACHE_FILE, help='Path to the SQLite file caching raw web responses')
+    parser.add_argument('-nc', '--no_http_cache', action='store_true', help='Do not cache raw web responses')
+    parser.add_argument('-s', '--stream', action='store_true', help='Overlap the BrickLink and LEGO requests in one streaming pipeline')
+    parser.add_argument('-cf', '--catalog_file', help='BrickLink catalog codes file (Codes.txt or XML) to import before scraping')
+    parser.add_argument('--debug', action='store_true', help='Enable debug logging')
+    parser.add_argument('--trace', action='store_true', help='Enable debug logging, and log every partslist, ID set and bucket in full')
+    parser.add_argument('-r', '--resume', action='store_true', help='Continue the last unfinished run on the same input where it stopped')
+    parser.add_argument('-pm', '--prometheus_file', help='Also write the metrics of the run to this file in the Prometheus text format')
+    args = parser.parse_args()
+
+    input_basename = os.path.splitext(os.path.basename(args.input_xml_file))[0]
+    timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
+    logfile_name = os.path.join(args.log_dir, f"convert_{input_basename}_{timestamp}.txt")
+    metrics_file_name = os.path.join(args.log_dir, f"convert_{input_basename}_{timestamp}_metrics.json")
+
+    logger = setup_logger(logfile_name, get_level(args.debug, args.trace))
+    metrics.reset()
+
+    database = DatabaseManager(args.database_file, logger)
+
+    # Don't actually convert if purge is requested
+    if args.purge_bricklink:
+        database.purge_bricklink_table()
+        return
+    if args.purge_lego_store:
+        database.purge_lego_store_table()
+        return
+
+    # Pre-seed the bricklink database table from the catalog download, so only designs missing from it are scraped
+    if args.catalog_file:
+        import_catalog(database, args.catalog_file)
+
+    http_cache = None if args.no_http_cache else ResponseCache(args.http_cache_file)
+    engine = FetchEngine(args.workers, http_cache)
+
+    condition = None
+    if args.bricklink_new:
+        condition = 'N'
+    elif args.bricklink_used:
+        condition = 'U'
+    else:
+        condition = 'X'
+
+    # Steps 0 to 8, journaled so that a run that stops halfway can be resumed
+    journal = RunJournal(database, 'convert', args.input_xml_file, args.resume)
+    try:
+        lots = convert_partslist(args.input_xml_file, database, engine, journal, args.parse_workers, args.stream, condition)
+    except BaseException:
+        journal.stop()
+        engine.close()
+        raise
+    journal.finish()
+
+    # Step 9 - close the database, the web sessions and the response cache, and write out the metrics of the run
     database.close()
+    engine.close()
+    if http_cache:
+        http_cache.close()
+    metrics.registry.write_json(metrics_file_name, pipeline='convert', input_file=args.input_xml_file, lots=lots)
+    if args.prometheus_file:
+        metrics.registry.write_prometheus(args.prometheus_file)
+    logger.info(f"Wrote the metrics of the run to {metrics_file_name}")
 
 
 if __name__ == '__main__':
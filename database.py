@@ -2,10 +2,43 @@
 Database.
 
 This module provides the DatabaseManager class for managing the SQLite cache
-holding BrickLink and LEGO Pick-a-Brick data.
+holding BrickLink and LEGO Pick-a-Brick data. Every row records when it was
+fetched, and each table has a maximum age after which its rows are considered
+stale and get requested again. Inserted rows are buffered and written in
+batches, each batch in its own transaction. Queries and writes are timed in
+the metrics registry.
 """
 
+import time
 import sqlite3
+import metrics
+
+DAY = 24 * 60 * 60
+
+# Maximum age of a cached row, in seconds, per table
+DEFAULT_MAX_AGES = {
+    'bricklink_entries': 90 * DAY,  # Element IDs of a design rarely change
+    'lego_store_entries': 1 * DAY,  # Pick-a-Brick prices and availability change daily
+    'lego_store_entries_not_sold': 7 * DAY,  # Parts LEGO does not sell rarely show up in Pick-a-Brick overnight
+    'bricklink_store_lots': 1 * DAY,  # Store lot prices change daily
+}
+
+# Number of buffered rows that triggers a write to the database
+DEFAULT_BATCH_SIZE = 500
+
+# Number of seconds after which buffered rows are written to the database, however few there are
+DEFAULT_FLUSH_INTERVAL = 5.0
+
+INSERT_STATEMENTS = {
+    'bricklink_entries': 'INSERT OR REPLACE INTO bricklink_entries VALUES (?, ?, ?, ?)',
+    'lego_store_entries': 'INSERT OR REPLACE INTO lego_store_entries VALUES (?, ?, ?, ?, ?, ?)',
+    'bricklink_store_lots': 'INSERT OR REPLACE INTO bricklink_store_lots VALUES (?, ?, ?, ?, ?, ?, ?)',
+    # Written last, so a key is only ever marked done in the same transaction as its rows
+    'run_keys': 'INSERT OR REPLACE INTO run_keys VALUES (?, ?, ?, ?)',
+}
+
+# Tables holding fetched rows, each with a fetched_at timestamp
+CACHE_TABLES = ('bricklink_entries', 'lego_store_entries', 'bricklink_store_lots')
 
 
 class DatabaseManager:
@@ -16,28 +49,60 @@ class DatabaseManager:
         connection (sqlite3.Connection): The database connection.
         cursor (sqlite3.Cursor): The database cursor.
         logger (logging.Logger): The logger instance.
+        max_ages (dict): Maps table names to the maximum age of their rows, in seconds.
+        batch_size (int): The number of buffered rows that triggers a write.
+        flush_interval (float): The number of seconds after which buffered rows are written.
     """
 
-    def __init__(self, database_filename, logger_instance):
+    def __init__(self, database_filename, logger_instance, max_ages=None, batch_size=DEFAULT_BATCH_SIZE, flush_interval=DEFAULT_FLUSH_INTERVAL):
         """
         Initialize the DatabaseManager with a database connection and logger.
 
         Args:
             database_filename (str): The filename of the SQLite database.
             logger_instance (logging.Logger): The logger instance.
+            max_ages (dict): Overrides for the maximum age of the rows of each table, in seconds.
+            batch_size (int): The number of buffered rows that triggers a write.
+            flush_interval (float): The number of seconds after which buffered rows are written.
         """
         self.connection = sqlite3.connect(database_filename)
         self.cursor = self.connection.cursor()
         self.logger = logger_instance
+        self.max_ages = dict(DEFAULT_MAX_AGES, **(max_ages or {}))
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self._pending_rows = {table: [] for table in INSERT_STATEMENTS}
+        self._pending_count = 0
+        self._last_flush = time.monotonic()
+        self.cursor.execute('PRAGMA journal_mode=WAL')
+        self.cursor.execute('PRAGMA synchronous=NORMAL')  # Safe with WAL; only the last transactions can be lost on power failure
+        self.cursor.execute('PRAGMA cache_size=-65536')  # 64 MB page cache
         self._create_tables()
         self.logger.debug("[DB] Connection established.")
 
     def _create_tables(self):
-        """Create the necessary tables if they do not exist."""
+        """Create the necessary tables if they do not exist, and migrate them to the current schema version."""
+        migrations = [self._migrate_to_version_1, self._migrate_to_version_2, self._migrate_to_version_3, self._migrate_to_version_4]
+        version = self.cursor.execute('PRAGMA user_version').fetchone()[0]
+        for new_version, migration in enumerate(migrations, 1):
+            if version >= new_version:
+                continue
+            self.cursor.execute('BEGIN')
+            migration()
+            self.cursor.execute(f'PRAGMA user_version = {new_version}')
+            self.connection.commit()
+            self.logger.info(f"[DB] Migrated schema to version {new_version}")
+
+        for name, detail in self.check_query_plans():
+            self.logger.warning(f"[DB] Query {name} does not use an index: {detail}")
+
+    def _migrate_to_version_1(self):
+        """Create the original tables, with a fetched_at timestamp on every row."""
         self.cursor.execute('''CREATE TABLE IF NOT EXISTS bricklink_entries (
             element_id TEXT NOT NULL PRIMARY KEY,
             design_id TEXT NOT NULL,
-            color_code TEXT NOT NULL
+            color_code TEXT NOT NULL,
+            fetched_at REAL
         )''')
 
         self.cursor.execute('''CREATE TABLE IF NOT EXISTS lego_store_entries (
@@ -45,7 +110,8 @@ class DatabaseManager:
             lego_sells BOOLEAN NOT NULL,
             bestseller BOOLEAN,
             price REAL,
-            max_order_quantity INTEGER
+            max_order_quantity INTEGER,
+            fetched_at REAL
         )''')
 
         self.cursor.execute('''CREATE TABLE IF NOT EXISTS bricklink_store_lots (
@@ -54,33 +120,237 @@ class DatabaseManager:
             price REAL NOT NULL,
             design_id TEXT NOT NULL,
             color_code TEXT NOT NULL,
-            type TEXT NOT NULL
+            type TEXT NOT NULL,
+            fetched_at REAL
+        )''')
+
+        # Databases created before rows were timestamped lack the column; their rows count as stale
+        for table in CACHE_TABLES:
+            columns = [column[1] for column in self.cursor.execute(f'PRAGMA table_info({table})')]
+            if 'fetched_at' not in columns:
+                self.cursor.execute(f'ALTER TABLE {table} ADD COLUMN fetched_at REAL')
+                self.logger.info(f"[DB] Added fetched_at column to {table}")
+
+    def _migrate_to_version_2(self):
+        """Index BrickLink entries by design and color, and key store lots by store and lot ID."""
+        self.cursor.execute('CREATE INDEX IF NOT EXISTS bricklink_entries_design_color ON bricklink_entries (design_id, color_code)')
+
+        # Rebuild the store lots table with a primary key, keeping only the latest copy of each duplicated lot
+        self.cursor.execute('''CREATE TABLE bricklink_store_lots_v2 (
+            store_id TEXT NOT NULL,
+            lot_id TEXT NOT NULL,
+            price REAL NOT NULL,
+            design_id TEXT NOT NULL,
+            color_code TEXT NOT NULL,
+            type TEXT NOT NULL,
+            fetched_at REAL,
+            PRIMARY KEY (store_id, lot_id)
+        )''')
+        self.cursor.execute('''INSERT OR REPLACE INTO bricklink_store_lots_v2
+                               SELECT store_id, lot_id, price, design_id, color_code, type, fetched_at
+                               FROM bricklink_store_lots ORDER BY rowid''')
+        self.cursor.execute('DROP TABLE bricklink_store_lots')
+        self.cursor.execute('ALTER TABLE bricklink_store_lots_v2 RENAME TO bricklink_store_lots')
+
+    def _migrate_to_version_3(self):
+        """Track the BrickLink catalog files imported into the BrickLink table."""
+        self.cursor.execute('''CREATE TABLE IF NOT EXISTS catalog_imports (
+            path TEXT NOT NULL PRIMARY KEY,
+            mtime REAL NOT NULL,
+            size INTEGER NOT NULL,
+            sha256 TEXT NOT NULL,
+            row_count INTEGER NOT NULL,
+            imported_at REAL NOT NULL
+        )''')
+
+    def _migrate_to_version_4(self):
+        """Add the run journal, tracking the step and the done, failed and pending keys of every run."""
+        self.cursor.execute('''CREATE TABLE IF NOT EXISTS runs (
+            run_id INTEGER PRIMARY KEY,
+            pipeline TEXT NOT NULL,
+            input_file TEXT NOT NULL,
+            fingerprint TEXT NOT NULL,
+            step TEXT,
+            status TEXT NOT NULL,
+            started_at REAL NOT NULL,
+            updated_at REAL NOT NULL
+        )''')
+        self.cursor.execute('CREATE INDEX IF NOT EXISTS runs_pipeline_fingerprint ON runs (pipeline, fingerprint, status)')
+        self.cursor.execute('''CREATE TABLE IF NOT EXISTS run_keys (
+            run_id INTEGER NOT NULL,
+            step TEXT NOT NULL,
+            key TEXT NOT NULL,
+            status TEXT NOT NULL,
+            PRIMARY KEY (run_id, step, key)
+        )''')
+        self.cursor.execute('''CREATE TABLE IF NOT EXISTS run_choices (
+            run_id INTEGER NOT NULL,
+            key TEXT NOT NULL,
+            choice TEXT NOT NULL,
+            PRIMARY KEY (run_id, key)
         )''')
 
+    def check_query_plans(self):
+        """
+        Check that the hot queries look rows up through an index instead of scanning a table.
+
+        Returns:
+            list of tuple: The (query name, plan detail) of every full table scan found.
+        """
+        hot_queries = {
+            'get_bricklink_entries_by_design_id_and_color_code': ('SELECT element_id FROM bricklink_entries WHERE design_id = ? AND color_code = ?',
+                                                                  ('', '')),
+            'get_bricklink_cart_entry_by_store_and_lot_id': ('SELECT price FROM bricklink_store_lots WHERE store_id = ? AND lot_id = ?', ('', '')),
+            'match_bricklink_entries_to_lego_store_entries': ('''
+                select lse.price from bricklink_entries be
+                inner join lego_store_entries lse on be.element_id = lse.element_id
+                where be.design_id = ? and be.color_code = ?
+                ''', ('', '')),
+            'compare_prices_for_lot': ('''
+                select lse.price from lego_store_entries lse
+                join bricklink_entries be on lse.element_id == be.element_id
+                join bricklink_store_lots bsl on be.design_id == bsl.design_id and be.color_code == bsl.color_code
+                where bsl.store_id = ? and bsl.lot_id = ?
+                ''', ('', '')),
+        }
+        scans = []
+        for name, (query, parameters) in hot_queries.items():
+            for row in self.cursor.execute(f'EXPLAIN QUERY PLAN {query}', parameters).fetchall():
+                detail = row[-1]
+                if detail.startswith('SCAN') and 'INDEX' not in detail:
+                    scans.append((name, detail))
+        return scans
+
+    def _freshness_cutoff(self, table):
+        """
+        Get the oldest fetch time at which a row of a table is still fresh.
+
+        Args:
+            table (str): The table name.
+
+        Returns:
+            float: The cutoff, as a UNIX timestamp.
+        """
+        return time.time() - self.max_ages[table]
+
+    @metrics.timed('db_query_seconds')
     def close(self):
-        """Commit changes and close the database connection."""
+        """Write buffered rows, commit changes and close the database connection."""
+        self.flush()
         self.connection.commit()
         self.connection.close()
         self.logger.debug("[DB] Connection closed.")
 
+    def _buffer_row(self, table, row):
+        """
+        Buffer a row for a table, writing all buffered rows once the batch is full or old enough.
+
+        Args:
+            table (str): The table name.
+            row (tuple): The row to insert.
+        """
+        self._pending_rows[table].append(row)
+        self._pending_count += 1
+        if self._pending_count >= self.batch_size or time.monotonic() - self._last_flush >= self.flush_interval:
+            self.flush()
+
+    @metrics.timed('db_query_seconds')
+    def flush(self):
+        """Write all buffered rows with executemany, in a single transaction."""
+        self._last_flush = time.monotonic()
+        if self._pending_count == 0:
+            return
+        with self.connection:
+            for table, rows in self._pending_rows.items():
+                if rows:
+                    self.cursor.executemany(INSERT_STATEMENTS[table], rows)
+                    metrics.increment('db_rows_written_total', len(rows), table=table)
+                    rows.clear()
+        self.logger.debug("[DB] Wrote batch of %s rows.", self._pending_count)
+        self._pending_count = 0
+
     def insert_bricklink_entry(self, element_id, design_id, color_code):
         """
-        Insert a new entry into the BrickLink table.
+        Insert or refresh an entry in the BrickLink table.
 
         Args:
             element_id (str): The element ID.
             design_id (str): The design ID.
             color_code (str): The color code.
         """
-        self.cursor.execute('INSERT OR IGNORE INTO bricklink_entries VALUES (?, ?, ?)', (element_id, design_id, color_code))
-        if self.cursor.rowcount == 0:
-            self.logger.debug(f"[DB] Skipped existing BrickLink entry: {element_id}, {design_id}, {color_code}")
-        else:
-            self.logger.debug(f"[DB] Inserted BrickLink entry: {element_id}, {design_id}, {color_code}")
+        self._buffer_row('bricklink_entries', (element_id, design_id, color_code, time.time()))
+
+    @metrics.timed('db_query_seconds')
+    def get_catalog_import(self, path):
+        """
+        Retrieve the record of the last import of a BrickLink catalog file.
+
+        Args:
+            path (str): The absolute path of the catalog file.
+
+        Returns:
+            tuple: (mtime, size, sha256, row_count, imported_at), or None if the file was never imported.
+        """
+        self.cursor.execute('SELECT mtime, size, sha256, row_count, imported_at FROM catalog_imports WHERE path = ?', (path,))
+        return self.cursor.fetchone()
+
+    @metrics.timed('db_query_seconds')
+    def record_catalog_import(self, path, mtime, size, sha256, row_count):
+        """
+        Record that a BrickLink catalog file is up to date in the database.
+
+        Args:
+            path (str): The absolute path of the catalog file.
+            mtime (float): The modification time of the file.
+            size (int): The size of the file, in bytes.
+            sha256 (str): The SHA-256 hash of the contents of the file.
+            row_count (int): The number of entries the file holds.
+        """
+        with self.connection:
+            self.cursor.execute('INSERT OR REPLACE INTO catalog_imports VALUES (?, ?, ?, ?, ?, ?)',
+                                (path, mtime, size, sha256, row_count, time.time()))
+
+    @metrics.timed('db_query_seconds')
+    def import_bricklink_entries(self, rows, path, mtime, size, sha256):
+        """
+        Bulk load BrickLink entries from a catalog file, in a single transaction with the record of the import.
+
+        Each entry is stamped with the time of the import, so it stays fresh for the
+        maximum age of the table however old the file is. Entries scraped more
+        recently than the file was modified are kept, unless they have gone stale.
+
+        Args:
+            rows (iterable of tuple): The (element ID, design ID, color code) entries.
+            path (str): The absolute path of the catalog file.
+            mtime (float): The modification time of the file.
+            size (int): The size of the file, in bytes.
+            sha256 (str): The SHA-256 hash of the contents of the file.
+
+        Returns:
+            int: The number of entries in the file.
+        """
+        self.flush()
+        imported_at = time.time()
+        cutoff = self._freshness_cutoff('bricklink_entries')
+        rows = [(element_id, design_id, color_code, imported_at, mtime, cutoff) for element_id, design_id, color_code in rows]
+        with self.connection:
+            self.cursor.executemany('''
+                                    INSERT INTO bricklink_entries VALUES (?1, ?2, ?3, ?4)
+                                    ON CONFLICT (element_id) DO UPDATE SET
+                                        design_id = excluded.design_id, color_code = excluded.color_code, fetched_at = excluded.fetched_at
+                                    WHERE bricklink_entries.fetched_at IS NULL OR bricklink_entries.fetched_at <= ?5
+                                        OR bricklink_entries.fetched_at < ?6
+                                    ''', rows)
+            written = self.cursor.rowcount
+            metrics.increment('db_rows_written_total', written, table='bricklink_entries')
+            self.cursor.execute('INSERT OR REPLACE INTO catalog_imports VALUES (?, ?, ?, ?, ?, ?)',
+                                (path, mtime, size, sha256, len(rows), imported_at))
+        self.logger.info(f"[DB] Imported {len(rows)} BrickLink entries from {path}, {written} of them written")
+        return len(rows)
 
     def insert_lego_store_entry(self, element_id, lego_sells, bestseller, price, max_order_quantity):
         """
-        Insert a new entry into the LEGO Pick-a-Brick table.
+        Insert or refresh an entry in the LEGO Pick-a-Brick table.
 
         Args:
             element_id (str): The element ID.
@@ -91,15 +361,11 @@ class DatabaseManager:
         """
         if price is not None:
             price = float(price[1:])
-        self.cursor.execute('INSERT OR IGNORE INTO lego_store_entries VALUES (?, ?, ?, ?, ?)', (element_id, lego_sells, bestseller, price, max_order_quantity))
-        if self.cursor.rowcount == 0:
-            self.logger.debug(f"[DB] Skipped existing LEGO Pick-a-Brick entry: {element_id}, {lego_sells}, {bestseller}, {price}, {max_order_quantity}")
-        else:
-            self.logger.debug(f"[DB] Inserted LEGO Pick-a-Brick entry: {element_id}, {lego_sells}, {bestseller}, {price}, {max_order_quantity}")
+        self._buffer_row('lego_store_entries', (element_id, lego_sells, bestseller, price, max_order_quantity, time.time()))
 
     def insert_bricklink_cart_entry(self, store_id, lot_id, price, design_id, color_code, type):
         """
-        Insert a new entry into the BrickLink cart table.
+        Insert or refresh an entry in the BrickLink cart table.
 
         Args:
             store_id (str): The store ID.
@@ -108,41 +374,30 @@ class DatabaseManager:
             design_id (str): The design ID.
             color_code (str): The color code.
         """
-        self.cursor.execute('INSERT OR IGNORE INTO bricklink_store_lots VALUES (?, ?, ?, ?, ?, ?)', (store_id, lot_id, price, design_id, color_code, type))
-        if self.cursor.rowcount == 0:
-            self.logger.debug(f"[DB] Skipped existing BrickLink cart entry: {store_id}, {lot_id}, {price}, {design_id}, {color_code}, {type}")
-        else:
-            self.logger.debug(f"[DB] Inserted BrickLink cart entry: {store_id}, {lot_id}, {price}, {design_id}, {color_code}, {type}")
+        self._buffer_row('bricklink_store_lots', (store_id, lot_id, price, design_id, color_code, type, time.time()))
 
-    def get_bricklink_entry_by_design_id(self, design_id):
+    @metrics.timed('db_query_seconds')
+    def get_bricklink_entry_by_design_id(self, design_id, fresh_only=False):
         """
         Retrieve a BrickLink entry by design ID.
 
         Args:
             design_id (int): The design ID.
+            fresh_only (bool): Whether to ignore entries older than the table's maximum age.
 
         Returns:
             tuple: The row corresponding to the design ID, or None if not found.
         """
-        self.cursor.execute('SELECT * FROM bricklink_entries WHERE design_id = ?', (design_id,))
-        self.logger.debug(f"[DB] Queried BrickLink entry by design ID: {design_id}")
-        return self.cursor.fetchone()
-    
-    def get_bricklink_cart_entry_by_store_and_lot_id(self, store_id, lot_id):
-        """
-        Retrieve a BrickLink cart entry by store and lot ID.
-
-        Args:
-            store_id (int): The store ID.
-            lot_id (int): The lot ID.
-
-        Returns:
-            tuple: The row corresponding to the store and lot ID, or None if not found.
-        """
-        self.cursor.execute('SELECT * FROM bricklink_store_lots WHERE store_id = ? AND lot_id = ?', (store_id, lot_id))
-        self.logger.debug(f"[DB] Queried BrickLink cart entry by store and lot ID: {store_id}, {lot_id}")
+        self.flush()
+        if fresh_only:
+            self.cursor.execute('SELECT element_id, design_id, color_code FROM bricklink_entries WHERE design_id = ? AND fetched_at >= ?',
+                                (design_id, self._freshness_cutoff('bricklink_entries')))
+        else:
+            self.cursor.execute('SELECT element_id, design_id, color_code FROM bricklink_entries WHERE design_id = ?', (design_id,))
+        self.logger.debug("[DB] Queried BrickLink entry by design ID: %s", design_id)
         return self.cursor.fetchone()
 
+    @metrics.timed('db_query_seconds')
     def get_bricklink_entries_by_design_id_and_color_code(self, design_id, color_code):
         """
         Retrieve a BrickLink entry by design ID and color code.
@@ -154,39 +409,255 @@ class DatabaseManager:
         Returns:
             tuple: The row corresponding to the design ID and color code, or None if not found.
         """
-        self.cursor.execute('SELECT * FROM bricklink_entries WHERE design_id = ? AND color_code = ?', (design_id, color_code))
-        self.logger.debug(f"[DB] Queried BrickLink entry by design ID and color code: {design_id}, {color_code}")
+        self.flush()
+        self.cursor.execute('SELECT element_id, design_id, color_code FROM bricklink_entries WHERE design_id = ? AND color_code = ?', (design_id, color_code))
+        self.logger.debug("[DB] Queried BrickLink entry by design ID and color code: %s, %s", design_id, color_code)
         return self.cursor.fetchall()
 
-    def get_lego_store_entry_by_element_id(self, element_id):
+    @metrics.timed('db_query_seconds')
+    def get_lego_store_entry_by_element_id(self, element_id, fresh_only=False):
         """
         Retrieve a LEGO Pick-a-Brick entry by element ID.
 
         Args:
             element_id (int): The element ID.
+            fresh_only (bool): Whether to ignore an entry older than its maximum age.
 
         Returns:
             tuple: The row corresponding to the element ID, or None if not found.
         """
-        self.cursor.execute('SELECT * FROM lego_store_entries WHERE element_id = ?', (element_id,))
-        self.logger.debug(f"[DB] Queried LEGO Pick-a-Brick entry by element ID: {element_id}")
+        self.flush()
+        if fresh_only:
+            self.cursor.execute('''SELECT element_id, lego_sells, bestseller, price, max_order_quantity FROM lego_store_entries
+                                   WHERE element_id = ? AND fetched_at >= (CASE WHEN lego_sells THEN ? ELSE ? END)''',
+                                (element_id, self._freshness_cutoff('lego_store_entries'), self._freshness_cutoff('lego_store_entries_not_sold')))
+        else:
+            self.cursor.execute('SELECT element_id, lego_sells, bestseller, price, max_order_quantity FROM lego_store_entries WHERE element_id = ?',
+                                (element_id,))
+        self.logger.debug("[DB] Queried LEGO Pick-a-Brick entry by element ID: %s", element_id)
         return self.cursor.fetchone()
 
-    def get_bricklink_cart_entry_by_store_and_lot_id(self, store_id, lot_id):
+    @metrics.timed('db_query_seconds')
+    def get_bricklink_cart_entry_by_store_and_lot_id(self, store_id, lot_id, fresh_only=False):
         """
         Retrieve a BrickLink cart entry by store and lot ID.
 
         Args:
             store_id (int): The store ID.
             lot_id (int): The lot ID.
+            fresh_only (bool): Whether to ignore an entry older than the table's maximum age.
 
         Returns:
             tuple: The row corresponding to the store and lot ID, or None if not found.
         """
-        self.cursor.execute('SELECT * FROM bricklink_store_lots WHERE store_id = ? AND lot_id = ?', (store_id, lot_id))
-        self.logger.debug(f"[DB] Queried BrickLink cart entry by store and lot ID: {store_id}, {lot_id}")
+        self.flush()
+        if fresh_only:
+            self.cursor.execute('''SELECT store_id, lot_id, price, design_id, color_code, type FROM bricklink_store_lots
+                                   WHERE store_id = ? AND lot_id = ? AND fetched_at >= ?''',
+                                (store_id, lot_id, self._freshness_cutoff('bricklink_store_lots')))
+        else:
+            self.cursor.execute('SELECT store_id, lot_id, price, design_id, color_code, type FROM bricklink_store_lots WHERE store_id = ? AND lot_id = ?',
+                                (store_id, lot_id))
+        self.logger.debug("[DB] Queried BrickLink cart entry by store and lot ID: %s, %s", store_id, lot_id)
         return self.cursor.fetchone()
-    
+
+    def _load_keys(self, name, columns, keys):
+        """
+        Load a set of keys into a temporary table, so they can be joined against in one query.
+
+        Args:
+            name (str): The name of the temporary table.
+            columns (tuple of str): The names of the key columns.
+            keys (iterable): The keys, as single values or as tuples matching the columns.
+
+        Returns:
+            int: The number of keys loaded.
+        """
+        rows = [key if isinstance(key, tuple) else (key,) for key in set(keys)]
+        self.cursor.execute(f'DROP TABLE IF EXISTS temp.{name}')
+        self.cursor.execute(f'CREATE TEMP TABLE {name} ({", ".join(f"{column} TEXT NOT NULL" for column in columns)}, PRIMARY KEY ({", ".join(columns)}))')
+        self.cursor.executemany(f'INSERT OR IGNORE INTO temp.{name} VALUES ({", ".join("?" for _ in columns)})', rows)
+        return len(rows)
+
+    @metrics.timed('db_query_seconds')
+    def get_missing_design_ids(self, design_ids, fresh_only=True):
+        """
+        Find which design IDs have no BrickLink entries.
+
+        Args:
+            design_ids (iterable): The design IDs to check.
+            fresh_only (bool): Whether to also count design IDs with only stale entries as missing.
+
+        Returns:
+            set: The design IDs that need to be requested.
+        """
+        self.flush()
+        count = self._load_keys('design_id_keys', ('design_id',), design_ids)
+        self.cursor.execute('''
+                            select k.design_id from temp.design_id_keys k
+                            where not exists (
+                                select 1 from bricklink_entries be
+                                where be.design_id = k.design_id and (? = 0 or be.fetched_at >= ?)
+                            )
+                            ''', (fresh_only, self._freshness_cutoff('bricklink_entries')))
+        missing = {row[0] for row in self.cursor.fetchall()}
+        self.logger.debug("[DB] Found %s missing of %s design IDs", len(missing), count)
+        return missing
+
+    @metrics.timed('db_query_seconds')
+    def get_missing_element_ids(self, element_ids, fresh_only=True):
+        """
+        Find which element IDs have no LEGO Pick-a-Brick entry.
+
+        Args:
+            element_ids (iterable): The element IDs to check.
+            fresh_only (bool): Whether to also count element IDs with a stale entry as missing. Entries
+                recording that LEGO does not sell an element go stale after their own, longer maximum age.
+
+        Returns:
+            set: The element IDs that need to be requested.
+        """
+        self.flush()
+        count = self._load_keys('element_id_keys', ('element_id',), element_ids)
+        self.cursor.execute('''
+                            select k.element_id from temp.element_id_keys k
+                            where not exists (
+                                select 1 from lego_store_entries lse
+                                where lse.element_id = k.element_id
+                                and (? = 0 or lse.fetched_at >= (case when lse.lego_sells then ? else ? end))
+                            )
+                            ''', (fresh_only, self._freshness_cutoff('lego_store_entries'), self._freshness_cutoff('lego_store_entries_not_sold')))
+        missing = {row[0] for row in self.cursor.fetchall()}
+        self.logger.debug("[DB] Found %s missing of %s element IDs", len(missing), count)
+        return missing
+
+    @metrics.timed('db_query_seconds')
+    def get_missing_store_lots(self, store_lots, fresh_only=True):
+        """
+        Find which (store ID, lot ID) pairs have no BrickLink cart entry.
+
+        Args:
+            store_lots (iterable of tuple): The (store ID, lot ID) pairs to check.
+            fresh_only (bool): Whether to also count pairs with a stale entry as missing.
+
+        Returns:
+            set of tuple: The (store ID, lot ID) pairs that need to be requested.
+        """
+        self.flush()
+        count = self._load_keys('store_lot_keys', ('store_id', 'lot_id'), store_lots)
+        self.cursor.execute('''
+                            select k.store_id, k.lot_id from temp.store_lot_keys k
+                            where not exists (
+                                select 1 from bricklink_store_lots bsl
+                                where bsl.store_id = k.store_id and bsl.lot_id = k.lot_id and (? = 0 or bsl.fetched_at >= ?)
+                            )
+                            ''', (fresh_only, self._freshness_cutoff('bricklink_store_lots')))
+        missing = set(self.cursor.fetchall())
+        self.logger.debug("[DB] Found %s missing of %s store lots", len(missing), count)
+        return missing
+
+    @metrics.timed('db_query_seconds')
+    def get_bricklink_cart_entries_by_store_and_lot_ids(self, store_lots):
+        """
+        Retrieve the BrickLink cart entries for many (store ID, lot ID) pairs at once.
+
+        Args:
+            store_lots (iterable of tuple): The (store ID, lot ID) pairs.
+
+        Returns:
+            dict: Maps each (store ID, lot ID) pair that has an entry to its row.
+        """
+        self.flush()
+        self._load_keys('store_lot_keys', ('store_id', 'lot_id'), store_lots)
+        self.cursor.execute('''
+                            select bsl.store_id, bsl.lot_id, bsl.price, bsl.design_id, bsl.color_code, bsl.type
+                            from temp.store_lot_keys k
+                            join bricklink_store_lots bsl on bsl.store_id = k.store_id and bsl.lot_id = k.lot_id
+                            ''')
+        entries = {(row[0], row[1]): row for row in self.cursor.fetchall()}
+        self.logger.debug("[DB] Queried %s BrickLink cart entries by store and lot ID", len(entries))
+        return entries
+
+    @metrics.timed('db_query_seconds')
+    def get_element_ids_by_design_id_and_color_code_pairs(self, pairs):
+        """
+        Retrieve the element IDs of many (design ID, color code) pairs at once.
+
+        Args:
+            pairs (iterable of tuple): The (design ID, color code) pairs.
+
+        Returns:
+            set: The element IDs of all of the pairs.
+        """
+        self.flush()
+        self._load_keys('design_color_keys', ('design_id', 'color_code'), pairs)
+        self.cursor.execute('''
+                            select distinct be.element_id
+                            from temp.design_color_keys k
+                            join bricklink_entries be on be.design_id = k.design_id and be.color_code = k.color_code
+                            ''')
+        element_ids = {row[0] for row in self.cursor.fetchall()}
+        self.logger.debug("[DB] Queried %s element IDs by design ID and color code", len(element_ids))
+        return element_ids
+
+    @metrics.timed('db_query_seconds')
+    def get_element_ids_by_store_and_lot_ids(self, store_lots):
+        """
+        Retrieve the element IDs matching many BrickLink cart entries at once.
+
+        Args:
+            store_lots (iterable of tuple): The (store ID, lot ID) pairs.
+
+        Returns:
+            set: The element IDs of the designs and colors of all of the cart entries.
+        """
+        self.flush()
+        self._load_keys('store_lot_keys', ('store_id', 'lot_id'), store_lots)
+        self.cursor.execute('''
+                            select distinct be.element_id
+                            from temp.store_lot_keys k
+                            join bricklink_store_lots bsl on bsl.store_id = k.store_id and bsl.lot_id = k.lot_id
+                            join bricklink_entries be on be.design_id = bsl.design_id and be.color_code = bsl.color_code
+                            ''')
+        element_ids = {row[0] for row in self.cursor.fetchall()}
+        self.logger.debug("[DB] Queried %s element IDs by store and lot ID", len(element_ids))
+        return element_ids
+
+    @metrics.timed('db_query_seconds')
+    def get_sellable_elements_by_design_id_and_color_code_pairs(self, pairs):
+        """
+        Retrieve the elements LEGO sells for many (design ID, color code) pairs in one query.
+
+        Args:
+            pairs (iterable of tuple): The (design ID, color code) pairs.
+
+        Returns:
+            dict: Maps each (design ID, color code) pair that has sellable elements to a
+                list of dicts with the elementId, price, bestseller and maxOrderQuantity
+                of each element, ordered by element ID.
+        """
+        self.flush()
+        self._load_keys('design_color_keys', ('design_id', 'color_code'), pairs)
+        self.cursor.execute('''
+                            select be.design_id, be.color_code, be.element_id, lse.price, lse.bestseller, lse.max_order_quantity
+                            from temp.design_color_keys k
+                            join bricklink_entries be on be.design_id = k.design_id and be.color_code = k.color_code
+                            join lego_store_entries lse on lse.element_id = be.element_id
+                            where lse.lego_sells
+                            order by be.design_id, be.color_code, be.element_id
+                            ''')
+        sellable_elements = {}
+        for design_id, color_code, element_id, price, bestseller, max_order_quantity in self.cursor.fetchall():
+            sellable_elements.setdefault((design_id, color_code), []).append({
+                'elementId': element_id,
+                'price': price,
+                'maxOrderQuantity': max_order_quantity,
+                'bestseller': bestseller
+            })
+        self.logger.debug("[DB] Queried sellable elements for %s designs and colors", len(sellable_elements))
+        return sellable_elements
+
+    @metrics.timed('db_query_seconds')
     def match_bricklink_cart_entries_to_element_ids(self, store_id, lot_id):
         """
         Match BrickLink entries to BrickLink cart entries by store and lot ID.
@@ -198,6 +669,7 @@ class DatabaseManager:
         Returns:
             tuple array: The matched rows, or an empty array if no matches are found.
         """
+        self.flush()
         self.cursor.execute('''
                             select element_id from bricklink_entries
                             join bricklink_store_lots
@@ -206,9 +678,10 @@ class DatabaseManager:
                             and bricklink_store_lots.store_id = ?
                             and bricklink_store_lots.lot_id = ?
                             ''', (store_id, lot_id))
-        self.logger.debug(f"[DB] Matched BrickLink entries to BrickLink cart entries by store and lot ID: {store_id}, {lot_id}")
+        self.logger.debug("[DB] Matched BrickLink entries to BrickLink cart entries by store and lot ID: %s, %s", store_id, lot_id)
         return self.cursor.fetchall()
 
+    @metrics.timed('db_query_seconds')
     def match_bricklink_entries_to_lego_store_entries(self, design_id, color_code):
         """
         Match BrickLink entries to LEGO Pick-a-Brick entries by design ID and color code.
@@ -220,16 +693,21 @@ class DatabaseManager:
         Returns:
             tuple array: The matched rows, or an empty array if no matches are found.
         """
+        self.flush()
         self.cursor.execute('''
-                            select * from bricklink_entries
+                            select bricklink_entries.element_id, bricklink_entries.design_id, bricklink_entries.color_code,
+                                   lego_store_entries.element_id, lego_store_entries.lego_sells, lego_store_entries.bestseller,
+                                   lego_store_entries.price, lego_store_entries.max_order_quantity
+                            from bricklink_entries
                             inner join lego_store_entries
                             on bricklink_entries.element_id = lego_store_entries.element_id
                             where bricklink_entries.design_id = ?
                             and bricklink_entries.color_code = ?
                             ''', (design_id, color_code))
-        self.logger.debug(f"[DB] Matched BrickLink entries to LEGO Pick-a-Brick entries by design ID and color code: {design_id}, {color_code}")
+        self.logger.debug("[DB] Matched BrickLink entries to LEGO Pick-a-Brick entries by design ID and color code: %s, %s", design_id, color_code)
         return self.cursor.fetchall()
     
+    @metrics.timed('db_query_seconds')
     def compare_prices_for_lot(self, store_id, lot_id):
         """
         Compare prices between LEGO Pick-a-Brick and BrickLink.
@@ -237,6 +715,7 @@ class DatabaseManager:
         Returns:
             tuple array: The matched rows, or an empty array if no matches are found.
         """
+        self.flush()
         self.cursor.execute('''
                             select lse.element_id, lse.price as lego_price, bsl.price as bricklink_price
                             from lego_store_entries lse
@@ -245,25 +724,176 @@ class DatabaseManager:
                             where bsl.store_id = ? and bsl.lot_id = ?
                             order by lse.element_id
                             ''', (store_id, lot_id))
-        self.logger.debug(f"[DB] Generated list to compare prices between LEGO Pick-a-Brick and BrickLink for store ID and lot ID: {store_id}, {lot_id}")
+        self.logger.debug("[DB] Generated list to compare prices between LEGO Pick-a-Brick and BrickLink for store ID and lot ID: %s, %s", store_id, lot_id)
         return self.cursor.fetchall()
     
+    @metrics.timed('db_query_seconds')
+    def start_run(self, pipeline, input_file, fingerprint):
+        """
+        Start a new run in the journal, abandoning any unfinished run of the same pipeline on the same input.
+
+        Args:
+            pipeline (str): The pipeline, 'convert' or 'save_me_money'.
+            input_file (str): The path to the input file.
+            fingerprint (str): The fingerprint of the input file.
+
+        Returns:
+            int: The ID of the new run.
+        """
+        now = time.time()
+        with self.connection:
+            stale_runs = [row[0] for row in self.cursor.execute('SELECT run_id FROM runs WHERE pipeline = ? AND fingerprint = ? AND status = ?',
+                                                                (pipeline, fingerprint, 'running'))]
+            for table in ('run_keys', 'run_choices'):
+                self.cursor.executemany(f'DELETE FROM {table} WHERE run_id = ?', ((run_id,) for run_id in stale_runs))
+            self.cursor.executemany('UPDATE runs SET status = ?, updated_at = ? WHERE run_id = ?', (('abandoned', now, run_id) for run_id in stale_runs))
+            self.cursor.execute('INSERT INTO runs (pipeline, input_file, fingerprint, step, status, started_at, updated_at) VALUES (?, ?, ?, NULL, ?, ?, ?)',
+                                (pipeline, input_file, fingerprint, 'running', now, now))
+            run_id = self.cursor.lastrowid
+        self.logger.debug("[DB] Started run %s, abandoning %s unfinished runs", run_id, len(stale_runs))
+        return run_id
+
+    @metrics.timed('db_query_seconds')
+    def get_unfinished_run(self, pipeline, fingerprint):
+        """
+        Get the latest unfinished run of a pipeline on an input.
+
+        Args:
+            pipeline (str): The pipeline, 'convert' or 'save_me_money'.
+            fingerprint (str): The fingerprint of the input file.
+
+        Returns:
+            tuple: (run ID, step) of the run, or None if there is none.
+        """
+        self.cursor.execute('SELECT run_id, step FROM runs WHERE pipeline = ? AND fingerprint = ? AND status = ? ORDER BY run_id DESC LIMIT 1',
+                            (pipeline, fingerprint, 'running'))
+        return self.cursor.fetchone()
+
+    def set_run_step(self, run_id, step):
+        """
+        Record the step a run has reached.
+
+        Args:
+            run_id (int): The ID of the run.
+            step (str): The step.
+        """
+        with self.connection:
+            self.cursor.execute('UPDATE runs SET step = ?, updated_at = ? WHERE run_id = ?', (step, time.time(), run_id))
+
+    @metrics.timed('db_query_seconds')
+    def add_run_keys(self, run_id, step, keys):
+        """
+        Record the keys a step of a run is about to look up as pending.
+
+        Args:
+            run_id (int): The ID of the run.
+            step (str): The step.
+            keys (iterable of str): The encoded keys.
+        """
+        with self.connection:
+            self.cursor.executemany('INSERT OR IGNORE INTO run_keys VALUES (?, ?, ?, ?)', ((run_id, step, key, 'pending') for key in keys))
+
+    @metrics.timed('db_query_seconds')
+    def get_run_keys(self, run_id, step):
+        """
+        Get the keys recorded for a step of a run.
+
+        Args:
+            run_id (int): The ID of the run.
+            step (str): The step.
+
+        Returns:
+            dict: Maps each encoded key to its status, 'pending', 'done' or 'failed'.
+        """
+        self.cursor.execute('SELECT key, status FROM run_keys WHERE run_id = ? AND step = ?', (run_id, step))
+        return dict(self.cursor.fetchall())
+
+    def mark_run_key(self, run_id, step, key, status):
+        """
+        Mark a key of a step of a run as done or failed.
+
+        The mark is buffered with the inserted rows and written in the same
+        transaction as them, so a key is never marked done before its rows are stored.
+
+        Args:
+            run_id (int): The ID of the run.
+            step (str): The step.
+            key (str): The encoded key.
+            status (str): 'done' or 'failed'.
+        """
+        self._buffer_row('run_keys', (run_id, step, key, status))
+
+    def record_run_choice(self, run_id, key, choice):
+        """
+        Record a choice the user made during a run, committing it right away.
+
+        Args:
+            run_id (int): The ID of the run.
+            key (str): The encoded key of what the choice was about.
+            choice (str): The choice.
+        """
+        with self.connection:
+            self.cursor.execute('INSERT OR REPLACE INTO run_choices VALUES (?, ?, ?)', (run_id, key, choice))
+
+    @metrics.timed('db_query_seconds')
+    def get_run_choices(self, run_id):
+        """
+        Get the choices the user made during a run.
+
+        Args:
+            run_id (int): The ID of the run.
+
+        Returns:
+            dict: Maps the encoded keys to their choices.
+        """
+        self.cursor.execute('SELECT key, choice FROM run_choices WHERE run_id = ?', (run_id,))
+        return dict(self.cursor.fetchall())
+
+    @metrics.timed('db_query_seconds')
+    def finish_run(self, run_id):
+        """
+        Mark a run as finished, and drop its keys and choices.
+
+        Args:
+            run_id (int): The ID of the run.
+        """
+        self.flush()
+        with self.connection:
+            self.cursor.execute('DELETE FROM run_keys WHERE run_id = ?', (run_id,))
+            self.cursor.execute('DELETE FROM run_choices WHERE run_id = ?', (run_id,))
+            self.cursor.execute('UPDATE runs SET status = ?, updated_at = ? WHERE run_id = ?', ('finished', time.time(), run_id))
+        self.logger.debug("[DB] Finished run %s", run_id)
+
+    @metrics.timed('db_query_seconds')
     def commit_changes(self):
-        """Commit changes to the database."""
+        """Write buffered rows and commit changes to the database."""
+        self.flush()
         self.connection.commit()
         self.logger.debug("[DB] Committed changes.")
 
+    @metrics.timed('db_query_seconds')
     def purge_bricklink_table(self):
         """Purge the BrickLink table."""
-        self.cursor.execute('DROP TABLE bricklink_entries')
+        self._pending_count -= len(self._pending_rows['bricklink_entries'])
+        self._pending_rows['bricklink_entries'].clear()
+        self.cursor.execute('DELETE FROM bricklink_entries')
+        self.connection.commit()
         self.logger.warning("[DB] Purged BrickLink table.")
 
+    @metrics.timed('db_query_seconds')
     def purge_lego_store_table(self):
         """Purge the LEGO Pick-a-Brick table."""
-        self.cursor.execute('DROP TABLE lego_store_entries')
+        self._pending_count -= len(self._pending_rows['lego_store_entries'])
+        self._pending_rows['lego_store_entries'].clear()
+        self.cursor.execute('DELETE FROM lego_store_entries')
+        self.connection.commit()
         self.logger.warning("[DB] Purged LEGO Pick-a-Brick table.")
 
+    @metrics.timed('db_query_seconds')
     def purge_bricklink_store_lots(self):
         """Purge the BrickLink store lots table."""
+        self._pending_count -= len(self._pending_rows['bricklink_store_lots'])
+        self._pending_rows['bricklink_store_lots'].clear()
         self.cursor.execute('DELETE FROM bricklink_store_lots')
+        self.connection.commit()
         self.logger.warning("[DB] Purged BrickLink store lots table.")
@@ -2,6 +2,8 @@
 Export.
 
 This module provides functions to export partslist data to CSV and JSON files.
+Each export function takes the record types from the records module and uses
+their converters to build its rows.
 """
 
 import csv
@@ -14,14 +16,14 @@ def export_csv(parts, path):
     Save partslist data to a CSV file.
 
     Args:
-        parts (list of dict): The partslist data to be exported.
+        parts (list of PickABrickLot): The partslist data to be exported.
         path (str): The file path where the CSV file will be saved.
     """
     fields = ['elementId', 'quantity']
     with open(path, 'w', newline='') as csv_file:
         writer = csv.DictWriter(csv_file, fieldnames=fields)
         writer.writeheader()
-        writer.writerows(parts)
+        writer.writerows(part.to_dict() for part in parts)
     logging.info(f"Exported {len(parts)} entries to {path}")
 
 
@@ -30,11 +32,11 @@ def export_json(parts, path):
     Save partslist data to a JSON file.
 
     Args:
-        parts (list of dict): The partslist data to be exported.
+        parts (list of PickABrickLot): The partslist data to be exported.
         path (str): The file path where the JSON file will be saved.
     """
     with open(path, 'w') as json_file:
-        json.dump(parts, json_file, indent=4)
+        json.dump([part.to_dict() for part in parts], json_file, indent=4)
     logging.info(f"Exported {len(parts)} entries to {path}")
 
 
@@ -43,8 +45,9 @@ def export_xml(parts, path, condition='X'):
     Save partslist data to an XML file.
 
     Args:
-        parts (list of dict): The partslist data to be exported.
+        parts (list of Part): The partslist data to be exported.
         path (str): The file path where the XML file will be saved.
+        condition (str): The part condition, 'X' (don't care), 'N' (new) or 'U' (used).
     """
     if condition not in ['X', 'N', 'U']:
         raise ValueError("Condition must be one of 'X' (don't care), 'N' (new), or 'U' (used)")
@@ -52,16 +55,13 @@ def export_xml(parts, path, condition='X'):
         xml_file.write('<?xml version="1.0" encoding="UTF-8"?>\n')
         xml_file.write('<INVENTORY>\n')
         for part in parts:
-            type = part['type']
-            design_id = part['design_id']
-            color_id = part['color_id']
-            quantity = part['quantity']
+            fields = part.to_xml_fields()
             xml_file.write('<ITEM>\n')
-            xml_file.write(f'<ITEMTYPE>{type}</ITEMTYPE>\n')
-            xml_file.write(f'<ITEMID>{design_id}</ITEMID>\n')
-            xml_file.write(f'<COLOR>{color_id}</COLOR>\n')
+            xml_file.write(f'<ITEMTYPE>{fields["ITEMTYPE"]}</ITEMTYPE>\n')
+            xml_file.write(f'<ITEMID>{fields["ITEMID"]}</ITEMID>\n')
+            xml_file.write(f'<COLOR>{fields["COLOR"]}</COLOR>\n')
             xml_file.write('<MAXPRICE>-1.0000</MAXPRICE>\n')
-            xml_file.write(f'<MINQTY>{quantity}</MINQTY>\n')
+            xml_file.write(f'<MINQTY>{fields["MINQTY"]}</MINQTY>\n')
             xml_file.write(f'<CONDITION>{condition}</CONDITION>\n')
             xml_file.write('<NOTIFY>N</NOTIFY>\n')
             xml_file.write('</ITEM>\n')
@@ -74,17 +74,29 @@ def export_cart(cart_items, path):
     Export cart lot data to a BrickLink .cart file.
 
     Args:
-        cart_items (list of dict): The cart lot data to be exported
+        cart_items (list of CartLot): The cart lot data to be exported
         path (str): The file path to save the BrickLink .cart file
     """
-    records = []
-    for item in cart_items:
-        record = f"{item.get('prefix', '')}:{item['store_id']}:{item['lot_id']}:{item['quantity']}"
-        records.append(record)
-    
+    records = [item.to_cart_record() for item in cart_items]
+
     ascii_data = '\n'.join(records)
     bytes_data = ascii_data.encode('ascii')
     cart_string = bytes_data.hex().upper()
     
     with open(path, 'w') as file:
-        file.write(cart_string)
\ No newline at end of file
+        file.write(cart_string)
+
+def export_decisions(decisions, path):
+    """
+    Save the reason each cart lot was kept on BrickLink or moved to Pick-a-Brick to a CSV file.
+
+    Args:
+        decisions (list of LotDecision): The decisions to be exported.
+        path (str): The file path where the CSV file will be saved.
+    """
+    fields = ['storeId', 'lotId', 'quantity', 'destination', 'reason', 'elementId', 'legoPrice', 'bricklinkPrice']
+    with open(path, 'w', newline='') as csv_file:
+        writer = csv.DictWriter(csv_file, fieldnames=fields)
+        writer.writeheader()
+        writer.writerows(decision.to_dict() for decision in decisions)
+    logging.info(f"Exported {len(decisions)} entries to {path}")
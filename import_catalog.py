@@ -0,0 +1,175 @@
+"""
+Import Catalog.
+
+Pre-seed the BrickLink table of the database from a BrickLink catalog download,
+so that convert.py and save_me_money.py only scrape the catalog pages of designs
+missing from it. Both the tab-separated Codes.txt and the XML codes export of
+the BrickLink catalog download page are supported.
+
+Imports are incremental. A file whose modification time and size have not
+changed since its last import is skipped without being read, and a file that
+was touched but whose contents hash the same is skipped after hashing it.
+Imported entries are stamped with the time of the import, so an unchanged file
+is only imported again once they have gone stale.
+"""
+
+import os
+import sys
+import csv
+import time
+import hashlib
+import logging
+import argparse
+import xml.etree.ElementTree as ET
+from database import DatabaseManager
+from colors import colors_by_id, colors_by_name
+
+# Size of the chunks a catalog file is hashed in
+HASH_CHUNK_SIZE = 1024 * 1024
+
+
+def get_color_code(color):
+    """
+    Get the BrickLink color code of a color, as written in a catalog file.
+
+    Args:
+        color (str): The color name, or its numeric code.
+
+    Returns:
+        str: The color code, or None if the color is unknown.
+    """
+    color = color.strip()
+    if color.isdigit() and int(color) in colors_by_id:
+        return color
+    color_id = colors_by_name.get(color)
+    return str(color_id) if color_id is not None else None
+
+
+def iter_codes_txt(path):
+    """
+    Stream the element IDs of a tab-separated Codes.txt catalog file.
+
+    Args:
+        path (str): The path to the Codes.txt file, with Item No, Color and Code columns.
+
+    Yields:
+        tuple: (element ID, design ID, color name) for every row.
+    """
+    with open(path, newline='', encoding='utf-8-sig', errors='replace') as codes_file:
+        reader = csv.reader(codes_file, delimiter='\t')
+        for row in reader:
+            if len(row) < 3 or row[0] == 'Item No':
+                continue
+            yield row[2].strip(), row[0].strip(), row[1]
+
+
+def iter_codes_xml(path):
+    """
+    Stream the element IDs of an XML catalog codes file, one ITEM at a time.
+
+    Args:
+        path (str): The path to the XML file, with ITEMTYPE, ITEMID, COLOR and CODENAME elements per ITEM.
+
+    Yields:
+        tuple: (element ID, design ID, color name) for every part.
+    """
+    context = ET.iterparse(path, events=('start', 'end'))
+    _, root = next(context)
+    for event, element in context:
+        if event != 'end' or element.tag != 'ITEM':
+            continue
+        if element.findtext('ITEMTYPE', 'P') == 'P':
+            yield element.findtext('CODENAME', '').strip(), element.findtext('ITEMID', '').strip(), element.findtext('COLOR', '')
+        root.clear()
+
+
+def iter_catalog_entries(path):
+    """
+    Stream the BrickLink entries of a catalog file, skipping rows with an unknown color or no element ID.
+
+    Args:
+        path (str): The path to the Codes.txt or XML catalog file.
+
+    Yields:
+        tuple: (element ID, design ID, color code) for every usable row.
+    """
+    rows = iter_codes_xml(path) if path.lower().endswith('.xml') else iter_codes_txt(path)
+    skipped = 0
+    for element_id, design_id, color in rows:
+        color_code = get_color_code(color)
+        if not element_id or not design_id or color_code is None:
+            skipped += 1
+            continue
+        yield element_id, design_id, color_code
+    if skipped:
+        logging.info(f"Skipped {skipped} catalog rows with an unknown color or no element ID")
+
+
+def hash_file(path):
+    """
+    Hash the contents of a file.
+
+    Args:
+        path (str): The path to the file.
+
+    Returns:
+        str: The SHA-256 hash of the file, in hex.
+    """
+    sha256 = hashlib.sha256()
+    with open(path, 'rb') as file:
+        for chunk in iter(lambda: file.read(HASH_CHUNK_SIZE), b''):
+            sha256.update(chunk)
+    return sha256.hexdigest()
+
+
+def import_catalog(database, path, force=False):
+    """
+    Import a BrickLink catalog file into the BrickLink table, unless it is unchanged since its last import.
+
+    Args:
+        database (DatabaseManager): The database to import into.
+        path (str): The path to the Codes.txt or XML catalog file.
+        force (bool): Whether to import the file even if it is unchanged.
+
+    Returns:
+        int: The number of entries imported, or None if the file was unchanged.
+    """
+    path = os.path.abspath(path)
+    stat = os.stat(path)
+    previous = database.get_catalog_import(path)
+    # The imported entries go stale with their import, so an unchanged file is imported again once they have
+    if previous is not None and previous[4] < time.time() - database.max_ages['bricklink_entries']:
+        logging.info(f"Catalog file {path} was last imported too long ago, importing it again")
+        previous = None
+    if not force and previous is not None and previous[0] == stat.st_mtime and previous[1] == stat.st_size:
+        logging.info(f"Catalog file {path} is unchanged since its last import, skipping it")
+        return None
+    sha256 = hash_file(path)
+    if not force and previous is not None and previous[2] == sha256:
+        database.record_catalog_import(path, stat.st_mtime, stat.st_size, sha256, previous[3])
+        logging.info(f"Catalog file {path} was touched but its contents are unchanged, skipping it")
+        return None
+    return database.import_bricklink_entries(iter_catalog_entries(path), path, stat.st_mtime, stat.st_size, sha256)
+
+
+def main():
+    """
+    Parse command-line arguments and import the BrickLink catalog files.
+    """
+    parser = argparse.ArgumentParser(description='Import BrickLink catalog codes (Codes.txt or XML) into the database.')
+    parser.add_argument('catalog_files', nargs='+', help='Paths to the Codes.txt or XML catalog files')
+    parser.add_argument('-db', '--database_file', default='part_info.db', help='Path to the SQLite database file')
+    parser.add_argument('-f', '--force', action='store_true', help='Import the files even if they are unchanged since their last import')
+    args = parser.parse_args()
+
+    logging.basicConfig(stream=sys.stdout, level=logging.INFO, format='%(asctime)s [%(levelname)s] %(message)s')
+    logger = logging.getLogger()
+
+    database = DatabaseManager(args.database_file, logger)
+    for catalog_file in args.catalog_files:
+        import_catalog(database, catalog_file, args.force)
+    database.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,213 @@
+"""
+Journal.
+
+This module provides the RunJournal class, which records the progress of a
+convert.py, save_me_money.py or batch.py run in the SQLite database: a
+fingerprint of the input files, the step the run has reached, which keys each
+request step still has pending, has done or has failed, and the choices the
+user made. A run that died halfway, or was stopped with Ctrl-C, can then be
+continued with --resume, requesting only the keys it had not finished and
+asking none of the questions it already asked.
+"""
+
+import json
+import hashlib
+import logging
+from import_catalog import hash_file
+
+
+def fingerprint_input(pipeline, input_file):
+    """
+    Fingerprint the input of a run, so only a run on the same input is resumed.
+
+    Args:
+        pipeline (str): The pipeline, 'convert', 'save_me_money' or 'batch'.
+        input_file (Union[str, list of str]): The path to the input file, or the paths to the input files of a batch.
+
+    Returns:
+        str: The SHA-256 hash of the pipeline and the contents of the input files, in hex. The order of the files does not matter.
+    """
+    input_files = [input_file] if isinstance(input_file, str) else input_file
+    hashes = '\n'.join(sorted(hash_file(path) for path in input_files))
+    return hashlib.sha256(f"{pipeline}\n{hashes}".encode('utf-8')).hexdigest()
+
+
+def encode_key(key):
+    """
+    Encode a key, such as a design ID or a (store ID, lot ID) pair, for the journal.
+
+    Args:
+        key (Union[str, tuple]): The key.
+
+    Returns:
+        str: The encoded key.
+    """
+    return json.dumps(key)
+
+
+def decode_key(text):
+    """
+    Decode a key encoded by encode_key.
+
+    Args:
+        text (str): The encoded key.
+
+    Returns:
+        Union[str, tuple]: The key, with pairs as tuples.
+    """
+    key = json.loads(text)
+    return tuple(key) if isinstance(key, list) else key
+
+
+class RunJournal:
+    """
+    Records the progress of a run, and continues an unfinished run on the same input if asked to.
+
+    Attributes:
+        database (DatabaseManager): The database holding the journal.
+        pipeline (str): The pipeline, 'convert', 'save_me_money' or 'batch'.
+        run_id (int): The ID of the run in the journal.
+        step (str): The step the run has reached, or None before the first one.
+        resumed (bool): Whether the run continues an unfinished one.
+        choices (dict): Maps the encoded keys of the choices made so far to the choices.
+        done_keys (dict): Maps the steps whose keys are added as they are found to the encoded keys a resumed run had done.
+    """
+
+    def __init__(self, database, pipeline, input_file, resume=False):
+        """
+        Initialize the RunJournal, starting a new run or resuming the last unfinished one.
+
+        Args:
+            database (DatabaseManager): The database holding the journal.
+            pipeline (str): The pipeline, 'convert', 'save_me_money' or 'batch'.
+            input_file (Union[str, list of str]): The path to the input file, or the paths to the input files of a batch.
+            resume (bool): Whether to continue the last unfinished run on the same input, if there is one.
+        """
+        self.database = database
+        self.pipeline = pipeline
+        self.done_keys = {}
+        fingerprint = fingerprint_input(pipeline, input_file)
+        if not isinstance(input_file, str):
+            input_file = ', '.join(input_file)
+        run = database.get_unfinished_run(pipeline, fingerprint) if resume else None
+        self.resumed = run is not None
+        if self.resumed:
+            self.run_id, self.step = run
+            self.choices = database.get_run_choices(self.run_id)
+            logging.info(f"Resuming run {self.run_id} of {input_file}, which stopped in step {self.step}")
+        else:
+            if resume:
+                logging.warning(f"No unfinished run of {input_file} to resume, starting a new one")
+            self.run_id = database.start_run(pipeline, input_file, fingerprint)
+            self.step = None
+            self.choices = {}
+
+    def begin_step(self, step):
+        """
+        Record that the run has reached a step.
+
+        Args:
+            step (str): The step.
+        """
+        self.step = step
+        self.database.set_run_step(self.run_id, step)
+
+    def get_keys(self, step, find_keys):
+        """
+        Get the keys a request step has to look up.
+
+        The keys are found afresh and recorded as pending. A resumed run also
+        gets back the keys it recorded for the step and had not done yet, and
+        leaves out the ones it had done, even if they have gone stale since.
+
+        Args:
+            step (str): The step.
+            find_keys (callable): Finds the keys of the step, with no arguments.
+
+        Returns:
+            set: The keys to look up.
+        """
+        self.begin_step(step)
+        statuses = self.database.get_run_keys(self.run_id, step) if self.resumed else {}
+        new_keys = {key for key in find_keys() if encode_key(key) not in statuses}
+        self.database.add_run_keys(self.run_id, step, (encode_key(key) for key in new_keys))
+        if not statuses:
+            return new_keys
+        keys = new_keys | {decode_key(key) for key, status in statuses.items() if status != 'done'}
+        done = sum(status == 'done' for status in statuses.values())
+        logging.info(f"Step {step} resumed - {done} of {len(statuses)} keys already done, {len(keys)} left to look up")
+        return keys
+
+    def add_keys(self, step, keys):
+        """
+        Record keys a request step has found as pending, for a step that finds its keys a few at a time.
+
+        Unlike get_keys, this can be called again and again for the same step. A
+        resumed run leaves out the keys it had done, as get_keys does; the keys it
+        had not done are found again along with the others.
+
+        Args:
+            step (str): The step.
+            keys (iterable): The keys found.
+
+        Returns:
+            set: The keys to look up.
+        """
+        if step not in self.done_keys:
+            statuses = self.database.get_run_keys(self.run_id, step) if self.resumed else {}
+            self.done_keys[step] = {key for key, status in statuses.items() if status == 'done'}
+        keys = {key for key in keys if encode_key(key) not in self.done_keys[step]}
+        self.database.add_run_keys(self.run_id, step, (encode_key(key) for key in keys))
+        return keys
+
+    def mark_done(self, step, key):
+        """
+        Mark a key of a request step as done, along with the rows inserted for it.
+
+        Args:
+            step (str): The step.
+            key (Union[str, tuple]): The key.
+        """
+        self.database.mark_run_key(self.run_id, step, encode_key(key), 'done')
+
+    def mark_failed(self, step, key):
+        """
+        Mark a key of a request step as failed, so a resumed run retries it.
+
+        Args:
+            step (str): The step.
+            key (Union[str, tuple]): The key.
+        """
+        self.database.mark_run_key(self.run_id, step, encode_key(key), 'failed')
+
+    def get_choice(self, key):
+        """
+        Get the choice the user made about a key in this run, before it was resumed.
+
+        Args:
+            key (Union[str, tuple]): The key.
+
+        Returns:
+            str: The choice, or None if none was made.
+        """
+        return self.choices.get(encode_key(key))
+
+    def record_choice(self, key, choice):
+        """
+        Record a choice the user made about a key.
+
+        Args:
+            key (Union[str, tuple]): The key.
+            choice (str): The choice.
+        """
+        self.choices[encode_key(key)] = choice
+        self.database.record_run_choice(self.run_id, encode_key(key), choice)
+
+    def stop(self):
+        """Write the rows and marks buffered so far, after the run failed or was interrupted."""
+        self.database.commit_changes()
+        logging.error(f"Run {self.run_id} stopped in step {self.step}, run it again with --resume to continue from there")
+
+    def finish(self):
+        """Mark the run as finished."""
+        self.database.finish_run(self.run_id)
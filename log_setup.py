@@ -0,0 +1,167 @@
+"""
+Log Setup.
+
+This module provides the logging setup shared by the scripts. Records are
+handed to a queue by the thread that logs them, and a listener thread writes
+them to the log file and stdout, so slow terminal or disk I/O never holds up
+the fetch loop. Large collections such as partslists and ID sets are logged
+as summaries, their length and first few items, and are only dumped in full
+at the TRACE level, below DEBUG.
+
+Log with %-style arguments instead of f-strings wherever a call runs once per
+request, row or lot, so that nothing is formatted unless the level is enabled.
+"""
+
+import os
+import sys
+import queue
+import atexit
+import logging
+from logging.handlers import QueueHandler, QueueListener
+
+# Level of the full dumps of partslists, ID sets and buckets, below DEBUG
+TRACE = 5
+logging.addLevelName(TRACE, 'TRACE')
+
+# Number of items shown in the summary of a collection
+DEFAULT_SAMPLE_SIZE = 5
+
+LOG_FORMAT = '%(asctime)s [%(levelname)s] %(message)s'
+
+_listener = None
+_queue_handler = None
+
+
+class Summary:
+    """
+    A collection to log as its length and first few items, formatted only if the record is emitted.
+
+    Attributes:
+        collection (collection): The collection.
+        sample_size (int): The number of items shown.
+    """
+
+    __slots__ = ('collection', 'sample_size')
+
+    def __init__(self, collection, sample_size=DEFAULT_SAMPLE_SIZE):
+        """
+        Initialize the Summary.
+
+        Args:
+            collection (collection): The collection.
+            sample_size (int): The number of items shown.
+        """
+        self.collection = collection
+        self.sample_size = sample_size
+
+    def __str__(self):
+        """Format the length and the first few items of the collection."""
+        sample = []
+        for item in self.collection:
+            if len(sample) == self.sample_size:
+                break
+            sample.append(repr(item))
+        more = ', ...' if len(self.collection) > len(sample) else ''
+        return f"(length {len(self.collection)}): [{', '.join(sample)}{more}]"
+
+
+def summarize(collection, sample_size=DEFAULT_SAMPLE_SIZE):
+    """
+    Wrap a collection to be logged as a summary.
+
+    Args:
+        collection (collection): The collection.
+        sample_size (int): The number of items shown.
+
+    Returns:
+        Summary: The summary, to pass as a %-style logging argument.
+    """
+    return Summary(collection, sample_size)
+
+
+def get_level(debug=False, trace=False):
+    """
+    Get the log level selected by the command-line flags.
+
+    Args:
+        debug (bool): Whether debug logging was requested.
+        trace (bool): Whether the full dumps of collections were requested, which implies debug.
+
+    Returns:
+        int: The log level.
+    """
+    if trace:
+        return TRACE
+    return logging.DEBUG if debug else logging.INFO
+
+
+def setup_logger(log_file, level=logging.INFO):
+    """
+    Configure the root logger to write to a log file and stdout from a listener thread.
+
+    Calling it again replaces the previous setup, so one process can run several jobs.
+
+    Args:
+        log_file (str): The path to the log file. Its directory is created if needed.
+        level (int): The log level.
+
+    Returns:
+        logging.Logger: Configured logger instance.
+    """
+    global _listener, _queue_handler
+    previous_listener, previous_queue_handler = _listener, _queue_handler
+    log_dir = os.path.dirname(log_file)
+    if log_dir and not os.path.exists(log_dir):
+        os.makedirs(log_dir)
+
+    # File handler
+    file_handler = logging.FileHandler(log_file)
+    file_handler.setLevel(level)
+    file_handler.setFormatter(logging.Formatter(LOG_FORMAT))
+
+    # Stream handler (stdout)
+    stream_handler = logging.StreamHandler(sys.stdout)
+    stream_handler.setLevel(level)
+    stream_handler.setFormatter(logging.Formatter(LOG_FORMAT))
+
+    # Only the queue handler runs on the logging thread, the listener does the writing
+    log_queue = queue.SimpleQueue()
+    _queue_handler = QueueHandler(log_queue)
+    _listener = QueueListener(log_queue, file_handler, stream_handler, respect_handler_level=True)
+    _listener.start()
+
+    # The new handler goes in before the previous one comes out, so records logged by other threads meanwhile are kept
+    logger = logging.getLogger()
+    logger.setLevel(level)
+    logger.addHandler(_queue_handler)
+    if previous_listener is not None:
+        _stop_listener(previous_listener, previous_queue_handler)
+    return logger
+
+
+def flush_logging():
+    """Wait until every queued record has been written, for example before prompting the user."""
+    if _listener is not None:
+        _listener.stop()
+        _listener.start()
+
+
+def stop_logging():
+    """Write every queued record, stop the listener thread and close the log file."""
+    global _listener, _queue_handler
+    if _listener is None:
+        return
+    _stop_listener(_listener, _queue_handler)
+    _listener = None
+    _queue_handler = None
+
+
+def _stop_listener(listener, queue_handler):
+    """Detach a queue handler from the root logger, then write its queued records and close the listener's handlers."""
+    logging.getLogger().removeHandler(queue_handler)
+    listener.stop()
+    for handler in listener.handlers:
+        handler.close()
+
+
+atexit.register(stop_logging)
@@ -0,0 +1,126 @@
+"""
+Lookups.
+
+This module provides the request steps shared by convert.py, save_me_money.py
+and batch.py. Each one takes the lookups of a fetch engine as they complete,
+inserts their results into the database on the calling thread, and marks
+their keys as done or failed in the run journal.
+"""
+
+import logging
+import metrics
+from request_bricklink_cart import get_part_and_price_for_lot_async
+from request_lego_store import parse_store_result
+
+
+async def get_part_and_price_for_cart_lot_async(cart_lot, engine):
+    """
+    Get the part and price for a (store ID, lot ID) pair using a fetch engine.
+
+    Args:
+        cart_lot (tuple): The store ID and lot ID.
+        engine (request_session.FetchEngine): The engine to make the request with.
+
+    Returns:
+        tuple: The part and price data.
+    """
+    store_id, lot_id = cart_lot
+    return await get_part_and_price_for_lot_async(store_id, lot_id, engine)
+
+
+def insert_store_lots(database, journal, step, completed):
+    """
+    Insert BrickLink store lots as their lookups complete.
+
+    Args:
+        database (DatabaseManager): The database to store the results in.
+        journal (journal.RunJournal): The journal recording which store lots are done.
+        step (str): The step, for the journal, the metrics and the log.
+        completed (iterable): (store lot, task) pairs of get_part_and_price_for_cart_lot_async lookups.
+
+    Returns:
+        int: The number of database insertions.
+    """
+    database_insertions = 0
+    for (store_id, lot_id), task in completed:
+        try:
+            design_id, color_code, price, type = task.result()
+            database.insert_bricklink_cart_entry(store_id, lot_id, price, design_id, color_code, type)
+            database_insertions += 1
+            journal.mark_done(step, (store_id, lot_id))
+            logging.debug("Step %s - Inserted store ID %s lot ID %s", step, store_id, lot_id)
+        except Exception as exc:
+            logging.error(f"Step {step} - Store ID {store_id}, lot ID {lot_id} generated an exception: {exc}")
+            journal.mark_failed(step, (store_id, lot_id))
+    database.commit_changes()
+    metrics.increment('database_insertions_total', database_insertions, step=step)
+    return database_insertions
+
+
+def insert_designs(database, journal, step, completed):
+    """
+    Insert the element IDs of BrickLink designs as their catalog pages are parsed.
+
+    Args:
+        database (DatabaseManager): The database to store the results in.
+        journal (journal.RunJournal): The journal recording which designs are done.
+        step (str): The step, for the journal, the metrics and the log.
+        completed (iterable): (design ID, future) pairs of a map_pipeline run of parse_color_dict_from_page.
+
+    Returns:
+        int: The number of database insertions.
+    """
+    database_insertions = 0
+    for design_id, task in completed:
+        try:
+            data = task.result()
+            for color_code, element_id_list in data.items():
+                for element_id in element_id_list:
+                    database.insert_bricklink_entry(element_id, design_id, color_code)
+                    database_insertions += 1
+            journal.mark_done(step, design_id)
+            logging.debug("Step %s - Inserted design ID %s", step, design_id)
+        except Exception as exc:
+            logging.error(f"Step {step} - Design ID {design_id} generated an exception: {exc}")
+            journal.mark_failed(step, design_id)
+    database.commit_changes()
+    metrics.increment('database_insertions_total', database_insertions, step=step)
+    return database_insertions
+
+
+def insert_element_ids(database, journal, step, completed):
+    """
+    Insert LEGO Pick-a-Brick results as their batches complete.
+
+    Args:
+        database (DatabaseManager): The database to store the results in.
+        journal (journal.RunJournal): The journal recording which element IDs are done.
+        step (str): The step, for the journal, the metrics and the log.
+        completed (iterable): (batch, task) pairs of get_lego_store_results_for_element_ids_async lookups.
+
+    Returns:
+        int: The number of database insertions.
+    """
+    database_insertions = 0
+    for batch, task in completed:
+        try:
+            results = task.result()
+        except Exception as exc:
+            logging.error(f"Step {step} - Batch of {len(batch)} element IDs starting at {batch[0]} generated an exception: {exc}")
+            for element_id in batch:
+                journal.mark_failed(step, element_id)
+            continue
+        for element_id, data in results.items():
+            try:
+                database.insert_lego_store_entry(element_id, **parse_store_result(data))
+                database_insertions += 1
+                journal.mark_done(step, element_id)
+            except Exception as exc:
+                logging.error(f"Step {step} - Element ID {element_id} generated an exception: {exc}")
+                journal.mark_failed(step, element_id)
+        for element_id in set(batch).difference(results):
+            journal.mark_failed(step, element_id)
+        logging.debug("Step %s - Inserted batch of %d element IDs starting at %s", step, len(batch), batch[0])
+    database.commit_changes()
+    metrics.increment('database_insertions_total', database_insertions, step=step)
+    return database_insertions
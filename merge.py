@@ -1,52 +1,28 @@
 import os
-import sys
 import logging
 import argparse
-from parse import parse_xml
+from parse import iter_xml
 from export import export_xml
-
-def setup_logger(log_file):
-    """
-    Configure and return a logger instance.
-
-    Args:
-        log_file (str): The path to the log file.
-
-    Returns:
-        logging.Logger: Configured logger instance.
-    """
-    logger = logging.getLogger()
-    logger.setLevel(logging.DEBUG)
-    # File handler
-    file_handler = logging.FileHandler(log_file)
-    file_handler.setLevel(logging.DEBUG)
-    file_handler.setFormatter(logging.Formatter('%(asctime)s [%(levelname)s] %(message)s'))
-    # Stream handler (stdout)
-    stream_handler = logging.StreamHandler(sys.stdout)
-    stream_handler.setLevel(logging.DEBUG)
-    stream_handler.setFormatter(logging.Formatter('%(asctime)s [%(levelname)s] %(message)s'))
-    # Add handlers to the logger
-    logger.addHandler(file_handler)
-    logger.addHandler(stream_handler)
-    return logger
+from log_setup import setup_logger
 
 def merge_parts(partslist_2d, logger):
     """
     Merge parts by summing quantities for duplicate design_id and color_id combinations.
 
     Args:
-        parts_list (list of list of dict): List of parts lists to be merged.
+        partslist_2d (iterable of iterable of Part): The parts lists to be merged, which may be generators.
+        logger (logging.Logger): The logger instance.
 
     Returns:
-        list of dict: Merged parts list.
+        list of Part: Merged parts list.
     """
     merged_parts = {}
     for partslist_1d in partslist_2d:
         for part in partslist_1d:
-            key = (part['design_id'], part['color_id'])
+            key = part.key
             if key in merged_parts:
-                logger.info(f"Combining {part['quantity']:3} with {merged_parts[key]['quantity']:3} for {key}")
-                merged_parts[key]['quantity'] = str(int(merged_parts[key]['quantity']) + int(part['quantity']))
+                logger.info("Combining %3d with %3d for %s", part.quantity, merged_parts[key].quantity, key)
+                merged_parts[key].quantity += part.quantity
             else:
                 merged_parts[key] = part.copy()
     return list(merged_parts.values())
@@ -74,11 +50,8 @@ def main():
 
     logger = setup_logger(args.log_file)
 
-    all_parts = []
-    for input_file in args.input_xml_files:
-        parts = parse_xml(input_file)
-        all_parts.append(parts)
-        logger.info(f"Parsed {len(parts)} entries from {input_file}")
+    # Each input file is streamed, so only the merged parts are ever held in memory
+    all_parts = (iter_xml(input_file) for input_file in args.input_xml_files)
 
     merged_parts = merge_parts(all_parts, logger)
     logger.info(f"Merged parts list contains {len(merged_parts)} unique entries")
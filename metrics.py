@@ -0,0 +1,376 @@
+"""
+Metrics.
+
+This module provides the counters and timers that convert.py and
+save_me_money.py record while they run: how long each step took, every web
+request by host and status, retries and throttling, response cache hits and
+misses, database queries and page parsing. At the end of a run they are
+written out as a JSON summary, and optionally in the Prometheus text format,
+so a slow run can be broken down into BrickLink latency, LEGO latency, SQLite
+and parsing without reading the logs.
+
+The metrics live in a module-level registry shared by every module, and
+recording them is safe from any thread.
+"""
+
+import json
+import time
+import functools
+import threading
+
+# Prefix of every metric name in the Prometheus text format
+PROMETHEUS_PREFIX = 'bricklink_to_csv_'
+
+
+class TimerStats:
+    """
+    The summary of every duration recorded under a timer and its labels.
+
+    Attributes:
+        count (int): The number of durations recorded.
+        total (float): The sum of the durations, in seconds.
+        min (float): The shortest duration, in seconds.
+        max (float): The longest duration, in seconds.
+    """
+
+    __slots__ = ('count', 'total', 'min', 'max')
+
+    def __init__(self):
+        """Initialize the TimerStats."""
+        self.count = 0
+        self.total = 0.0
+        self.min = float('inf')
+        self.max = 0.0
+
+    def add(self, seconds):
+        """
+        Record a duration.
+
+        Args:
+            seconds (float): The duration, in seconds.
+        """
+        self.count += 1
+        self.total += seconds
+        self.min = min(self.min, seconds)
+        self.max = max(self.max, seconds)
+
+    def to_dict(self):
+        """
+        Convert the summary into a JSON object.
+
+        Returns:
+            dict: The count, total, mean, min and max of the durations.
+        """
+        return {'count': self.count, 'total_seconds': self.total, 'mean_seconds': self.total / self.count if self.count else 0.0,
+                'min_seconds': self.min if self.count else 0.0, 'max_seconds': self.max}
+
+
+class Stopwatch:
+    """
+    Times a block of code and records its duration under a timer when stopped.
+
+    Can be used as a context manager, or started and stopped by hand around a step.
+
+    Attributes:
+        registry (Metrics): The registry to record the duration in.
+        name (str): The name of the timer.
+        labels (dict): The labels of the timer.
+        started_at (float): When the stopwatch was started, from time.perf_counter.
+        elapsed (float): The duration, in seconds, once stopped.
+    """
+
+    __slots__ = ('registry', 'name', 'labels', 'started_at', 'elapsed')
+
+    def __init__(self, registry, name, labels):
+        """
+        Initialize and start the Stopwatch.
+
+        Args:
+            registry (Metrics): The registry to record the duration in.
+            name (str): The name of the timer.
+            labels (dict): The labels of the timer.
+        """
+        self.registry = registry
+        self.name = name
+        self.labels = labels
+        self.started_at = time.perf_counter()
+        self.elapsed = None
+
+    def stop(self):
+        """
+        Stop the stopwatch and record its duration, unless it was already stopped.
+
+        Returns:
+            float: The duration, in seconds.
+        """
+        if self.elapsed is None:
+            self.elapsed = time.perf_counter() - self.started_at
+            self.registry.observe(self.name, self.elapsed, **self.labels)
+        return self.elapsed
+
+    def __enter__(self):
+        """Return the stopwatch for use as a context manager."""
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        """Stop the stopwatch when leaving the context."""
+        self.stop()
+
+
+class Metrics:
+    """
+    A registry of counters and timers, each identified by a name and a set of labels.
+
+    Attributes:
+        counters (dict): Maps (name, labels) pairs to their values.
+        timers (dict): Maps (name, labels) pairs to their TimerStats.
+        started_at (float): When the registry was created or last reset, as a UNIX timestamp.
+    """
+
+    def __init__(self):
+        """Initialize the Metrics."""
+        self._lock = threading.Lock()
+        self.reset()
+
+    @staticmethod
+    def _key(name, labels):
+        """Build the key of a metric, with its labels in a stable order."""
+        return name, tuple(sorted((label, str(value)) for label, value in labels.items()))
+
+    def reset(self):
+        """Forget every counter and timer, to start a new run."""
+        with self._lock:
+            self.counters = {}
+            self.timers = {}
+            self.started_at = time.time()
+
+    def increment(self, name, value=1, **labels):
+        """
+        Add to a counter.
+
+        Args:
+            name (str): The name of the counter.
+            value (int): The amount to add.
+            **labels: The labels of the counter, such as host or source.
+        """
+        key = self._key(name, labels)
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name, seconds, **labels):
+        """
+        Record a duration under a timer.
+
+        Args:
+            name (str): The name of the timer.
+            seconds (float): The duration, in seconds.
+            **labels: The labels of the timer, such as host or step.
+        """
+        key = self._key(name, labels)
+        with self._lock:
+            stats = self.timers.get(key)
+            if stats is None:
+                stats = self.timers[key] = TimerStats()
+            stats.add(seconds)
+
+    def timer(self, name, **labels):
+        """
+        Start timing a block of code.
+
+        Args:
+            name (str): The name of the timer.
+            **labels: The labels of the timer.
+
+        Returns:
+            Stopwatch: The running stopwatch, to stop or to use as a context manager.
+        """
+        return Stopwatch(self, name, labels)
+
+    def total(self, name):
+        """
+        Get the total of a counter or timer across all of its labels.
+
+        Args:
+            name (str): The name of the counter or timer.
+
+        Returns:
+            float: The sum of the counter values, or of the timer durations in seconds.
+        """
+        with self._lock:
+            return sum(value for (key_name, _), value in self.counters.items() if key_name == name) + \
+                   sum(stats.total for (key_name, _), stats in self.timers.items() if key_name == name)
+
+    def to_dict(self, **info):
+        """
+        Summarize every counter and timer as a JSON object.
+
+        Args:
+            **info: Details of the run to include, such as the pipeline and input file.
+
+        Returns:
+            dict: The run details, wall time, counters and timers, each metric a list of its label sets.
+        """
+        with self._lock:
+            counters = {}
+            for (name, labels), value in sorted(self.counters.items()):
+                counters.setdefault(name, []).append({'labels': dict(labels), 'value': value})
+            timers = {}
+            for (name, labels), stats in sorted(self.timers.items()):
+                timers.setdefault(name, []).append(dict(stats.to_dict(), labels=dict(labels)))
+        return {'run': dict(info, started_at=self.started_at, wall_seconds=time.time() - self.started_at),
+                'counters': counters, 'timers': timers}
+
+    def to_prometheus(self):
+        """
+        Render every counter and timer in the Prometheus text exposition format.
+
+        Timers become summaries, with a _count and _sum sample per label set.
+
+        Returns:
+            str: The metrics, one sample per line.
+        """
+        lines = []
+        with self._lock:
+            counters = sorted(self.counters.items())
+            timers = sorted((key, stats.count, stats.total) for key, stats in self.timers.items())
+        previous = None
+        for (name, labels), value in counters:
+            if name != previous:
+                lines.append(f"# TYPE {PROMETHEUS_PREFIX}{name} counter")
+                previous = name
+            lines.append(f"{PROMETHEUS_PREFIX}{name}{format_labels(labels)} {value}")
+        for (name, labels), count, total in timers:
+            if name != previous:
+                lines.append(f"# TYPE {PROMETHEUS_PREFIX}{name} summary")
+                previous = name
+            lines.append(f"{PROMETHEUS_PREFIX}{name}_count{format_labels(labels)} {count}")
+            lines.append(f"{PROMETHEUS_PREFIX}{name}_sum{format_labels(labels)} {total:.6f}")
+        return '\n'.join(lines) + '\n'
+
+    def write_json(self, path, **info):
+        """
+        Write the JSON summary of the metrics to a file.
+
+        Args:
+            path (str): The path of the JSON file.
+            **info: Details of the run to include, such as the pipeline and input file.
+        """
+        with open(path, 'w') as file:
+            json.dump(self.to_dict(**info), file, indent=4)
+
+    def write_prometheus(self, path):
+        """
+        Write the metrics to a file in the Prometheus text exposition format.
+
+        Args:
+            path (str): The path of the file, for example one read by the node exporter's textfile collector.
+        """
+        with open(path, 'w') as file:
+            file.write(self.to_prometheus())
+
+
+def format_labels(labels):
+    """
+    Format the labels of a sample in the Prometheus text format.
+
+    Args:
+        labels (tuple): The (label, value) pairs.
+
+    Returns:
+        str: The labels in braces, or an empty string if there are none.
+    """
+    if not labels:
+        return ''
+    escaped = (value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, value in labels)
+    return '{' + ','.join(f'{label}="{value}"' for (label, _), value in zip(labels, escaped)) + '}'
+
+
+def format_duration(seconds):
+    """
+    Format a duration for the step log lines.
+
+    Args:
+        seconds (float): The duration, in seconds.
+
+    Returns:
+        str: The duration in whole minutes and seconds.
+    """
+    minutes, seconds = divmod(int(seconds), 60)
+    return f"{minutes} minutes and {seconds} seconds"
+
+
+# The registry shared by every module
+registry = Metrics()
+_timed_depth = threading.local()
+
+
+def reset():
+    """Forget every counter and timer in the shared registry, to start a new run."""
+    registry.reset()
+
+
+def increment(name, value=1, **labels):
+    """
+    Add to a counter in the shared registry.
+
+    Args:
+        name (str): The name of the counter.
+        value (int): The amount to add.
+        **labels: The labels of the counter.
+    """
+    registry.increment(name, value, **labels)
+
+
+def observe(name, seconds, **labels):
+    """
+    Record a duration under a timer in the shared registry.
+
+    Args:
+        name (str): The name of the timer.
+        seconds (float): The duration, in seconds.
+        **labels: The labels of the timer.
+    """
+    registry.observe(name, seconds, **labels)
+
+
+def timer(name, **labels):
+    """
+    Start timing a block of code in the shared registry.
+
+    Args:
+        name (str): The name of the timer.
+        **labels: The labels of the timer.
+
+    Returns:
+        Stopwatch: The running stopwatch, to stop or to use as a context manager.
+    """
+    return registry.timer(name, **labels)
+
+
+def timed(name):
+    """
+    Time every call of a function under a timer, labelled with the function's name as its operation.
+
+    Calls made from inside another timed function are left to the outer one,
+    so the same time is never counted twice.
+
+    Args:
+        name (str): The name of the timer.
+
+    Returns:
+        callable: The decorator.
+    """
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            depth = getattr(_timed_depth, 'depth', 0)
+            if depth:
+                return function(*args, **kwargs)
+            _timed_depth.depth = 1
+            try:
+                with registry.timer(name, operation=function.__name__):
+                    return function(*args, **kwargs)
+            finally:
+                _timed_depth.depth = 0
+        return wrapper
+    return decorator
@@ -6,6 +6,7 @@ This module provides functions to parse XML files and extract partslist data.
 
 import logging
 import xml.etree.ElementTree as ET
+from records import Part, CartLot
 
 
 def parse_xml(path):
@@ -16,47 +17,71 @@ def parse_xml(path):
         path (str): The file path to the XML file.
 
     Returns:
-        list of dict: The partslist data extracted from the XML file.
+        list of Part: The partslist data extracted from the XML file.
+    """
+    return list(iter_xml(path))
+
+
+def iter_xml(path):
+    """
+    Stream partslist data from an XML file, one part at a time.
+
+    The file is read with iterparse and every ITEM element is cleared once its
+    part has been yielded, so memory use stays flat however large the file is.
+    The statistics are computed as the parts go by and logged at the end.
+
+    Args:
+        path (str): The file path to the XML file.
+
+    Yields:
+        Part: The partslist data of each item in the XML file.
     """
-    tree = ET.parse(path)
-    root = tree.getroot()
-    parts = []
     unique_designs = set()
     unique_elements = set()
     non_parts = set()
     total_quantity = 0
-    for item in root:
+    count = 0
+    root = None
+    for event, element in ET.iterparse(path, events=('start', 'end')):
+        if root is None:
+            root = element
+            continue
+        if event != 'end' or element.tag != 'ITEM':
+            continue
         part = {}
-        for data in item:
+        for data in element:
             if data.tag == 'ITEMTYPE':
                 part['type'] = data.text
             elif data.tag == 'ITEMID':
                 part['design_id'] = data.text
-                if part['type'] == 'P':
-                    unique_designs.add(data.text)
-                else:
-                    logging.warning(f"Found non-part design ID {data.text} in {path}")
-                    non_parts.add(data.text)
             elif data.tag == 'COLOR':
                 part['color_id'] = data.text
             elif data.tag == 'MAXPRICE':
                 part['price'] = data.text
             elif data.tag == 'MINQTY':
                 part['quantity'] = data.text
-                if part['type'] == 'P':
-                    total_quantity += int(data.text)
+        root.clear()  # Drop the finished item (and any before it) from the tree
         design_id = part.get('design_id')
         color_id = part.get('color_id')
+        quantity = int(part.get('quantity', 0))
+        if design_id:
+            if part.get('type') == 'P':
+                unique_designs.add(design_id)
+                total_quantity += quantity
+            else:
+                logging.warning(f"Found non-part design ID {design_id} in {path}")
+                non_parts.add(design_id)
         if design_id and color_id:
-            unique_elements.add(f"{design_id}/{color_id}")
-            parts.append(part)
+            unique_elements.add((design_id, color_id))
+            count += 1
+            yield Part(part.get('type'), design_id, color_id, quantity, part.get('price'))
         else:
             logging.warning(f"Missing color_id for design_id {design_id} in {path}")
+    logging.info(f"Parsed {count} entries from {path}")
     logging.info(f"Found {len(unique_designs)} unique designs, "
                  f"{len(unique_elements)} unique elements, "
                  f"with {total_quantity} total quantity in {path}")
     logging.info(f"Found {len(non_parts)} non-part design IDs in {path}")
-    return parts
 
 
 def parse_cart(path):
@@ -67,7 +92,7 @@ def parse_cart(path):
         path (str): The file path to the BrickLink .cart file
 
     Returns:
-        list of dict: The cart lot data extracted from the .cart file
+        list of CartLot: The cart lot data extracted from the .cart file
     """
     with open(path, 'r') as file:
         cart_string = file.read().strip()
@@ -78,11 +103,5 @@ def parse_cart(path):
         for record in records:
             parts = record.split(':')
             if len(parts) >= 4:
-                item = {
-                    'prefix': parts[0],
-                    'store_id': parts[1],
-                    'lot_id': parts[2],
-                    'quantity': parts[3]
-                }
-                cart_items.append(item)
+                cart_items.append(CartLot(parts[0], parts[1], parts[2], parts[3]))
         return cart_items
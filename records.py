@@ -0,0 +1,287 @@
+"""
+Records.
+
+This module provides the compact record types that parts, cart lots and
+Pick-a-Brick order lines travel through the scripts as. They use __slots__
+instead of a per-instance dict, keep quantities as integers, and intern the
+design, color and element IDs, which repeat heavily across large inventories.
+"""
+
+import sys
+
+
+def intern_id(value):
+    """
+    Intern an ID, so that equal IDs share a single string object.
+
+    Args:
+        value (Union[int, str]): The ID.
+
+    Returns:
+        str: The interned ID, or None if the value is None.
+    """
+    if value is None:
+        return None
+    return sys.intern(str(value))
+
+
+class Part:
+    """
+    A lot of a BrickLink XML partslist.
+
+    Attributes:
+        type (str): The BrickLink item type, 'P' for parts.
+        design_id (str): The design ID.
+        color_id (str): The BrickLink color ID.
+        quantity (int): The quantity wanted.
+        price (str): The maximum price, as written in the XML, if any.
+    """
+
+    __slots__ = ('type', 'design_id', 'color_id', 'quantity', 'price')
+
+    def __init__(self, type, design_id, color_id, quantity, price=None):
+        """
+        Initialize the Part.
+
+        Args:
+            type (str): The BrickLink item type, 'P' for parts.
+            design_id (Union[int, str]): The design ID.
+            color_id (Union[int, str]): The BrickLink color ID.
+            quantity (Union[int, str]): The quantity wanted.
+            price (str): The maximum price, as written in the XML, if any.
+        """
+        self.type = intern_id(type)
+        self.design_id = intern_id(design_id)
+        self.color_id = intern_id(color_id)
+        self.quantity = int(quantity)
+        self.price = price
+
+    @property
+    def key(self):
+        """tuple: The (design ID, color ID) pair identifying the part."""
+        return (self.design_id, self.color_id)
+
+    def copy(self):
+        """
+        Copy the part.
+
+        Returns:
+            Part: The copy.
+        """
+        return Part(self.type, self.design_id, self.color_id, self.quantity, self.price)
+
+    def to_xml_fields(self):
+        """
+        Convert the part into the fields of a BrickLink XML item, as used by export_xml.
+
+        Returns:
+            dict: The ITEMTYPE, ITEMID, COLOR and MINQTY values.
+        """
+        return {'ITEMTYPE': self.type, 'ITEMID': self.design_id, 'COLOR': self.color_id, 'MINQTY': self.quantity}
+
+    def __eq__(self, other):
+        """Compare two parts field by field."""
+        if not isinstance(other, Part):
+            return NotImplemented
+        return (self.type, self.design_id, self.color_id, self.quantity, self.price) == \
+               (other.type, other.design_id, other.color_id, other.quantity, other.price)
+
+    def __repr__(self):
+        """Represent the part for logging."""
+        return f"Part({self.type}, {self.design_id}, {self.color_id}, x{self.quantity})"
+
+
+class CartLot:
+    """
+    A lot of a BrickLink .cart file.
+
+    Attributes:
+        prefix (str): The prefix of the cart record.
+        store_id (str): The BrickLink store ID.
+        lot_id (str): The BrickLink store lot ID.
+        quantity (int): The quantity in the cart.
+    """
+
+    __slots__ = ('prefix', 'store_id', 'lot_id', 'quantity')
+
+    def __init__(self, prefix, store_id, lot_id, quantity):
+        """
+        Initialize the CartLot.
+
+        Args:
+            prefix (str): The prefix of the cart record.
+            store_id (Union[int, str]): The BrickLink store ID.
+            lot_id (Union[int, str]): The BrickLink store lot ID.
+            quantity (Union[int, str]): The quantity in the cart.
+        """
+        self.prefix = prefix
+        self.store_id = intern_id(store_id)
+        self.lot_id = intern_id(lot_id)
+        self.quantity = int(quantity)
+
+    @property
+    def key(self):
+        """tuple: The (store ID, lot ID) pair identifying the lot."""
+        return (self.store_id, self.lot_id)
+
+    def to_cart_record(self):
+        """
+        Convert the lot into a record of a BrickLink .cart file, as used by export_cart.
+
+        Returns:
+            str: The colon-separated cart record.
+        """
+        return f"{self.prefix or ''}:{self.store_id}:{self.lot_id}:{self.quantity}"
+
+    def __eq__(self, other):
+        """Compare two cart lots field by field."""
+        if not isinstance(other, CartLot):
+            return NotImplemented
+        return (self.prefix, self.store_id, self.lot_id, self.quantity) == (other.prefix, other.store_id, other.lot_id, other.quantity)
+
+    def __repr__(self):
+        """Represent the cart lot for logging."""
+        return f"CartLot({self.store_id}, {self.lot_id}, x{self.quantity})"
+
+
+class PickABrickLot:
+    """
+    A line of a LEGO Pick-a-Brick order.
+
+    Attributes:
+        element_id (str): The LEGO element ID.
+        quantity (int): The quantity to order.
+    """
+
+    __slots__ = ('element_id', 'quantity')
+
+    def __init__(self, element_id, quantity):
+        """
+        Initialize the PickABrickLot.
+
+        Args:
+            element_id (Union[int, str]): The LEGO element ID.
+            quantity (Union[int, str]): The quantity to order.
+        """
+        self.element_id = intern_id(element_id)
+        self.quantity = int(quantity)
+
+    def to_dict(self):
+        """
+        Convert the lot into a Pick-a-Brick upload row, as used by export_csv and export_json.
+
+        Returns:
+            dict: The elementId and quantity of the lot.
+        """
+        return {'elementId': self.element_id, 'quantity': self.quantity}
+
+    def __eq__(self, other):
+        """Compare two Pick-a-Brick lots field by field."""
+        if not isinstance(other, PickABrickLot):
+            return NotImplemented
+        return (self.element_id, self.quantity) == (other.element_id, other.quantity)
+
+    def __repr__(self):
+        """Represent the Pick-a-Brick lot for logging."""
+        return f"PickABrickLot({self.element_id}, x{self.quantity})"
+
+
+class QuantityAccumulator:
+    """
+    Merges records that share a key by summing their quantities.
+
+    Records are kept in a dict, so adding a lot is a single lookup no matter
+    how many records there are, and they come back out in the order their
+    keys were first added.
+
+    Attributes:
+        records (dict): Maps each key to its merged record.
+    """
+
+    __slots__ = ('records',)
+
+    def __init__(self):
+        """Initialize the QuantityAccumulator."""
+        self.records = {}
+
+    def add(self, key, quantity, make_record):
+        """
+        Add a quantity under a key, creating the record the first time the key is seen.
+
+        Args:
+            key (hashable): The key to merge on.
+            quantity (int): The quantity to add.
+            make_record (callable): Builds the record for a new key, with the given quantity.
+
+        Returns:
+            bool: True if the quantity was merged into an existing record.
+        """
+        record = self.records.get(key)
+        if record is None:
+            self.records[key] = make_record()
+            return False
+        record.quantity += quantity
+        return True
+
+    def values(self):
+        """
+        Get the merged records.
+
+        Returns:
+            list: The records, in the order their keys were first added.
+        """
+        return list(self.records.values())
+
+    def __len__(self):
+        """Count the merged records."""
+        return len(self.records)
+
+
+class LotDecision:
+    """
+    The reason a cart lot was kept on BrickLink or moved to Pick-a-Brick.
+
+    Attributes:
+        cart_lot (CartLot): The cart lot.
+        destination (str): 'bricklink' or 'lego'.
+        reason (str): Why the lot went to that destination.
+        element_id (str): The chosen LEGO element ID, if any.
+        lego_price (float): The Pick-a-Brick price of the chosen element, if any.
+        bricklink_price (float): The price of the BrickLink store lot, if known.
+    """
+
+    __slots__ = ('cart_lot', 'destination', 'reason', 'element_id', 'lego_price', 'bricklink_price')
+
+    def __init__(self, cart_lot, destination, reason, element_id=None, lego_price=None, bricklink_price=None):
+        """
+        Initialize the LotDecision.
+
+        Args:
+            cart_lot (CartLot): The cart lot.
+            destination (str): 'bricklink' or 'lego'.
+            reason (str): Why the lot went to that destination.
+            element_id (Union[int, str]): The chosen LEGO element ID, if any.
+            lego_price (float): The Pick-a-Brick price of the chosen element, if any.
+            bricklink_price (float): The price of the BrickLink store lot, if known.
+        """
+        self.cart_lot = cart_lot
+        self.destination = destination
+        self.reason = reason
+        self.element_id = intern_id(element_id)
+        self.lego_price = lego_price
+        self.bricklink_price = bricklink_price
+
+    def to_dict(self):
+        """
+        Convert the decision into a report row, as used by export_decisions.
+
+        Returns:
+            dict: The store ID, lot ID, quantity, destination, reason, element ID and prices.
+        """
+        return {'storeId': self.cart_lot.store_id, 'lotId': self.cart_lot.lot_id, 'quantity': self.cart_lot.quantity,
+                'destination': self.destination, 'reason': self.reason, 'elementId': self.element_id,
+                'legoPrice': self.lego_price, 'bricklinkPrice': self.bricklink_price}
+
+    def __repr__(self):
+        """Represent the decision for logging."""
+        return f"LotDecision({self.cart_lot.store_id}, {self.cart_lot.lot_id}, {self.destination}: {self.reason})"
@@ -2,13 +2,42 @@
 
 This module contains the API needed for making web requests to BrickLink.com
 and obtaining a color dictionary for a given part number (design ID).
+
+lxml and BeautifulSoup are imported by the functions that parse a page, so
+they are only loaded by the processes that actually parse one.
 """
 
+import os
 import sys
+import json
+import time
 import logging
-import requests
-from bs4 import BeautifulSoup
 from colors import colors_by_name
+import request_session
+from request_session import fetch
+
+# Response cache source, which sets how long responses are cached for
+SOURCE = 'bricklink_catalog'
+
+HEADERS = {"User-Agent": "Mozilla/5.0", "accept-language": "en-US,en"}
+
+CATALOG_COLORS_URL = "https://www.bricklink.com/catalogColors.asp"
+
+# The color table is the first table directly inside a <center> that follows a <p>
+COLOR_TABLE_XPATH = '//center/table[preceding-sibling::*[1][self::p]]'
+
+
+def get_url_for_part(design_id):
+    """
+    Get the catalog colors URL for a given part number (design ID).
+
+    Args:
+        design_id (int): The part number (design ID).
+
+    Returns:
+        str: The URL of the catalog colors page.
+    """
+    return f"{CATALOG_COLORS_URL}?itemType=P&itemNo={design_id}"
 
 
 def get_color_dict_for_part(design_id):
@@ -21,12 +50,39 @@ def get_color_dict_for_part(design_id):
     Returns:
         dict: A dictionary mapping color IDs to lists of element IDs.
     """
-    webpage_content = get_webpage_for_part(design_id)
-    color_table = find_color_table_in_page(webpage_content)
-    if not color_table:
+    return parse_color_dict_from_page(design_id, get_webpage_for_part(design_id))
+
+
+async def get_color_dict_for_part_async(design_id, engine):
+    """
+    Get a color dictionary for a given part number (design ID) using a fetch engine.
+
+    Args:
+        design_id (int): The part number (design ID).
+        engine (request_session.FetchEngine): The engine to make the request with.
+
+    Returns:
+        dict: A dictionary mapping color IDs to lists of element IDs.
+    """
+    return parse_color_dict_from_page(design_id, await get_webpage_for_part_async(design_id, engine))
+
+
+def parse_color_dict_from_page(design_id, webpage_content):
+    """
+    Get a color dictionary from the catalog colors page of a part.
+
+    Args:
+        design_id (int): The part number (design ID).
+        webpage_content (bytes): The content of the webpage.
+
+    Returns:
+        dict: A dictionary mapping color IDs to lists of element IDs.
+    """
+    color_rows = find_color_rows_in_page(webpage_content)
+    if color_rows is None:
         logging.error(f"Could not find color table for design ID: {design_id}")
         return
-    color_dict = convert_table_to_dict(color_table)
+    color_dict = convert_rows_to_dict(color_rows)
     return color_dict
 
 
@@ -45,21 +101,95 @@ def get_webpage_for_part(design_id):
         bytes: The content of the webpage.
     """
     try:
-        url = f"https://www.bricklink.com/catalogColors.asp?itemType=P&itemNo={design_id}"
-        logging.info(f"Fetching {url}...")
-        response = requests.get(url, headers={"User-Agent": "Mozilla/5.0", "accept-language": "en-US,en"})
-        response.raise_for_status()  # Raise an HTTPError for bad responses (4xx and 5xx)
+        url = get_url_for_part(design_id)
+        logging.debug("Fetching %s...", url)
+        return fetch('GET', url, headers=HEADERS, source=SOURCE).content
+    except request_session.HTTPError as http_err:
+        logging.error(f"HTTP error occurred: {http_err}")
+        logging.error(f"Error code: {http_err.response.status_code}")
+        logging.error(f"Error data: {http_err.response.text}")
+        raise http_err
+    except Exception as err:
+        logging.error(f"Other error occurred: {err}")
+        raise err
+
+
+async def get_webpage_for_part_async(design_id, engine):
+    """
+    Get the webpage content for a given part number (design ID) using a fetch engine.
+
+    Args:
+        design_id (int): The part number (design ID).
+        engine (request_session.FetchEngine): The engine to make the request with.
+
+    Raises:
+        http_err: An HTTP error occurred.
+        err: An error occurred.
+
+    Returns:
+        bytes: The content of the webpage.
+    """
+    try:
+        url = get_url_for_part(design_id)
+        logging.debug("Fetching %s...", url)
+        response = await engine.fetch('GET', url, headers=HEADERS, source=SOURCE)
         return response.content
-    except requests.exceptions.HTTPError as http_err:
+    except request_session.HTTPError as http_err:
         logging.error(f"HTTP error occurred: {http_err}")
-        logging.error(f"Error code: {response.status_code}")
-        logging.error(f"Error data: {response.text}")
+        logging.error(f"Error code: {http_err.response.status_code}")
+        logging.error(f"Error data: {http_err.response.text}")
         raise http_err
     except Exception as err:
         logging.error(f"Other error occurred: {err}")
         raise err
 
 
+def find_color_rows_in_page(page_content):
+    """
+    Find the cell texts of the rows of the color table in the given page content.
+
+    The lxml fast path is tried first, and BeautifulSoup is used as a fallback
+    if it finds no color table.
+
+    Args:
+        page_content (bytes): The content of the webpage.
+
+    Returns:
+        list: The cell texts of each row of the color table, or None if there is no color table.
+    """
+    color_rows = find_color_rows_with_lxml(page_content)
+    if color_rows is not None:
+        return color_rows
+    logging.debug("lxml found no color table, falling back to BeautifulSoup")
+    color_table = find_color_table_in_page(page_content)
+    if not color_table:
+        return None
+    return [[cell.text for cell in row.find_all('td')] for row in color_table.find_all('tr')]
+
+
+def find_color_rows_with_lxml(page_content):
+    """
+    Find the cell texts of the rows of the color table using lxml and XPath.
+
+    This skips building a BeautifulSoup tree, which is most of the cost of parsing a page.
+
+    Args:
+        page_content (bytes): The content of the webpage.
+
+    Returns:
+        list: The cell texts of each row of the color table, or None if there is no color table.
+    """
+    from lxml import html, etree
+    try:
+        document = html.fromstring(page_content)
+    except (etree.ParserError, ValueError):
+        return None
+    tables = document.xpath(COLOR_TABLE_XPATH)
+    if not tables:
+        return None
+    return [[cell.text_content() for cell in row.iterfind('.//td')] for row in tables[0].iterfind('.//tr')]
+
+
 def find_color_table_in_page(page_content):
     """
     Find the color table in the given page content.
@@ -70,6 +200,7 @@ def find_color_table_in_page(page_content):
     Returns:
         bs4.element.Tag: The color table element.
     """
+    from bs4 import BeautifulSoup
     soup = BeautifulSoup(page_content, 'lxml')
     tables = soup.select('center > table')
     color_table = None
@@ -93,21 +224,32 @@ def convert_table_to_dict(table):
     Args:
         table (bs4.element.Tag): The color table element.
 
+    Returns:
+        dict: A dictionary mapping color IDs to lists of element IDs.
+    """
+    return convert_rows_to_dict([[cell.text for cell in row.find_all('td')] for row in table.find_all('tr')])
+
+
+def convert_rows_to_dict(rows):
+    """
+    Convert the rows of the color table to a dictionary.
+
+    Args:
+        rows (list): The cell texts of each row of the color table.
+
     Returns:
         dict: A dictionary mapping color IDs to lists of element IDs.
     """
     dict = {}
-    rows = table.find_all('tr')
-    for row in rows:
-        data = row.find_all('td')
+    for data in rows:
         if len(data) < 5:
             continue
-        color_name = data[COLOR_COLUMN].text
+        color_name = data[COLOR_COLUMN]
         color_name = color_name.strip().replace('\xa0', '')
         if color_name not in colors_by_name.keys():
             continue
         color_id = colors_by_name[color_name]
-        element_id = data[ELEMENT_ID_COLUMN].text
+        element_id = data[ELEMENT_ID_COLUMN]
         element_id = element_id.strip().replace('\xa0', '')
         if dict.get(color_id):
             dict[color_id].append(element_id)
@@ -116,14 +258,67 @@ def convert_table_to_dict(table):
     return dict
 
 
+def check_saved_pages(pages_dir):
+    """
+    Parse the saved catalog pages in a directory with both parser backends and compare them.
+
+    Each page named catalogColors_<design ID>.html is checked against the color
+    dictionary recorded for it in expected.json, if there is one.
+
+    Args:
+        pages_dir (str): The directory of saved catalog pages.
+
+    Returns:
+        bool: True if both backends agree with each other and with the expected results.
+    """
+    expected_path = os.path.join(pages_dir, 'expected.json')
+    expected = {}
+    if os.path.exists(expected_path):
+        with open(expected_path) as expected_file:
+            expected = json.load(expected_file)
+    ok = True
+    lxml_seconds = 0.0
+    soup_seconds = 0.0
+    for filename in sorted(os.listdir(pages_dir)):
+        if not filename.endswith('.html'):
+            continue
+        with open(os.path.join(pages_dir, filename), 'rb') as page_file:
+            page_content = page_file.read()
+        start = time.perf_counter()
+        lxml_rows = find_color_rows_with_lxml(page_content)
+        lxml_result = convert_rows_to_dict(lxml_rows) if lxml_rows is not None else None
+        lxml_seconds += time.perf_counter() - start
+        start = time.perf_counter()
+        color_table = find_color_table_in_page(page_content)
+        soup_result = convert_table_to_dict(color_table) if color_table else None
+        soup_seconds += time.perf_counter() - start
+        # JSON object keys are strings, so compare with the color IDs as strings
+        lxml_result = {str(color_id): element_ids for color_id, element_ids in lxml_result.items()} if lxml_result is not None else None
+        soup_result = {str(color_id): element_ids for color_id, element_ids in soup_result.items()} if soup_result is not None else None
+        if lxml_result != soup_result:
+            print(f"{filename}: lxml and BeautifulSoup disagree: {lxml_result} != {soup_result}")
+            ok = False
+        elif filename in expected and expected[filename] != lxml_result:
+            print(f"{filename}: expected {expected[filename]}, got {lxml_result}")
+            ok = False
+        else:
+            print(f"{filename}: OK ({len(lxml_result or {})} colors)")
+    print(f"lxml took {lxml_seconds * 1000:.1f} ms, BeautifulSoup took {soup_seconds * 1000:.1f} ms")
+    return ok
+
+
 def main():
     """
     Entrypoint for test.
 
     You can run this script from the command line to test the functionality of the API.
+    Pass --check and a directory of saved catalog pages to check the parser backends against them.
     """
+    if len(sys.argv) == 3 and sys.argv[1] == '--check':
+        sys.exit(0 if check_saved_pages(sys.argv[2]) else 1)
     if len(sys.argv) != 2:
-        print("Usage: python grab_color_info.py <number>")
+        print("Usage: python request_bricklink.py <number>")
+        print("       python request_bricklink.py --check <saved pages directory>")
         return
     number = sys.argv[1]
     color_dict = get_color_dict_for_part(number)
@@ -6,7 +6,19 @@ and obtaining information about a certain store id and lot id (items in a cart).
 
 import sys
 import logging
-import requests
+import request_session
+from request_session import fetch
+
+# Response cache source, which sets how long responses are cached for
+SOURCE = 'bricklink_store_lot'
+
+HEADERS = {
+    'Accept': 'application/json, text/javascript, */*; q=0.01',
+    'Host': 'store.bricklink.com',
+    'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/58.0.3029.110 Safari/537.3',
+}
+
+STORE_ITEM_URL = "https://store.bricklink.com/ajax/clone/store/item.ajax"
 
 
 def get_part_and_price_for_lot(store_id, lot_id):
@@ -23,6 +35,21 @@ def get_part_and_price_for_lot(store_id, lot_id):
     return parse_json(get_json_for_store_and_lot_id(store_id, lot_id))
 
 
+async def get_part_and_price_for_lot_async(store_id, lot_id, engine):
+    """
+    Get the part and price for a given store and lot ID using a fetch engine.
+
+    Args:
+        store_id (Union[int, str]): The BrickLink store ID.
+        lot_id (Union[int, str]): The BrickLink store lot ID.
+        engine (request_session.FetchEngine): The engine to make the request with.
+
+    Returns:
+        dict: The part and price data from the request.
+    """
+    return parse_json(await get_json_for_store_and_lot_id_async(store_id, lot_id, engine))
+
+
 def parse_json(json_data):
     """
     Parse the JSON data from a request.
@@ -36,6 +63,20 @@ def parse_json(json_data):
     return (json_data['itemNo'], json_data['colorID'], float(json_data['nativePrice'][4:]), json_data['itemType'])
 
 
+def get_url_for_store_and_lot_id(store_id, lot_id):
+    """
+    Get the item URL for a given store and lot ID.
+
+    Args:
+        store_id (Union[int, str]): The BrickLink store ID.
+        lot_id (Union[int, str]): The BrickLink store lot ID.
+
+    Returns:
+        str: The URL of the store item.
+    """
+    return f"{STORE_ITEM_URL}?invID={lot_id}&sid={store_id}&wantedMoreArrayID="
+
+
 def get_json_for_store_and_lot_id(store_id, lot_id):
     """
     Get the JSON data for a given store.
@@ -52,20 +93,44 @@ def get_json_for_store_and_lot_id(store_id, lot_id):
         dict: The JSON data from the request.
     """
     try:
-        url = f"https://store.bricklink.com/ajax/clone/store/item.ajax?invID={lot_id}&sid={store_id}&wantedMoreArrayID="
-        logging.info(f"Fetching {url}")
-        headers = {
-            'Accept': 'application/json, text/javascript, */*; q=0.01',
-            'Host': 'store.bricklink.com',
-            'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/58.0.3029.110 Safari/537.3',
-        }
-        response = requests.get(url, headers=headers)
-        response.raise_for_status()  # Raise an HTTPError for bad responses (4xx and 5xx)
+        url = get_url_for_store_and_lot_id(store_id, lot_id)
+        logging.debug("Fetching %s", url)
+        return fetch('GET', url, headers=HEADERS, source=SOURCE).json()
+    except request_session.HTTPError as http_err:
+        logging.error(f"HTTP error occurred: {http_err}")
+        logging.error(f"Error code: {http_err.response.status_code}")
+        logging.error(f"Error data: {http_err.response.text}")
+        raise http_err
+    except Exception as err:
+        logging.error(f"Other error occurred: {err}")
+        raise err
+
+
+async def get_json_for_store_and_lot_id_async(store_id, lot_id, engine):
+    """
+    Get the JSON data for a given store using a fetch engine.
+
+    Args:
+        store_id (Union[int, str]): The BrickLink store ID.
+        lot_id (Union[int, str]): The BrickLink store lot ID.
+        engine (request_session.FetchEngine): The engine to make the request with.
+
+    Raises:
+        http_err: An HTTP error occurred.
+        err: An error occurred.
+
+    Returns:
+        dict: The JSON data from the request.
+    """
+    try:
+        url = get_url_for_store_and_lot_id(store_id, lot_id)
+        logging.debug("Fetching %s", url)
+        response = await engine.fetch('GET', url, headers=HEADERS, source=SOURCE)
         return response.json()
-    except requests.exceptions.HTTPError as http_err:
+    except request_session.HTTPError as http_err:
         logging.error(f"HTTP error occurred: {http_err}")
-        logging.error(f"Error code: {response.status_code}")
-        logging.error(f"Error data: {response.text}")
+        logging.error(f"Error code: {http_err.response.status_code}")
+        logging.error(f"Error data: {http_err.response.text}")
         raise http_err
     except Exception as err:
         logging.error(f"Other error occurred: {err}")
@@ -2,11 +2,18 @@
 
 This module contains the API needed for making web requests to LEGO.com
 and obtaining Pick-A-Brick store results for a part number (Element ID).
+Batches of element IDs can be looked up in a single request, with one
+aliased searchElements field per element ID.
 """
 
 import sys
 import logging
-from curl_cffi import requests
+from request_session import fetch
+
+# Response cache source, which sets how long responses are cached for
+SOURCE = 'lego_store'
+
+URL = "https://www.lego.com/api/graphql/PickABrickQuery"
 
 QUERY = '''
 query PickABrickQuery($input: ElementQueryInput!) {
@@ -29,6 +36,16 @@ fragment ElementLeaf on SearchResultElement {
 }
 '''
 
+ELEMENT_LEAF_FRAGMENT = QUERY[QUERY.index('fragment ElementLeaf'):]
+
+# Maximum number of element IDs looked up in a single batched request
+BATCH_SIZE = 50
+
+BATCH_HEADERS = {
+    "Referer": "https://www.lego.com/en-us/pick-and-build/pick-a-brick",
+    "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/122.0.0.0 Safari/537.36"
+}
+
 
 def get_lego_store_result_for_element_id(element_id):
     """
@@ -40,7 +57,172 @@ def get_lego_store_result_for_element_id(element_id):
     Returns:
         dict: A dictionary containing the store results for the given part number.
     """
-    url = "https://www.lego.com/api/graphql/PickABrickQuery"
+    json_body, headers = build_request(element_id)
+    response = fetch('POST', URL, headers=headers, json_body=json_body, source=SOURCE)
+    return parse_response(element_id, response.json())
+
+
+async def get_lego_store_result_for_element_id_async(element_id, engine):
+    """
+    Get the Pick-A-Brick store results for a given part number (Element ID) using a fetch engine.
+
+    Args:
+        element_id (int): The part number (Element ID).
+        engine (request_session.FetchEngine): The engine to make the request with.
+
+    Returns:
+        dict: A dictionary containing the store results for the given part number.
+    """
+    json_body, headers = build_request(element_id)
+    response = await engine.fetch('POST', URL, headers=headers, json_body=json_body, source=SOURCE)
+    return parse_response(element_id, response.json())
+
+
+def get_lego_store_results_for_element_ids(element_ids):
+    """
+    Get the Pick-A-Brick store results for a batch of part numbers (Element IDs) in one request.
+
+    Args:
+        element_ids (iterable): The part numbers (Element IDs), at most BATCH_SIZE of them.
+
+    Returns:
+        dict: Maps each element ID to its store result, or None if LEGO does not sell it.
+    """
+    element_ids = list(element_ids)
+    response = fetch('POST', URL, headers=BATCH_HEADERS, json_body=build_batch_request(element_ids), source=SOURCE)
+    return parse_batch_response(element_ids, response.json())
+
+
+async def get_lego_store_results_for_element_ids_async(element_ids, engine):
+    """
+    Get the Pick-A-Brick store results for a batch of part numbers (Element IDs) in one request using a fetch engine.
+
+    Element IDs already being looked up by another batch in flight are not requested
+    again; their results are shared with that batch instead.
+
+    Args:
+        element_ids (iterable): The part numbers (Element IDs), at most BATCH_SIZE of them.
+        engine (request_session.FetchEngine): The engine to make the request with.
+
+    Returns:
+        dict: Maps each element ID to its store result, or None if LEGO does not sell it.
+    """
+    async def fetch_batch(batch):
+        response = await engine.fetch('POST', URL, headers=BATCH_HEADERS, json_body=build_batch_request(batch), source=SOURCE)
+        return parse_batch_response(batch, response.json())
+
+    return await engine.single_flight(SOURCE).do_many(element_ids, fetch_batch)
+
+
+def split_into_batches(element_ids, batch_size=BATCH_SIZE):
+    """
+    Split element IDs into batches small enough for a single request.
+
+    Args:
+        element_ids (iterable): The part numbers (Element IDs).
+        batch_size (int): The maximum number of element IDs per batch.
+
+    Returns:
+        list of tuple: The batches of element IDs.
+    """
+    element_ids = sorted(element_ids)
+    return [tuple(element_ids[i:i + batch_size]) for i in range(0, len(element_ids), batch_size)]
+
+
+def parse_store_result(result):
+    """
+    Convert a store result into the fields of a LEGO Pick-a-Brick database entry.
+
+    Args:
+        result (dict): The store result, or None if LEGO does not sell the part.
+
+    Raises:
+        ValueError: The store result has an unknown delivery channel.
+
+    Returns:
+        dict: The lego_sells, bestseller, price and max_order_quantity fields.
+    """
+    if result is None:
+        return {'lego_sells': False, 'bestseller': None, 'price': None, 'max_order_quantity': None}
+    if result['deliveryChannel'] not in ['pab', 'bap']:
+        raise ValueError(f"Invalid delivery channel: {result['deliveryChannel']}")
+    return {
+        'lego_sells': True,
+        'bestseller': (result['deliveryChannel'] == 'pab'),
+        'price': result['price']['formattedAmount'],
+        'max_order_quantity': result['maxOrderQuantity'],
+    }
+
+
+def build_batch_request(element_ids):
+    """
+    Build a GraphQL request body that looks up a batch of part numbers (Element IDs).
+
+    Each element ID gets its own aliased searchElements field (e0, e1, ...) with
+    its own input variable, so the results can be mapped back by position.
+
+    Args:
+        element_ids (list): The part numbers (Element IDs).
+
+    Returns:
+        dict: The JSON body of the request.
+    """
+    variable_definitions = ', '.join(f"$input{i}: ElementQueryInput!" for i in range(len(element_ids)))
+    fields = '\n'.join(f"  e{i}: searchElements(input: $input{i}) {{\n    results {{\n      ...ElementLeaf\n    }}\n  }}"
+                        for i in range(len(element_ids)))
+    query = f"query PickABrickQuery({variable_definitions}) {{\n{fields}\n}}\n{ELEMENT_LEAF_FRAGMENT}"
+    variables = {f"input{i}": {"perPage": 10, "query": str(element_id)} for i, element_id in enumerate(element_ids)}
+    return {
+        "operationName": "PickABrickQuery",
+        "variables": variables,
+        "query": query
+    }
+
+
+def parse_batch_response(element_ids, response_json):
+    """
+    Map the aliased results of a batched GraphQL response back to their element IDs.
+
+    Element IDs whose field came back empty (for example because of a GraphQL
+    error) are left out, so they can be requested again later.
+
+    Args:
+        element_ids (list): The part numbers (Element IDs), in request order.
+        response_json (dict): The JSON data from the request.
+
+    Returns:
+        dict: Maps each element ID to its store result, or None if LEGO does not sell it.
+    """
+    data = response_json.get('data') or {}
+    for error in response_json.get('errors', []):
+        logging.error(f"GraphQL error in batched request: {error.get('message', error)}")
+    results_by_element_id = {}
+    for i, element_id in enumerate(element_ids):
+        search_result = data.get(f"e{i}")
+        if search_result is None:
+            logging.error(f"Did not receive a search result for element ID: {element_id}")
+            continue
+        results = search_result['results']
+        if len(results) < 1:
+            logging.warning(f"Did not receive result for element ID: {element_id}")
+            results_by_element_id[element_id] = None
+            continue
+        matching = [result for result in results if str(result['id']) == str(element_id)]
+        results_by_element_id[element_id] = matching[0] if matching else results[0]
+    logging.debug("Received results for %d of %d element IDs in one batch", len(results_by_element_id), len(element_ids))
+    return results_by_element_id
+
+
+def build_request(element_id):
+    """
+    Build the GraphQL request body and headers for a part number (Element ID).
+
+    Args:
+        element_id (int): The part number (Element ID).
+
+    Returns:
+        tuple: The JSON body and the headers of the request.
+    """
     json_body = {
         "operationName": "PickABrickQuery",
         "variables": {"input": {"perPage": 10, "query": str(element_id)}},
@@ -50,10 +232,20 @@ def get_lego_store_result_for_element_id(element_id):
         "Referer": f"https://www.lego.com/en-us/pick-and-build/pick-a-brick?query={str(element_id)}",
         "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/122.0.0.0 Safari/537.36"
     }
-    response = requests.post(url, json=json_body, headers=headers)
-    response.raise_for_status()  # Raise an exception for HTTP errors
-    response_json = response.json()
+    return json_body, headers
+
+
+def parse_response(element_id, response_json):
+    """
+    Pick the store result out of a GraphQL response.
 
+    Args:
+        element_id (int): The part number (Element ID).
+        response_json (dict): The JSON data from the request.
+
+    Returns:
+        dict: The store result, or None if LEGO does not sell the part.
+    """
     results = response_json['data']['searchElements']['results']
     if len(results) < 1:
         logging.warning(f"Did not receive result for element ID: {element_id}")
@@ -75,6 +267,7 @@ def main():
     element_id = int(sys.argv[1])
 
     print(get_lego_store_result_for_element_id(element_id))
+    print(get_lego_store_results_for_element_ids([element_id]))
 
 
 if __name__ == "__main__":
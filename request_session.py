@@ -0,0 +1,886 @@
+"""Request Session.
+
+This module contains the shared HTTP layer used by all of the request modules.
+It keeps one pooled keep-alive session per host, so repeated lookups against
+BrickLink and LEGO reuse their connections instead of paying for a new TCP and
+TLS handshake on every call. Requests are paced per host by a HostLimiter, and
+throttled or failed requests are retried with backoff. The FetchEngine class
+runs many async lookups at once with a bounded concurrency, optionally handing
+the raw responses to a pool of parse workers. Requests tagged with a source go
+through the response cache, if one is configured. Every request, retry and
+cache lookup is counted in the metrics registry.
+
+curl_cffi is only imported once a request actually goes out, so a run that
+finds everything in the database or the response cache never pays for it.
+"""
+
+import os
+import time
+import random
+import asyncio
+import logging
+import threading
+import contextlib
+import metrics
+from urllib.parse import urlsplit
+from concurrent.futures import Future, ProcessPoolExecutor
+from email.utils import parsedate_to_datetime
+from response_cache import ResponseCache
+
+# Default number of requests allowed in flight at once
+DEFAULT_CONCURRENCY = 16
+
+# Default number of responses parsed at once, one per core
+DEFAULT_PARSE_WORKERS = os.cpu_count() or 1
+
+# Default number of times a throttled or failed request is retried
+DEFAULT_MAX_RETRIES = 4
+
+# Base and cap of the exponential backoff between retries, in seconds
+BACKOFF_BASE = 0.5
+BACKOFF_CAP = 30.0
+
+# Longest Retry-After we are willing to wait for, in seconds
+MAX_RETRY_AFTER = 300.0
+
+# Status codes worth retrying, and the ones that mean we are going too fast
+RETRY_STATUS_CODES = {429, 500, 502, 503, 504}
+THROTTLE_STATUS_CODES = {429, 503}
+
+# Throttled responses within this many seconds of the last one do not shrink the limit again
+THROTTLE_WINDOW = 1.0
+
+# Default request rate allowed per host, in requests per second, and per-host overrides
+DEFAULT_REQUESTS_PER_SECOND = 8.0
+REQUESTS_PER_SECOND = {
+    'www.bricklink.com': 4.0,  # The catalog pages throttle hardest
+}
+
+_sessions = {}
+_sessions_lock = threading.Lock()
+_cache = None
+_limiters = {}
+_limiters_lock = threading.Lock()
+_in_flight = {}
+_in_flight_lock = threading.Lock()
+
+
+def __getattr__(name):
+    """
+    Import HTTPError from curl_cffi the first time another module asks for it.
+
+    Args:
+        name (str): The name of the attribute.
+
+    Returns:
+        type: curl_cffi's HTTPError.
+    """
+    if name == 'HTTPError':
+        from curl_cffi.requests.exceptions import HTTPError
+        return HTTPError
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+def get_host(url):
+    """
+    Get the host part of a URL.
+
+    Args:
+        url (str): The URL.
+
+    Returns:
+        str: The host (and port, if any) of the URL.
+    """
+    return urlsplit(url).netloc
+
+
+def get_session(url):
+    """
+    Get the shared keep-alive session for the host of a URL.
+
+    Args:
+        url (str): The URL that is about to be requested.
+
+    Returns:
+        curl_cffi.requests.Session: The session for the host.
+    """
+    host = get_host(url)
+    with _sessions_lock:
+        session = _sessions.get(host)
+        if session is None:
+            from curl_cffi import requests
+            session = requests.Session()
+            _sessions[host] = session
+            logging.debug("Opened session for %s", host)
+        return session
+
+
+class HostLimiter:
+    """
+    Paces the requests to a single host.
+
+    A token bucket caps the request rate, a Retry-After answer pauses the host
+    entirely, and an adaptive limit on the requests in flight is halved on every
+    throttled response and grows back by one request per limit's worth of successes.
+
+    The limiter is shared by the synchronous fetch function and every fetch engine,
+    so every access goes through a lock.
+
+    Attributes:
+        host (str): The host.
+        rate (float): The number of requests allowed per second.
+        burst (float): The maximum number of tokens the bucket holds.
+        tokens (float): The number of tokens currently in the bucket.
+        updated_at (float): When the bucket was last refilled.
+        paused_until (float): When the host may be requested again after a Retry-After.
+        throttled_at (float): When the limit was last halved.
+        limit (float): The adaptive number of requests allowed in flight at once.
+        max_limit (int): The number of requests in flight the limit grows back to.
+    """
+
+    def __init__(self, host, rate, max_limit=DEFAULT_CONCURRENCY):
+        """
+        Initialize the HostLimiter.
+
+        Args:
+            host (str): The host.
+            rate (float): The number of requests allowed per second.
+            max_limit (int): The number of requests in flight the limit grows back to.
+        """
+        self.host = host
+        self.rate = rate
+        self.burst = max(1.0, rate)
+        self.tokens = self.burst
+        self.updated_at = time.monotonic()
+        self.paused_until = 0.0
+        self.throttled_at = float('-inf')
+        self.limit = float(max_limit)
+        self.max_limit = max_limit
+        self._lock = threading.Lock()
+
+    def reserve(self):
+        """
+        Take a token from the bucket, going into debt if it is empty.
+
+        Returns:
+            float: How long to wait before sending the request, in seconds.
+        """
+        with self._lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.updated_at) * self.rate)
+            self.updated_at = now
+            self.tokens -= 1
+            delay = -self.tokens / self.rate if self.tokens < 0 else 0.0
+            return max(delay, self.paused_until - now)
+
+    def record_success(self):
+        """Grow the limit back after a successful request."""
+        with self._lock:
+            self.limit = min(self.max_limit, self.limit + 1 / self.limit)
+
+    def record_throttle(self, retry_after=None):
+        """
+        Halve the limit after a throttled request, and pause the host if the server asked us to.
+
+        Args:
+            retry_after (float): How long the server asked us to wait, in seconds, if it did.
+        """
+        with self._lock:
+            now = time.monotonic()
+            if retry_after:
+                self.paused_until = max(self.paused_until, now + min(retry_after, MAX_RETRY_AFTER))
+            # A burst of requests sent together is throttled together, so only halve once per burst
+            if now - self.throttled_at < THROTTLE_WINDOW:
+                return
+            self.throttled_at = now
+            self.limit = max(1.0, self.limit / 2)
+        logging.warning(f"Throttled by {self.host}, limiting to {int(self.limit)} requests in flight")
+
+
+def get_limiter(url):
+    """
+    Get the shared limiter for the host of a URL.
+
+    Args:
+        url (str): The URL that is about to be requested.
+
+    Returns:
+        HostLimiter: The limiter for the host.
+    """
+    host = get_host(url)
+    with _limiters_lock:
+        limiter = _limiters.get(host)
+        if limiter is None:
+            limiter = HostLimiter(host, REQUESTS_PER_SECOND.get(host, DEFAULT_REQUESTS_PER_SECOND))
+            _limiters[host] = limiter
+        return limiter
+
+
+def parse_retry_after(response):
+    """
+    Parse the Retry-After header of a response.
+
+    Args:
+        response (curl_cffi.requests.Response): The response.
+
+    Returns:
+        float: How long the server asked us to wait, in seconds, or None if it did not say.
+    """
+    value = response.headers.get('Retry-After')
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+def get_retry_delay(attempt, retry_after=None):
+    """
+    Get how long to wait before retrying a request.
+
+    Args:
+        attempt (int): The number of the attempt that failed, starting at 0.
+        retry_after (float): How long the server asked us to wait, in seconds, if it did.
+
+    Returns:
+        float: The delay, in seconds. Exponential backoff with full jitter, unless the server said otherwise.
+    """
+    if retry_after is not None:
+        return min(retry_after, MAX_RETRY_AFTER)
+    return random.uniform(0, min(BACKOFF_CAP, BACKOFF_BASE * 2 ** attempt))
+
+
+def should_retry(url, attempt, max_retries, response=None, error=None):
+    """
+    Decide whether a request is worth retrying, and record throttling on its host's limiter.
+
+    Args:
+        url (str): The URL of the request.
+        attempt (int): The number of the attempt that failed, starting at 0.
+        max_retries (int): The maximum number of retries.
+        response (curl_cffi.requests.Response): The response, if one arrived.
+        error (Exception): The connection error or timeout, if no response arrived.
+
+    Returns:
+        float: How long to wait before retrying, in seconds, or None if the request should not be retried.
+    """
+    if response is not None and response.status_code not in RETRY_STATUS_CODES:
+        return None
+    retry_after = None
+    if response is not None:
+        retry_after = parse_retry_after(response)
+        if response.status_code in THROTTLE_STATUS_CODES:
+            metrics.increment('http_throttled_total', host=get_host(url))
+            get_limiter(url).record_throttle(retry_after)
+    if attempt >= max_retries:
+        return None
+    metrics.increment('http_retries_total', host=get_host(url))
+    delay = get_retry_delay(attempt, retry_after)
+    reason = f"status {response.status_code}" if response is not None else error
+    logging.warning(f"Retrying {url} in {delay:.1f} seconds after {reason} "
+                    f"(attempt {attempt + 1} of {max_retries})")
+    return delay
+
+
+def set_cache(cache):
+    """
+    Set the response cache used by the synchronous fetch function.
+
+    Args:
+        cache (response_cache.ResponseCache): The cache, or None to disable caching.
+    """
+    global _cache
+    _cache = cache
+
+
+def prepare_cached_request(cache, method, url, headers, json_body, source):
+    """
+    Look up a request in the response cache before it is sent.
+
+    Args:
+        cache (response_cache.ResponseCache): The cache, or None if caching is disabled.
+        method (str): The HTTP method.
+        url (str): The URL to request.
+        headers (dict): The request headers.
+        json_body (dict): The JSON body to send, if any.
+        source (str): The source of the request, which selects its time-to-live.
+
+    Returns:
+        tuple: (key, cached, headers), where cached is the cached response (if
+            any) and headers includes the conditional headers to revalidate it.
+    """
+    if cache is None or source is None:
+        return None, None, headers
+    key = cache.make_key(method, url, json_body)
+    cached = cache.get(key)
+    if cached is None:
+        metrics.increment('cache_lookups_total', source=source, result='miss')
+    elif cache.is_fresh(cached, source):
+        metrics.increment('cache_lookups_total', source=source, result='hit')
+    else:
+        metrics.increment('cache_lookups_total', source=source, result='stale')
+        headers = dict(headers or {}, **cache.conditional_headers(cached))
+    return key, cached, headers
+
+
+def finish_cached_request(cache, key, cached, source, response):
+    """
+    Store or revalidate a response in the response cache after it arrives.
+
+    Args:
+        cache (response_cache.ResponseCache): The cache, or None if caching is disabled.
+        key (str): The cache key, or None if the request is not cached.
+        cached (response_cache.CachedResponse): The stale cached response, if any.
+        source (str): The source of the request.
+        response (curl_cffi.requests.Response): The response.
+
+    Raises:
+        HTTPError: The server returned a 4xx or 5xx response.
+
+    Returns:
+        object: The response, or the cached response if the server answered 304 Not Modified.
+    """
+    if key is not None and cached is not None and response.status_code == 304:
+        metrics.increment('cache_revalidated_total', source=source)
+        return cache.revalidate(key, cached, response)
+    response.raise_for_status()  # Raise an HTTPError for bad responses (4xx and 5xx)
+    if key is not None and response.status_code == 200:
+        if cache.is_cacheable(source, response):
+            return cache.store(key, source, response)
+        metrics.increment('cache_rejected_total', source=source)
+        logging.debug("[Cache] Not caching an incomplete response for %s", response.url)
+    return response
+
+
+def fetch(method, url, headers=None, json_body=None, source=None, max_retries=DEFAULT_MAX_RETRIES):
+    """
+    Make a paced request using the shared session for the host, retrying throttled and failed attempts.
+
+    Identical requests made from other threads while this one is in flight share its response.
+
+    Args:
+        method (str): The HTTP method.
+        url (str): The URL to request.
+        headers (dict): The request headers.
+        json_body (dict): The JSON body to send, if any.
+        source (str): The source of the request, used to cache the response.
+        max_retries (int): The maximum number of retries.
+
+    Raises:
+        HTTPError: The server returned a 4xx or 5xx response, after any retries.
+
+    Returns:
+        curl_cffi.requests.Response: The response.
+    """
+    request_key = ResponseCache.make_key(method, url, json_body)
+    with _in_flight_lock:
+        future = _in_flight.get(request_key)
+        owner = future is None
+        if owner:
+            future = Future()
+            _in_flight[request_key] = future
+    if not owner:
+        logging.debug("Joined in-flight request for %s", url)
+        metrics.increment('http_coalesced_total', host=get_host(url))
+        return future.result()
+    try:
+        response = fetch_uncoalesced(method, url, headers, json_body, source, max_retries)
+    except BaseException as exc:
+        future.set_exception(exc)
+        raise
+    else:
+        future.set_result(response)
+        return response
+    finally:
+        with _in_flight_lock:
+            del _in_flight[request_key]
+
+
+def fetch_uncoalesced(method, url, headers=None, json_body=None, source=None, max_retries=DEFAULT_MAX_RETRIES):
+    """
+    Make a paced request, without joining an identical request already in flight.
+
+    Args:
+        method (str): The HTTP method.
+        url (str): The URL to request.
+        headers (dict): The request headers.
+        json_body (dict): The JSON body to send, if any.
+        source (str): The source of the request, used to cache the response.
+        max_retries (int): The maximum number of retries.
+
+    Raises:
+        HTTPError: The server returned a 4xx or 5xx response, after any retries.
+
+    Returns:
+        curl_cffi.requests.Response: The response.
+    """
+    key, cached, headers = prepare_cached_request(_cache, method, url, headers, json_body, source)
+    if cached is not None and _cache.is_fresh(cached, source):
+        return cached
+    from curl_cffi.requests.exceptions import Timeout, ConnectionError as RequestConnectionError
+    limiter = get_limiter(url)
+    attempt = 0
+    while True:
+        time.sleep(limiter.reserve())
+        try:
+            with metrics.timer('http_request_seconds', host=limiter.host):
+                response = get_session(url).request(method, url, headers=headers, json=json_body)
+        except (RequestConnectionError, Timeout) as err:
+            metrics.increment('http_requests_total', host=limiter.host, status=type(err).__name__)
+            delay = should_retry(url, attempt, max_retries, error=err)
+            if delay is None:
+                raise
+        else:
+            metrics.increment('http_requests_total', host=limiter.host, status=response.status_code)
+            delay = should_retry(url, attempt, max_retries, response=response)
+            if delay is None:
+                if response.status_code < 400:
+                    limiter.record_success()
+                return finish_cached_request(_cache, key, cached, source, response)
+        time.sleep(delay)
+        attempt += 1
+
+
+def close_sessions():
+    """Close all of the shared sessions."""
+    with _sessions_lock:
+        for session in _sessions.values():
+            session.close()
+        _sessions.clear()
+
+
+def open_parse_pool(parse_workers=DEFAULT_PARSE_WORKERS, parse_pool=None):
+    """
+    Get the process pool to parse pages in, for use as a context manager.
+
+    Args:
+        parse_workers (int): Number of processes in a new pool.
+        parse_pool (concurrent.futures.ProcessPoolExecutor): A pool that is already running, or None.
+
+    Returns:
+        contextlib.AbstractContextManager: Yields the given pool and leaves it running on exit, or
+            yields a new pool and shuts it down on exit.
+    """
+    if parse_pool is not None:
+        return contextlib.nullcontext(parse_pool)
+    return ProcessPoolExecutor(parse_workers)
+
+
+class SingleFlight:
+    """
+    Lets concurrent callers asking for the same key share a single in-flight lookup and its result.
+
+    A key is only tracked while its lookup is in flight; once it completes, the
+    next caller starts a new lookup (which the response cache may then answer).
+
+    Attributes:
+        calls (dict): Maps the keys being looked up to the futures of their results.
+    """
+
+    # Result of a key that a batched lookup did not return
+    MISSING = object()
+
+    def __init__(self):
+        """Initialize the SingleFlight."""
+        self.calls = {}
+
+    async def do(self, key, function):
+        """
+        Look up a key, joining the lookup already in flight for it if there is one.
+
+        Args:
+            key (hashable): The key.
+            function (callable): An async function with no arguments that looks the key up.
+
+        Returns:
+            object: The result of the lookup.
+        """
+        future = self.calls.get(key)
+        if future is None:
+            future = asyncio.ensure_future(function())
+            self.calls[key] = future
+            future.add_done_callback(lambda _: self.calls.pop(key, None))
+        # Shielded, so one caller giving up does not cancel the lookup for the others
+        return await asyncio.shield(future)
+
+    async def do_many(self, keys, function):
+        """
+        Look up a batch of keys, only looking up the ones that are not already in flight.
+
+        Args:
+            keys (iterable): The keys.
+            function (callable): An async function taking a list of keys and returning a dict of their results.
+
+        Returns:
+            dict: Maps each key to its result, leaving out keys the lookups did not return.
+        """
+        keys = list(dict.fromkeys(keys))
+        owned = [key for key in keys if key not in self.calls]
+        if len(owned) < len(keys):
+            logging.debug("Joined in-flight requests for %s of %s keys", len(keys) - len(owned), len(keys))
+        if owned:
+            loop = asyncio.get_running_loop()
+            for key in owned:
+                self.calls[key] = loop.create_future()
+            batch = asyncio.ensure_future(function(owned))
+            batch.add_done_callback(lambda _: self._resolve(owned, batch))
+        futures = {key: self.calls[key] for key in keys}
+        results = {}
+        for key, future in futures.items():
+            result = await asyncio.shield(future)
+            if result is not self.MISSING:
+                results[key] = result
+        return results
+
+    def _resolve(self, owned, batch):
+        """Hand the result of a batched lookup to the futures of its keys."""
+        for key in owned:
+            future = self.calls.pop(key)
+            if batch.cancelled():
+                future.cancel()
+            elif batch.exception() is not None:
+                future.set_exception(batch.exception())
+                # A caller stops at the first key that raises, so mark the error retrieved for the keys it never awaits
+                future.exception()
+            else:
+                future.set_result(batch.result().get(key, self.MISSING))
+
+
+class FetchEngine:
+    """
+    Runs async requests with one pooled session per host and a bounded concurrency.
+
+    The engine owns its own event loop, so it can be driven from ordinary
+    synchronous code. Results are handed back to the calling thread, which
+    keeps all of the database writes on a single thread.
+
+    Attributes:
+        concurrency (int): The maximum number of requests in flight at once.
+        loop (asyncio.AbstractEventLoop): The event loop the requests run on.
+        semaphore (asyncio.Semaphore): Bounds the number of requests in flight.
+        sessions (dict): Maps hosts to their async sessions.
+        cache (response_cache.ResponseCache): The response cache, or None.
+        max_retries (int): The maximum number of retries of each request.
+        in_flight (dict): Maps hosts to their number of requests in flight.
+        host_conditions (dict): Maps hosts to the conditions their requests wait on for a free slot.
+        single_flights (dict): Maps namespaces to the SingleFlight groups coalescing their lookups.
+    """
+
+    def __init__(self, concurrency=DEFAULT_CONCURRENCY, cache=None, max_retries=DEFAULT_MAX_RETRIES):
+        """
+        Initialize the FetchEngine.
+
+        Args:
+            concurrency (int): The maximum number of requests in flight at once.
+            cache (response_cache.ResponseCache): The response cache, or None to disable caching.
+            max_retries (int): The maximum number of retries of each request.
+        """
+        if concurrency < 1:
+            raise ValueError(f"Concurrency must be at least 1, got {concurrency}")
+        self.concurrency = concurrency
+        self.loop = asyncio.new_event_loop()
+        self.semaphore = asyncio.Semaphore(concurrency)
+        self.sessions = {}
+        self.cache = cache
+        self.max_retries = max_retries
+        self.in_flight = {}
+        self.host_conditions = {}
+        self.single_flights = {}
+
+    def __enter__(self):
+        """Return the engine for use as a context manager."""
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        """Close the engine when leaving the context."""
+        self.close()
+
+    def single_flight(self, namespace):
+        """
+        Get the single-flight group of a namespace, creating it the first time.
+
+        Args:
+            namespace (str): The namespace, such as 'requests' or a response cache source.
+
+        Returns:
+            SingleFlight: The single-flight group.
+        """
+        group = self.single_flights.get(namespace)
+        if group is None:
+            group = SingleFlight()
+            self.single_flights[namespace] = group
+        return group
+
+    def get_session(self, url):
+        """
+        Get the async keep-alive session for the host of a URL.
+
+        Args:
+            url (str): The URL that is about to be requested.
+
+        Returns:
+            curl_cffi.requests.AsyncSession: The session for the host.
+        """
+        host = get_host(url)
+        session = self.sessions.get(host)
+        if session is None:
+            from curl_cffi import requests
+            session = requests.AsyncSession(max_clients=self.concurrency)
+            self.sessions[host] = session
+            logging.debug("Opened async session for %s", host)
+        return session
+
+    async def fetch(self, method, url, headers=None, json_body=None, source=None):
+        """
+        Make a paced async request using the session for the host, retrying throttled and failed attempts.
+
+        Identical requests made while this one is in flight share its response.
+
+        Args:
+            method (str): The HTTP method.
+            url (str): The URL to request.
+            headers (dict): The request headers.
+            json_body (dict): The JSON body to send, if any.
+            source (str): The source of the request, used to cache the response.
+
+        Raises:
+            HTTPError: The server returned a 4xx or 5xx response, after any retries.
+
+        Returns:
+            curl_cffi.requests.Response: The response.
+        """
+        request_key = ResponseCache.make_key(method, url, json_body)
+        requests_in_flight = self.single_flight('requests')
+        if request_key in requests_in_flight.calls:
+            logging.debug("Joined in-flight request for %s", url)
+            metrics.increment('http_coalesced_total', host=get_host(url))
+        return await requests_in_flight.do(request_key, lambda: self.fetch_uncoalesced(method, url, headers, json_body, source))
+
+    async def fetch_uncoalesced(self, method, url, headers, json_body, source):
+        """
+        Make a paced async request, without joining an identical request already in flight.
+
+        Args:
+            method (str): The HTTP method.
+            url (str): The URL to request.
+            headers (dict): The request headers.
+            json_body (dict): The JSON body to send, if any.
+            source (str): The source of the request, used to cache the response.
+
+        Raises:
+            HTTPError: The server returned a 4xx or 5xx response, after any retries.
+
+        Returns:
+            curl_cffi.requests.Response: The response.
+        """
+        key, cached, headers = prepare_cached_request(self.cache, method, url, headers, json_body, source)
+        if cached is not None and self.cache.is_fresh(cached, source):
+            return cached
+        from curl_cffi.requests.exceptions import Timeout, ConnectionError as RequestConnectionError
+        limiter = get_limiter(url)
+        attempt = 0
+        while True:
+            try:
+                response = await self.send(limiter, method, url, headers, json_body)
+            except (RequestConnectionError, Timeout) as err:
+                metrics.increment('http_requests_total', host=limiter.host, status=type(err).__name__)
+                delay = should_retry(url, attempt, self.max_retries, error=err)
+                if delay is None:
+                    raise
+            else:
+                metrics.increment('http_requests_total', host=limiter.host, status=response.status_code)
+                delay = should_retry(url, attempt, self.max_retries, response=response)
+                if delay is None:
+                    if response.status_code < 400:
+                        limiter.record_success()
+                    return finish_cached_request(self.cache, key, cached, source, response)
+            await asyncio.sleep(delay)
+            attempt += 1
+
+    async def send(self, limiter, method, url, headers, json_body):
+        """
+        Send a single request once its host has a free slot and a token.
+
+        Args:
+            limiter (HostLimiter): The limiter of the host.
+            method (str): The HTTP method.
+            url (str): The URL to request.
+            headers (dict): The request headers.
+            json_body (dict): The JSON body to send, if any.
+
+        Returns:
+            curl_cffi.requests.Response: The response, whatever its status code.
+        """
+        condition = self.host_conditions.setdefault(limiter.host, asyncio.Condition())
+        async with condition:
+            await condition.wait_for(lambda: self.in_flight.get(limiter.host, 0) < int(limiter.limit))
+            self.in_flight[limiter.host] = self.in_flight.get(limiter.host, 0) + 1
+        try:
+            await asyncio.sleep(limiter.reserve())
+            async with self.semaphore:
+                with metrics.timer('http_request_seconds', host=limiter.host):
+                    return await self.get_session(url).request(method, url, headers=headers, json=json_body)
+        finally:
+            async with condition:
+                self.in_flight[limiter.host] -= 1
+                # Only wake as many waiters as there are free slots, waking all of them is quadratic on long queues
+                condition.notify(max(1, int(limiter.limit) - self.in_flight[limiter.host]))
+
+    def map_unordered(self, function, keys):
+        """
+        Run an async lookup for every key, yielding the tasks as they complete.
+
+        Args:
+            function (callable): An async function taking a key and this engine.
+            keys (iterable): The keys to look up.
+
+        Yields:
+            tuple: (key, task) for each completed lookup. Calling task.result()
+                returns the result or raises the exception of the lookup.
+        """
+        return self.iter_completed({self.submit(function, key): key for key in keys})
+
+    def submit(self, function, key):
+        """
+        Schedule an async lookup without waiting for it.
+
+        The lookup makes progress whenever the event loop runs, for example while
+        another map_unordered or map_pipeline is being iterated, so independent
+        lookups can overlap.
+
+        Args:
+            function (callable): An async function taking a key and this engine.
+            key (object): The key to look up.
+
+        Returns:
+            asyncio.Task: The task of the lookup.
+        """
+        return self.loop.create_task(function(key, self))
+
+    def iter_completed(self, tasks):
+        """
+        Yield scheduled lookups as they complete, cancelling the rest if the caller stops early.
+
+        Args:
+            tasks (dict): Maps the tasks of the lookups to their keys.
+
+        Yields:
+            tuple: (key, task) for each completed lookup. Calling task.result()
+                returns the result or raises the exception of the lookup.
+        """
+        pending = set(tasks)
+        try:
+            while pending:
+                done, pending = self.loop.run_until_complete(asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED))
+                for task in done:
+                    yield tasks[task], task
+        finally:
+            for task in pending:
+                task.cancel()
+            if pending:
+                self.loop.run_until_complete(asyncio.gather(*pending, return_exceptions=True))
+
+    def map_pipeline(self, fetch_function, parse_function, keys, executor, parse_workers=DEFAULT_PARSE_WORKERS, queue_size=None):
+        """
+        Fetch every key on the event loop and parse the responses in an executor, yielding results as they complete.
+
+        Fetch workers only fetch raw content and hand it to the parse workers
+        through a bounded queue. Once the queue is full the fetch workers wait,
+        so pages are never fetched much faster than they can be parsed. With a
+        ProcessPoolExecutor the parsing runs on every core instead of competing
+        for the GIL with the event loop.
+
+        Args:
+            fetch_function (callable): An async function taking a key and this engine, returning the raw content.
+            parse_function (callable): A picklable function taking a key and its raw content, returning the result.
+            keys (iterable): The keys to look up.
+            executor (concurrent.futures.Executor): The executor to parse in.
+            parse_workers (int): The number of parses submitted to the executor at once.
+            queue_size (int): The number of fetched pages allowed to wait for a parse worker, twice the concurrency by default.
+
+        Yields:
+            tuple: (key, future) for each completed lookup. Calling future.result()
+                returns the parsed result or raises the exception of the fetch or parse.
+        """
+        keys = iter(keys)
+        pages = asyncio.Queue(queue_size or 2 * self.concurrency)
+        results = asyncio.Queue()
+
+        async def fetch_worker():
+            # Every worker pulls from the same key iterator, so each key is fetched once
+            for key in keys:
+                try:
+                    content = await fetch_function(key, self)
+                except Exception as exc:
+                    future = self.loop.create_future()
+                    future.set_exception(exc)
+                    await results.put((key, future))
+                    continue
+                await pages.put((key, content))
+
+        async def parse_worker():
+            while True:
+                item = await pages.get()
+                if item is None:
+                    return
+                key, content = item
+                future = self.loop.create_future()
+                try:
+                    with metrics.timer('parse_seconds', function=parse_function.__name__):
+                        future.set_result(await self.loop.run_in_executor(executor, parse_function, key, content))
+                except Exception as exc:
+                    future.set_exception(exc)
+                await results.put((key, future))
+
+        async def run():
+            parsers = [asyncio.ensure_future(parse_worker()) for _ in range(parse_workers)]
+            try:
+                await asyncio.gather(*(fetch_worker() for _ in range(self.concurrency)))
+                for _ in parsers:
+                    await pages.put(None)
+                await asyncio.gather(*parsers)
+            finally:
+                for parser in parsers:
+                    parser.cancel()
+                await results.put(None)
+
+        runner = self.loop.create_task(run())
+        try:
+            while True:
+                item = self.loop.run_until_complete(results.get())
+                if item is None:
+                    break
+                yield item
+            self.loop.run_until_complete(runner)
+        finally:
+            if not runner.done():
+                runner.cancel()
+                self.loop.run_until_complete(asyncio.gather(runner, return_exceptions=True))
+            # Mark the errors of results that were never handed out as retrieved
+            while not results.empty():
+                item = results.get_nowait()
+                if item is not None:
+                    item[1].exception()
+
+    def cancel_pending(self):
+        """Cancel the lookups still running, for example those left behind by a failed run, keeping the sessions open."""
+        pending = asyncio.all_tasks(self.loop)
+        for task in pending:
+            task.cancel()
+        if pending:
+            self.loop.run_until_complete(asyncio.gather(*pending, return_exceptions=True))
+
+    def close(self):
+        """Cancel the lookups still running, and close all of the async sessions and the event loop."""
+        if self.loop.is_closed():
+            return
+        self.cancel_pending()
+        for session in self.sessions.values():
+            self.loop.run_until_complete(session.close())
+        self.sessions.clear()
+        self.loop.close()
@@ -0,0 +1,300 @@
+"""
+Response Cache.
+
+This module provides the ResponseCache class, an on-disk cache of raw HTTP
+responses that sits underneath the request modules. Entries are keyed by the
+request method, URL and body, expire after a time-to-live that depends on the
+source they came from, and are revalidated with conditional requests when the
+server gave us an ETag or Last-Modified header. The least recently used entries
+are evicted once the cache grows above its size cap.
+"""
+
+import json
+import time
+import sqlite3
+import hashlib
+import logging
+import threading
+
+DEFAULT_CACHE_FILE = 'http_cache.db'
+
+# Default size cap of the cache, in bytes
+DEFAULT_MAX_BYTES = 256 * 1024 * 1024
+
+DAY = 24 * 60 * 60
+
+# Time-to-live of a cached response, in seconds, per source
+DEFAULT_TTLS = {
+    'bricklink_catalog': 30 * DAY,  # Catalog colors and element IDs rarely change
+    'bricklink_store_lot': 1 * DAY,  # Store lot prices change daily
+    'lego_store': 1 * DAY,  # Pick-a-Brick prices and availability change daily
+}
+
+# Sources answering GraphQL, whose 200 responses may still carry errors or null fields
+GRAPHQL_SOURCES = {'lego_store'}
+
+
+class CachedResponse:
+    """
+    A response served from the cache.
+
+    Offers the parts of the curl_cffi response interface used by the request modules.
+
+    Attributes:
+        url (str): The URL of the request.
+        status_code (int): The HTTP status code.
+        content (bytes): The body of the response.
+        etag (str): The ETag header of the response, if any.
+        last_modified (str): The Last-Modified header of the response, if any.
+        fetched_at (float): When the response was last fetched or revalidated.
+    """
+
+    def __init__(self, url, status_code, content, etag, last_modified, fetched_at):
+        """
+        Initialize the CachedResponse.
+
+        Args:
+            url (str): The URL of the request.
+            status_code (int): The HTTP status code.
+            content (bytes): The body of the response.
+            etag (str): The ETag header of the response, if any.
+            last_modified (str): The Last-Modified header of the response, if any.
+            fetched_at (float): When the response was last fetched or revalidated.
+        """
+        self.url = url
+        self.status_code = status_code
+        self.content = content
+        self.etag = etag
+        self.last_modified = last_modified
+        self.fetched_at = fetched_at
+
+    @property
+    def text(self):
+        """str: The body of the response, decoded as UTF-8."""
+        return self.content.decode('utf-8', errors='replace')
+
+    def json(self):
+        """
+        Decode the body of the response as JSON.
+
+        Returns:
+            object: The decoded JSON data.
+        """
+        return json.loads(self.content)
+
+    def raise_for_status(self):
+        """Do nothing, only successful responses are cached."""
+
+
+class ResponseCache:
+    """
+    Manages the on-disk cache of raw HTTP responses.
+
+    The cache may be used from several threads, so every access goes through a lock.
+
+    Attributes:
+        connection (sqlite3.Connection): The database connection.
+        max_bytes (int): The size cap of the cache, in bytes.
+        ttls (dict): Maps sources to their time-to-live, in seconds.
+        total_bytes (int): The current size of the cached bodies, in bytes.
+    """
+
+    def __init__(self, cache_filename=DEFAULT_CACHE_FILE, max_bytes=DEFAULT_MAX_BYTES, ttls=None):
+        """
+        Initialize the ResponseCache.
+
+        Args:
+            cache_filename (str): The filename of the SQLite cache database.
+            max_bytes (int): The size cap of the cache, in bytes.
+            ttls (dict): Overrides for the time-to-live of each source, in seconds.
+        """
+        self.connection = sqlite3.connect(cache_filename, check_same_thread=False)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('''CREATE TABLE IF NOT EXISTS responses (
+            key TEXT NOT NULL PRIMARY KEY,
+            url TEXT NOT NULL,
+            source TEXT NOT NULL,
+            status_code INTEGER NOT NULL,
+            content BLOB NOT NULL,
+            etag TEXT,
+            last_modified TEXT,
+            size INTEGER NOT NULL,
+            fetched_at REAL NOT NULL,
+            accessed_at REAL NOT NULL
+        )''')
+        self.connection.execute('CREATE INDEX IF NOT EXISTS responses_accessed_at ON responses (accessed_at)')
+        self.connection.commit()
+        self.max_bytes = max_bytes
+        self.ttls = dict(DEFAULT_TTLS, **(ttls or {}))
+        self.total_bytes = self.connection.execute('SELECT COALESCE(SUM(size), 0) FROM responses').fetchone()[0]
+        self._lock = threading.Lock()
+        logging.debug("[Cache] Opened %s holding %s bytes", cache_filename, self.total_bytes)
+
+    @staticmethod
+    def make_key(method, url, json_body=None):
+        """
+        Build the cache key of a request.
+
+        Args:
+            method (str): The HTTP method.
+            url (str): The URL of the request.
+            json_body (dict): The JSON body of the request, if any.
+
+        Returns:
+            str: The cache key.
+        """
+        body = json.dumps(json_body, sort_keys=True) if json_body is not None else ''
+        return hashlib.sha256(f"{method.upper()} {url}\n{body}".encode('utf-8')).hexdigest()
+
+    def get(self, key):
+        """
+        Look up a cached response and mark it as recently used.
+
+        Args:
+            key (str): The cache key.
+
+        Returns:
+            CachedResponse: The cached response, or None if there is none.
+        """
+        with self._lock:
+            row = self.connection.execute('SELECT url, status_code, content, etag, last_modified, fetched_at FROM responses WHERE key = ?',
+                                          (key,)).fetchone()
+            if row is None:
+                return None
+            self.connection.execute('UPDATE responses SET accessed_at = ? WHERE key = ?', (time.time(), key))
+            self.connection.commit()
+        return CachedResponse(*row)
+
+    def is_fresh(self, cached, source):
+        """
+        Check whether a cached response is still within the time-to-live of its source.
+
+        Args:
+            cached (CachedResponse): The cached response.
+            source (str): The source the response came from.
+
+        Returns:
+            bool: True if the response can be served without revalidating it.
+        """
+        return time.time() - cached.fetched_at < self.ttls.get(source, 0)
+
+    @staticmethod
+    def conditional_headers(cached):
+        """
+        Build the headers of a conditional request revalidating a cached response.
+
+        Args:
+            cached (CachedResponse): The cached response.
+
+        Returns:
+            dict: The If-None-Match and If-Modified-Since headers that apply.
+        """
+        headers = {}
+        if cached.etag:
+            headers['If-None-Match'] = cached.etag
+        if cached.last_modified:
+            headers['If-Modified-Since'] = cached.last_modified
+        return headers
+
+    @staticmethod
+    def is_cacheable(source, response):
+        """
+        Check whether a successful response is complete enough to cache.
+
+        A GraphQL response with errors, or with a null field such as an aliased
+        search that failed, is not cached, so its lookups are requested again
+        instead of being served the failure until it expires.
+
+        Args:
+            source (str): The source the response came from.
+            response (curl_cffi.requests.Response): The response.
+
+        Returns:
+            bool: True if the response may be cached.
+        """
+        if source not in GRAPHQL_SOURCES:
+            return True
+        try:
+            response_json = json.loads(response.content)
+        except ValueError:
+            return False
+        if not isinstance(response_json, dict) or response_json.get('errors'):
+            return False
+        data = response_json.get('data')
+        return isinstance(data, dict) and None not in data.values()
+
+    def store(self, key, source, response):
+        """
+        Cache a successful response.
+
+        Args:
+            key (str): The cache key.
+            source (str): The source the response came from.
+            response (curl_cffi.requests.Response): The response.
+
+        Returns:
+            CachedResponse: The cached copy of the response.
+        """
+        now = time.time()
+        cached = CachedResponse(response.url, response.status_code, response.content,
+                                response.headers.get('ETag'), response.headers.get('Last-Modified'), now)
+        size = len(cached.content)
+        with self._lock:
+            previous = self.connection.execute('SELECT size FROM responses WHERE key = ?', (key,)).fetchone()
+            self.connection.execute('INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                                    (key, cached.url, source, cached.status_code, cached.content,
+                                     cached.etag, cached.last_modified, size, now, now))
+            self.total_bytes += size - (previous[0] if previous else 0)
+            self._evict()
+            self.connection.commit()
+        logging.debug("[Cache] Stored %s bytes for %s", size, cached.url)
+        return cached
+
+    def revalidate(self, key, cached, response):
+        """
+        Mark a cached response as fresh again after the server answered 304 Not Modified.
+
+        Args:
+            key (str): The cache key.
+            cached (CachedResponse): The cached response.
+            response (curl_cffi.requests.Response): The 304 response.
+
+        Returns:
+            CachedResponse: The revalidated cached response.
+        """
+        cached.fetched_at = time.time()
+        cached.etag = response.headers.get('ETag') or cached.etag
+        cached.last_modified = response.headers.get('Last-Modified') or cached.last_modified
+        with self._lock:
+            self.connection.execute('UPDATE responses SET fetched_at = ?, etag = ?, last_modified = ? WHERE key = ?',
+                                    (cached.fetched_at, cached.etag, cached.last_modified, key))
+            self.connection.commit()
+        logging.debug("[Cache] Revalidated %s", cached.url)
+        return cached
+
+    def _evict(self):
+        """Evict the least recently used responses until the cache is back under its size cap."""
+        if self.total_bytes <= self.max_bytes:
+            return
+        evicted = 0
+        rows = self.connection.execute('SELECT key, size FROM responses ORDER BY accessed_at').fetchall()
+        for key, size in rows:
+            if self.total_bytes <= self.max_bytes:
+                break
+            self.connection.execute('DELETE FROM responses WHERE key = ?', (key,))
+            self.total_bytes -= size
+            evicted += 1
+        logging.debug("[Cache] Evicted %s least recently used responses", evicted)
+
+    def clear(self):
+        """Remove every cached response."""
+        with self._lock:
+            self.connection.execute('DELETE FROM responses')
+            self.connection.commit()
+            self.total_bytes = 0
+        logging.warning("[Cache] Cleared HTTP response cache.")
+
+    def close(self):
+        """Close the cache database connection."""
+        with self._lock:
+            self.connection.close()
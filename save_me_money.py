@@ -5,253 +5,250 @@ Reduce the cost of a BrickLink cart set by checking parts against LEGO Pick-a-Br
 """
 
 import os
-import sys
-import time
 import logging
 import argparse
+import metrics
 from database import *
 from parse import parse_cart
+from records import Part, PickABrickLot, QuantityAccumulator, LotDecision
+from log_setup import setup_logger, get_level, summarize, TRACE
 from export import export_csv
 from export import export_xml
 from datetime import datetime
 from export import export_cart
-from request_bricklink import get_color_dict_for_part
-from request_bricklink_cart import get_part_and_price_for_lot
-from request_lego_store import get_lego_store_result_for_element_id
+from export import export_decisions
+from request_session import FetchEngine, open_parse_pool, DEFAULT_CONCURRENCY, DEFAULT_PARSE_WORKERS
+from response_cache import ResponseCache, DEFAULT_CACHE_FILE
+from request_bricklink import get_webpage_for_part_async, parse_color_dict_from_page
+from import_catalog import import_catalog
+from journal import RunJournal
+from lookups import get_part_and_price_for_cart_lot_async, insert_store_lots, insert_designs, insert_element_ids
+from request_lego_store import get_lego_store_results_for_element_ids_async, split_into_batches
 
 
-def setup_logger(log_file, debug):
+def split_cart(input_cart_file, database, engine, journal, parse_workers=DEFAULT_PARSE_WORKERS, parse_pool=None):
     """
-    Configure and return a logger instance.
+    Run Steps 0 to 8 on a BrickLink cart file, writing the cheaper BrickLink cart and the LEGO order next to it.
 
     Args:
-        log_file (str): The path to the log file.
+        input_cart_file (str): Path to the BrickLink cart file.
+        database (DatabaseManager): The database to cache the lookups in.
+        engine (request_session.FetchEngine): The engine to make the requests with.
+        journal (journal.RunJournal): The journal recording the progress of the run.
+        parse_workers (int): Number of processes parsing BrickLink catalog pages.
+        parse_pool (concurrent.futures.ProcessPoolExecutor): A running pool to parse the catalog pages in, instead of a new one.
 
     Returns:
-        logging.Logger: Configured logger instance.
+        int: The number of lots in the cart.
     """
-    log_dir = os.path.dirname(log_file)
-    if not os.path.exists(log_dir):
-        os.makedirs(log_dir)
-
-    logger = logging.getLogger()
-    logger.setLevel(logging.DEBUG if debug else logging.INFO)
-
-    # File handler
-    file_handler = logging.FileHandler(log_file)
-    file_handler.setLevel(logging.DEBUG if debug else logging.INFO)
-    file_handler.setFormatter(logging.Formatter('%(asctime)s [%(levelname)s] %(message)s'))
-
-    # Stream handler (stdout)
-    stream_handler = logging.StreamHandler(sys.stdout)
-    stream_handler.setLevel(logging.DEBUG if debug else logging.INFO)
-    stream_handler.setFormatter(logging.Formatter('%(asctime)s [%(levelname)s] %(message)s'))
-
-    # Add handlers to the logger
-    logger.addHandler(file_handler)
-    logger.addHandler(stream_handler)
-
-    return logger
-
-
-def process_cart_file(input_cart_file, log_dir, database_file, skip_purge, debug):
-    input_basename = os.path.splitext(os.path.basename(input_cart_file))[0]
-    timestamp = datetime.now().strftime("%Y%m%d-%H%M%S")
-    logfile_name = os.path.join(log_dir, f'save_me_money_{input_basename}_{timestamp}.txt')
-
-    logger = setup_logger(logfile_name, debug)
-
-    database = DatabaseManager(database_file, logger)
-
-    # Don't actually process files if purge is requested
-    if not skip_purge:
-        database.purge_bricklink_store_lots()
-        logging.info("Purged all BrickLink store lots")
-
     # Step 0 - Parse input BrickLink cart file
-    cart_lots = parse_cart(input_cart_file)
-    logging.info(f"Step 0 complete - Parsed {len(cart_lots)} lots from {input_cart_file}: {cart_lots}")
+    with metrics.timer('step_seconds', step='0'):
+        cart_lots = parse_cart(input_cart_file)
+    logging.info("Step 0 complete - Parsed lots from %s %s", input_cart_file, summarize(cart_lots))
+    logging.log(TRACE, "Step 0 cart lots: %s", cart_lots)
 
-    # Step 1 - Find out which store and lot IDs need to be requested from BrickLink
-    request_cart_lots = {(cart['store_id'], cart['lot_id']) for cart in cart_lots if not database.get_bricklink_cart_entry_by_store_and_lot_id(cart['store_id'], cart['lot_id'])}
+    # Step 1 - Find out which store and lot IDs need to be requested from BrickLink (missing or stale)
+    cart_store_lots = {cart.key for cart in cart_lots}
+    with metrics.timer('step_seconds', step='1'):
+        request_cart_lots = journal.get_keys('2', lambda: database.get_missing_store_lots(cart_store_lots))
     logging.info(f"Step 1 complete - Found {len(request_cart_lots)} new lots to request from BrickLink")
     
-    # Step 2 - Make all the requests sequentially and insert the entries into the database
-    start_time = time.time()
-    database_insertions = 0
-    total_lots = len(request_cart_lots)
-    for i, (store_id, lot_id) in enumerate(request_cart_lots, 1):
-        logging.info(f"Lot {i}/{total_lots}")
-        try:
-            design_id, color_code, price, type = get_part_and_price_for_lot(store_id, lot_id)
-            database.insert_bricklink_cart_entry(store_id, lot_id, price, design_id, color_code, type)
-            database_insertions += 1
-        except Exception as e:
-            logging.error(f"Exception raised for {store_id}, {lot_id}: {e}")
-    database.commit_changes()
-    end_time = time.time()
-    elapsed_time = end_time - start_time
-    minutes, seconds = divmod(int(elapsed_time), 60)
-    logging.info(f"Step 2 complete - Inserted {database_insertions} new lots in {minutes} minutes and {seconds} seconds")
+    # Step 2 - Make all the requests concurrently and insert the entries into the database as they arrive
+    step_timer = metrics.timer('step_seconds', step='2')
+    database_insertions = insert_store_lots(database, journal, '2', engine.map_unordered(get_part_and_price_for_cart_lot_async, request_cart_lots))
+    logging.info(f"Step 2 complete - Inserted {database_insertions} new lots in {metrics.format_duration(step_timer.stop())}")
 
     # Step 3 - Find out which design and color IDs need to be requested from BrickLink (API exists)
-    request_design_ids = set()
-    for cart_lot in cart_lots:
-        bricklink_data = database.get_bricklink_cart_entry_by_store_and_lot_id(cart_lot['store_id'], cart_lot['lot_id'])
-        if bricklink_data:
-            design_id = bricklink_data[3]
-            color_code = bricklink_data[4]
-            if not database.get_bricklink_entry_by_design_id(design_id):
-                request_design_ids.add(design_id)
-    logging.info(f"Step 3 complete - request design IDs (length {len(request_design_ids)}): {request_design_ids}")
+    with metrics.timer('step_seconds', step='3'):
+        cart_design_ids = {design_id for (_, _, _, design_id, _, _) in database.get_bricklink_cart_entries_by_store_and_lot_ids(cart_store_lots).values()}
+        request_design_ids = journal.get_keys('4', lambda: database.get_missing_design_ids(cart_design_ids))
+    logging.info("Step 3 complete - request design IDs %s", summarize(request_design_ids))
+    logging.log(TRACE, "Step 3 request design IDs: %s", request_design_ids)
     
-    # Step 4 - Make all the requests sequentially and insert the entries into the database
-    start_time = time.time()
-    database_insertions = 0
-    total_designs = len(request_design_ids)
-    for i, design_id in enumerate(request_design_ids, 1):
-        logging.info(f"Design {i}/{total_designs}")
-        try:
-            data = get_color_dict_for_part(design_id)
-            for color_code, element_id_list in data.items():
-                for element_id in element_id_list:
-                    database.insert_bricklink_entry(element_id, design_id, color_code)
-                    database_insertions += 1
-        except Exception as exc:
-            logging.error(f"Step 3 - Design ID {design_id} generated an exception: {exc}")
-    database.commit_changes()
-    end_time = time.time()
-    elapsed_time = end_time - start_time
-    minutes, seconds = divmod(int(elapsed_time), 60)
-    logging.info(f"Step 4 complete - Inserted {database_insertions} new design IDs in {minutes} minutes and {seconds} seconds")
+    # Step 4 - Make all the requests concurrently and insert the entries into the database as they arrive
+    step_timer = metrics.timer('step_seconds', step='4')
+    with open_parse_pool(parse_workers, parse_pool) as parse_pool:
+        database_insertions = insert_designs(database, journal, '4', engine.map_pipeline(
+            get_webpage_for_part_async, parse_color_dict_from_page, request_design_ids, parse_pool, parse_workers))
+    logging.info(f"Step 4 complete - Inserted {database_insertions} new design IDs in {metrics.format_duration(step_timer.stop())}")
     
     # Step 5 - Find out which element IDs need to be requested from LEGO (API exists)
-    master_element_ids = set()
-    for cart_lot in cart_lots:
-        element_ids = [element_id for element_id in database.match_bricklink_cart_entries_to_element_ids(cart_lot['store_id'], cart_lot['lot_id'])]
-        master_element_ids.update(element_ids)
-    request_element_ids = {element_id[0] for element_id in master_element_ids if not database.get_lego_store_entry_by_element_id(element_id[0])}
-    logging.info(f"Step 5 complete - Master element IDs (length {len(master_element_ids)}): {master_element_ids}")
-    logging.info(f"Step 5 complete - Request element IDs (length {len(request_element_ids)}): {request_element_ids}")
-    
-    # Step 6 - Make all the requests sequentially and insert the entries into the database
-    start_time = time.time()
-    database_insertions = 0
-    total_elements = len(request_element_ids)
-    for i, element_id in enumerate(request_element_ids, 1):
-        logging.info(f"Element {i}/{total_elements}")
-        try:
-            data = get_lego_store_result_for_element_id(element_id)
-            if data is None:
-                database.insert_lego_store_entry(element_id, lego_sells=False, bestseller=None, price=None, max_order_quantity=None)
-                database_insertions += 1
-            else:
-                if data['deliveryChannel'] not in ['pab', 'bap']:
-                    raise ValueError(f"Invalid delivery channel: {data['deliveryChannel']}")
-                database.insert_lego_store_entry(element_id,
-                                                 lego_sells=True,
-                                                 bestseller=(data['deliveryChannel'] == 'pab'),
-                                                 price=data['price']['formattedAmount'],
-                                                 max_order_quantity=data['maxOrderQuantity'])
-                database_insertions += 1
-        except Exception as exc:
-            logging.error(f"Step 6 - Element ID {element_id} generated an exception: {exc}")
-    database.commit_changes()
-    end_time = time.time()
-    elapsed_time = end_time - start_time
-    minutes, seconds = divmod(int(elapsed_time), 60)
-    logging.info(f"Step 6 complete - database insertions: {database_insertions}, time taken: {minutes} minutes and {seconds} seconds")
+    with metrics.timer('step_seconds', step='5'):
+        master_element_ids = database.get_element_ids_by_store_and_lot_ids(cart_store_lots)
+        request_element_ids = journal.get_keys('6', lambda: database.get_missing_element_ids(master_element_ids))
+    logging.info("Step 5 complete - Master element IDs %s", summarize(master_element_ids))
+    logging.info("Step 5 complete - Request element IDs %s", summarize(request_element_ids))
+    logging.log(TRACE, "Step 5 master element IDs: %s", master_element_ids)
+    logging.log(TRACE, "Step 5 request element IDs: %s", request_element_ids)
     
+    # Step 6 - Make all the batched requests concurrently and insert the entries into the database as they arrive
+    step_timer = metrics.timer('step_seconds', step='6')
+    database_insertions = insert_element_ids(database, journal, '6', engine.map_unordered(
+        get_lego_store_results_for_element_ids_async, split_into_batches(request_element_ids)))
+    logging.info(f"Step 6 complete - database insertions: {database_insertions}, time taken: {metrics.format_duration(step_timer.stop())}")
+
+    # Steps 7 and 8 - Compare the prices and export the split cart
+    compare_and_export_cart(input_cart_file, cart_lots, database, journal)
+    return len(cart_lots)
+
+
+def compare_and_export_cart(input_cart_file, cart_lots, database, journal):
+    """
+    Run Steps 7 and 8, choosing BrickLink or LEGO for every lot of a cart from the database and exporting the split cart.
+
+    Args:
+        input_cart_file (str): Path to the BrickLink cart file. The output files are written next to it.
+        cart_lots (list of CartLot): The lots of the cart, looked up already. A lot whose lookup failed is kept in the BrickLink cart.
+        database (DatabaseManager): The database holding the lookups.
+        journal (journal.RunJournal): The journal recording the progress of the run.
+    """
+    cart_store_lots = {cart.key for cart in cart_lots}
+
     # Step 7 - Do the triple join, and find all rows that have a bricklink store entry and at least one lego store entry
+    journal.begin_step('7')
+    step_timer = metrics.timer('step_seconds', step='7')
+    cart_entries = database.get_bricklink_cart_entries_by_store_and_lot_ids(cart_store_lots)
     final_bricklink_lots = []
-    final_bricklink_partslist = []
-    final_lego_lots = []
+    final_bricklink_partslist = QuantityAccumulator()
+    final_lego_lots = QuantityAccumulator()
+    decisions = []
     for cart_lot in cart_lots:
-        # The code `price_compare` appears to be a function or variable name in Python. However,
-        # without seeing the actual implementation of the `price_compare` function or variable, it is
-        # not possible to determine exactly what it is doing. If you provide more context or the
-        # implementation of the `price_compare` function, I can help explain its functionality.
-        price_compare = [row for row in database.compare_prices_for_lot(cart_lot['store_id'], cart_lot['lot_id']) if row[1] is not None]
-        # print(f"Cart lot with store id {cart_lot['store_id']} and lot id {cart_lot['lot_id']} has price compare of size {len(price_compare)}: {price_compare}")
-        price_compare_value = None
-        if len(price_compare) == 0:
+        cart_entry = cart_entries.get(cart_lot.key)
+        if cart_entry is None:
+            # Step 2 could not look the lot up, so keep it in the BrickLink cart as it is
+            logging.warning(f"No BrickLink store lot for store ID {cart_lot.store_id} and lot ID {cart_lot.lot_id}, keeping it in the BrickLink cart")
+            decisions.append(LotDecision(cart_lot, 'bricklink', "BrickLink lookup failed"))
             final_bricklink_lots.append(cart_lot)
-            (_, _, _, design_id, color_code, type) = database.get_bricklink_cart_entry_by_store_and_lot_id(cart_lot['store_id'], cart_lot['lot_id'])
-            merged = False
-            for part in final_bricklink_partslist:
-                if part['design_id'] == design_id and part['color_id'] == color_code:
-                    part['quantity'] = str(int(cart_lot['quantity']) + int(part['quantity']))
-                    logger.info(f"Adding design ID {design_id} and color code {color_code} and quantity {cart_lot['quantity']} to existing part in BrickLink partslist")
-                    merged = True
-                    break
-            if not merged:
-                final_bricklink_partslist.append({
-                    'design_id': design_id,
-                    'color_id': color_code,
-                    'quantity': cart_lot['quantity'],
-                    'type': type,
-                })
-                logger.info(f"Adding design ID {design_id} and color code {color_code} and quantity {cart_lot['quantity']} to new part in BrickLink partslist")
-            logger.info(f"Choosing BrickLink price, adding to BrickLink cart: {cart_lot}")
             continue
+        (_, _, bricklink_price, design_id, color_code, type) = cart_entry
+        price_compare = [row for row in database.compare_prices_for_lot(*cart_lot.key) if row[1] is not None]
+        price_compare_value = None
+        if len(price_compare) == 0:
+            reason = "LEGO does not sell this part"
         elif len(price_compare) == 1:
             price_compare_value = price_compare[0]
-            logger.info(f"LEGO option for cart lot with store id {cart_lot['store_id']} and lot id {cart_lot['lot_id']}: {price_compare_value}")
+            logging.debug("LEGO option for cart lot with store id %s and lot id %s: %s", cart_lot.store_id, cart_lot.lot_id, price_compare_value)
         elif len(price_compare) == 2:
-            logger.info(f"Two LEGO options for cart lot with store id {cart_lot['store_id']} and lot id {cart_lot['lot_id']}: {price_compare}")
+            logging.debug("Two LEGO options for cart lot with store id %s and lot id %s: %s", cart_lot.store_id, cart_lot.lot_id, price_compare)
             if price_compare[0][1] <= price_compare[1][1]:
                 price_compare_value = price_compare[0]
             else:
                 price_compare_value = price_compare[1]
-            logger.info(f"Choosing option: {price_compare_value}")
+            logging.debug("Choosing option: %s", price_compare_value)
         else:
-            raise AssertionError(f"More than two LEGO options for cart lot with store id {cart_lot['store_id']} and lot id {cart_lot['lot_id']}: {price_compare}")
-        if price_compare_value[1] > price_compare_value[2]:
-            final_bricklink_lots.append(cart_lot)
-            (_, _, _, design_id, color_code, type) = database.get_bricklink_cart_entry_by_store_and_lot_id(cart_lot['store_id'], cart_lot['lot_id'])
-            merged = False
-            for part in final_bricklink_partslist:
-                if part['design_id'] == design_id and part['color_id'] == color_code:
-                    part['quantity'] = str(int(cart_lot['quantity']) + int(part['quantity']))
-                    logger.info(f"Adding design ID {design_id} and color code {color_code} and quantity {cart_lot['quantity']} to existing part in BrickLink partslist")
-                    merged = True
-                    break
-            if not merged:
-                final_bricklink_partslist.append({
-                    'design_id': design_id,
-                    'color_id': color_code,
-                    'quantity': cart_lot['quantity'],
-                    'type': type,
-                })
-                logger.info(f"Adding design ID {design_id} and color code {color_code} and quantity {cart_lot['quantity']} to new part in BrickLink partslist")
-            logger.info(f"Choosing BrickLink price, adding to BrickLink cart: {cart_lot}")
+            raise AssertionError(f"More than two LEGO options for cart lot with store id {cart_lot.store_id} and lot id {cart_lot.lot_id}: {price_compare}")
+
+        if price_compare_value is not None and price_compare_value[1] <= price_compare_value[2]:
+            element_id, lego_price, _ = price_compare_value
+            reason = f"LEGO price {lego_price:.2f} is not more than BrickLink price {bricklink_price:.2f}"
+            decisions.append(LotDecision(cart_lot, 'lego', reason, element_id, lego_price, bricklink_price))
+            merged = final_lego_lots.add(element_id, cart_lot.quantity, lambda: PickABrickLot(element_id, cart_lot.quantity))
+            logging.debug("Adding element ID %s and quantity %d to %s part in LEGO list (%s)",
+                          element_id, cart_lot.quantity, 'existing' if merged else 'new', reason)
+            continue
+
+        if price_compare_value is not None:
+            element_id, lego_price, _ = price_compare_value
+            reason = f"LEGO price {lego_price:.2f} is more than BrickLink price {bricklink_price:.2f}"
+            decisions.append(LotDecision(cart_lot, 'bricklink', reason, element_id, lego_price, bricklink_price))
         else:
-            merged = False
-            for lot in final_lego_lots:
-                if lot['elementId'] == price_compare_value[0]:
-                    lot['quantity'] = str(int(cart_lot['quantity']) + int(lot['quantity']))
-                    logger.info(f"Adding element ID {price_compare_value[0]} and quantity {cart_lot['quantity']} to existing part in LEGO list")
-                    merged = True
-                    break
-            if not merged:
-                final_lego_lots.append({
-                    'elementId': price_compare_value[0],
-                    'quantity': cart_lot['quantity'],
-                })
-                logger.info(f"Adding element ID {price_compare_value[0]} and quantity {cart_lot['quantity']} to new part in LEGO list")
-    final_bricklink_lots = sorted(final_bricklink_lots, key=lambda x: (x['store_id'], x['lot_id']))
-    logger.info(f"Step 7 complete - Final BrickLink lots (size {len(final_bricklink_lots)}): {final_bricklink_lots}")
-    logger.info(f"Step 7 complete - Final LEGO lots (size {len(final_lego_lots)}): {final_lego_lots}")
+            decisions.append(LotDecision(cart_lot, 'bricklink', reason, bricklink_price=bricklink_price))
+        final_bricklink_lots.append(cart_lot)
+        merged = final_bricklink_partslist.add((design_id, color_code), cart_lot.quantity, lambda: Part(type, design_id, color_code, cart_lot.quantity))
+        logging.debug("Adding design ID %s and color code %s and quantity %d to %s part in BrickLink partslist",
+                     design_id, color_code, cart_lot.quantity, 'existing' if merged else 'new')
+        logging.debug("Choosing BrickLink price, adding to BrickLink cart: %s (%s)", cart_lot, reason)
+    final_bricklink_lots = sorted(final_bricklink_lots, key=lambda x: x.key)
+    final_bricklink_partslist = final_bricklink_partslist.values()
+    final_lego_lots = final_lego_lots.values()
+    logging.info("Step 7 complete - Final BrickLink lots %s", summarize(final_bricklink_lots))
+    logging.info("Step 7 complete - Final LEGO lots %s", summarize(final_lego_lots))
+    logging.log(TRACE, "Step 7 final BrickLink lots: %s", final_bricklink_lots)
+    logging.log(TRACE, "Step 7 final LEGO lots: %s", final_lego_lots)
+    step_timer.stop()
+    for decision in decisions:
+        metrics.increment('lots_total', destination=decision.destination)
     
     # Step 8 - Export final BrickLink cart file and LEGO Pick-A-Brick CSV file
+    journal.begin_step('8')
+    step_timer = metrics.timer('step_seconds', step='8')
     basename = os.path.splitext(input_cart_file)[0]
     bricklink_output_file = f"{basename}_updated_bricklink_cart.cart"
     lego_output_file = f"{basename}_lego_cart.csv"
     bricklink_partslist_file = f"{basename}_bricklink_partslist.xml"
+    decisions_file = f"{basename}_decisions.csv"
     export_cart(final_bricklink_lots, bricklink_output_file)
     export_csv(final_lego_lots, lego_output_file)
     export_xml(final_bricklink_partslist, bricklink_partslist_file, condition='N')
-    logger.info(f"Step 8 complete")
+    export_decisions(decisions, decisions_file)
+    step_timer.stop()
+    logging.info(f"Step 8 complete")
+
+
+def process_cart_file(input_cart_file, log_dir, database_file, skip_purge, debug, workers=DEFAULT_CONCURRENCY, http_cache_file=DEFAULT_CACHE_FILE,
+                      parse_workers=DEFAULT_PARSE_WORKERS, catalog_file=None, prometheus_file=None, trace=False, resume=False):
+    """
+    Split a BrickLink cart file into a cheaper BrickLink cart and a LEGO Pick-a-Brick order.
+
+    The web requests of Steps 2, 4 and 6 run concurrently on a fetch engine,
+    while all of the database writes happen on this thread as results arrive.
+    The BrickLink catalog pages of Step 4 are parsed in a process pool. The
+    progress of the run is journaled in the database, and its metrics are
+    written next to the log file as JSON.
+
+    Args:
+        input_cart_file (str): Path to the BrickLink cart file.
+        log_dir (str): Path to the directory to save logs.
+        database_file (str): Path to the SQLite database file.
+        skip_purge (bool): Whether to only refresh stale BrickLink store lots, instead of purging all of them first.
+        debug (bool): Whether to enable debug logging.
+        workers (int): Maximum number of web requests in flight at once.
+        http_cache_file (str): Path to the SQLite file caching raw web responses, or None to disable the cache.
+        parse_workers (int): Number of processes parsing BrickLink catalog pages.
+        catalog_file (str): Path to a BrickLink catalog codes file (Codes.txt or XML) to import first, if any.
+        prometheus_file (str): Path to also write the metrics of the run to in the Prometheus text format, if any.
+        trace (bool): Whether to enable debug logging and log every cart, ID set and final list in full.
+        resume (bool): Whether to continue the last unfinished run on the same cart file where it stopped.
+    """
+    input_basename = os.path.splitext(os.path.basename(input_cart_file))[0]
+    timestamp = datetime.now().strftime("%Y%m%d-%H%M%S")
+    logfile_name = os.path.join(log_dir, f'save_me_money_{input_basename}_{timestamp}.txt')
+    metrics_file_name = os.path.join(log_dir, f'save_me_money_{input_basename}_{timestamp}_metrics.json')
+
+    logger = setup_logger(logfile_name, get_level(debug, trace))
+    metrics.reset()
+
+    database = DatabaseManager(database_file, logger)
+    http_cache = ResponseCache(http_cache_file) if http_cache_file else None
+    engine = FetchEngine(workers, http_cache)
+
+    # Stale store lots are refreshed below, so the command line only asks for a full purge with --purge
+    if not skip_purge:
+        database.purge_bricklink_store_lots()
+        logging.info("Purged all BrickLink store lots")
+
+    # Pre-seed the bricklink database table from the catalog download, so only designs missing from it are scraped
+    if catalog_file:
+        import_catalog(database, catalog_file)
+
+    # Steps 0 to 8, journaled so that a run that stops halfway can be resumed
+    journal = RunJournal(database, 'save_me_money', input_cart_file, resume)
+    try:
+        lots = split_cart(input_cart_file, database, engine, journal, parse_workers)
+    except BaseException:
+        journal.stop()
+        engine.close()
+        raise
+    journal.finish()
+    database.close()
+    engine.close()
+    if http_cache:
+        http_cache.close()
+
+    metrics.registry.write_json(metrics_file_name, pipeline='save_me_money', input_file=input_cart_file, lots=lots)
+    if prometheus_file:
+        metrics.registry.write_prometheus(prometheus_file)
+    logger.info(f"Wrote the metrics of the run to {metrics_file_name}")
 
 
 def main():
@@ -264,11 +261,22 @@ def main():
     parser.add_argument('input_cart_file', type=str, help='Path to the BrickLink cart file.')
     parser.add_argument('-ld', '--log_dir', type=str, default='logs', help='Path to the directory to save logs.')
     parser.add_argument('-db', '--database_file', type=str, default='part_info.db', help='Path to the SQLite database file.')
-    parser.add_argument('--skip-purge', action='store_true', help='Skip purging the BrickLink store lots.')
+    parser.add_argument('--purge', action='store_true', help='Purge all cached BrickLink store lots instead of only refreshing stale ones.')
+    parser.add_argument('--skip-purge', action='store_true', help=argparse.SUPPRESS)  # No-op, stale lots are refreshed automatically now
     parser.add_argument('--debug', action='store_true', help='Enable debug logging.')
+    parser.add_argument('--trace', action='store_true', help='Enable debug logging, and log every cart, ID set and final list in full.')
+    parser.add_argument('-w', '--workers', type=int, default=DEFAULT_CONCURRENCY, help='Maximum number of web requests in flight at once.')
+    parser.add_argument('-pw', '--parse_workers', type=int, default=DEFAULT_PARSE_WORKERS, help='Number of processes parsing BrickLink catalog pages.')
+    parser.add_argument('-hc', '--http_cache_file', type=str, default=DEFAULT_CACHE_FILE, help='Path to the SQLite file caching raw web responses.')
+    parser.add_argument('-nc', '--no_http_cache', action='store_true', help='Do not cache raw web responses.')
+    parser.add_argument('-cf', '--catalog_file', type=str, help='BrickLink catalog codes file (Codes.txt or XML) to import before scraping.')
+    parser.add_argument('-r', '--resume', action='store_true', help='Continue the last unfinished run on the same cart file where it stopped.')
+    parser.add_argument('-pm', '--prometheus_file', type=str, help='Also write the metrics of the run to this file in the Prometheus text format.')
     args = parser.parse_args()
 
-    process_cart_file(args.input_cart_file, args.log_dir, args.database_file, args.skip_purge, args.debug)
+    http_cache_file = None if args.no_http_cache else args.http_cache_file
+    process_cart_file(args.input_cart_file, args.log_dir, args.database_file, not args.purge, args.debug, args.workers, http_cache_file,
+                      args.parse_workers, args.catalog_file, args.prometheus_file, args.trace, args.resume)
 
 
 if __name__ == '__main__':
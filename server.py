@@ -0,0 +1,613 @@
+"""
+Server.
+
+Runs convert.py and save_me_money.py as background jobs of a long-running
+local server, so a caller such as the brickyui app does not pay for a fresh
+Python process on every conversion. One worker thread keeps the database
+connection, the per-host web sessions and their pacing, the response cache and
+the parse process pool warm between jobs, and runs the jobs one at a time, so
+they never fight over the database file.
+
+The server speaks JSON over HTTP, and only listens on localhost by default:
+
+    POST /jobs?pipeline=convert&filename=wanted.xml   Upload a partslist (or a
+                                                      .cart file with
+                                                      pipeline=save_me_money) as
+                                                      the body, get the job back
+    GET  /jobs                                        List the jobs
+    GET  /jobs/<id>                                   Get the status of a job
+    GET  /jobs/<id>/events                            Stream the progress of a job,
+                                                      one JSON object per line
+    GET  /jobs/<id>/files/<name>                      Download an output file
+    GET  /health                                      Check the server is up
+
+POST /jobs also takes stream=1 and condition=N|U|X for convert, resume=1 to
+continue an unfinished job on the same input, and wait=1 to answer only once
+the job is done. The Step 7.3 prompt of convert.py cannot be answered here, so
+between two equally priced elements the one with the highest max order
+quantity is chosen.
+"""
+
+import os
+import json
+import time
+import queue
+import shutil
+import logging
+import argparse
+import itertools
+import threading
+import metrics
+from datetime import datetime
+from urllib.parse import urlsplit, parse_qs
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from database import DatabaseManager
+from journal import RunJournal
+from log_setup import setup_logger, get_level
+from convert import convert_partslist, choose_highest_max_order_quantity
+from save_me_money import split_cart
+from request_session import FetchEngine, open_parse_pool, DEFAULT_CONCURRENCY, DEFAULT_PARSE_WORKERS
+from response_cache import ResponseCache, DEFAULT_CACHE_FILE
+
+DEFAULT_HOST = '127.0.0.1'
+DEFAULT_PORT = 8765
+
+# Default input file name of each pipeline, when the upload does not name one
+DEFAULT_FILENAMES = {
+    'convert': 'partslist.xml',
+    'save_me_money': 'cart.cart',
+}
+
+# Largest upload accepted, in bytes
+MAX_UPLOAD_BYTES = 64 * 1024 * 1024
+
+# Seconds an events stream waits for a new event before checking the connection again
+EVENTS_POLL_INTERVAL = 15.0
+
+
+class Job:
+    """
+    A conversion queued on, running on or finished by the server.
+
+    Attributes:
+        job_id (str): The ID of the job, also the name of its directory.
+        pipeline (str): The pipeline, 'convert' or 'save_me_money'.
+        input_file (str): The path to the uploaded input file.
+        options (dict): The options of the pipeline, such as stream, condition and resume.
+        status (str): 'queued', 'running', 'finished' or 'failed'.
+        step (str): The step the job has reached, or None.
+        lots (int): The number of lots in the input, once finished.
+        error (str): Why the job failed, or None.
+        outputs (list of str): The names of the output files, once finished.
+        events (list of dict): The progress events logged so far.
+        created_at (float): When the job was submitted, as a UNIX timestamp.
+        finished_at (float): When the job finished or failed, or None.
+        changed (threading.Condition): Guards the job, and wakes whoever waits for it to change.
+    """
+
+    __slots__ = ('job_id', 'pipeline', 'input_file', 'options', 'status', 'step', 'lots', 'error', 'outputs', 'events',
+                 'created_at', 'finished_at', 'changed')
+
+    def __init__(self, job_id, pipeline, input_file, options):
+        """
+        Initialize the Job.
+
+        Args:
+            job_id (str): The ID of the job.
+            pipeline (str): The pipeline, 'convert' or 'save_me_money'.
+            input_file (str): The path to the uploaded input file.
+            options (dict): The options of the pipeline.
+        """
+        self.job_id = job_id
+        self.pipeline = pipeline
+        self.input_file = input_file
+        self.options = options
+        self.status = 'queued'
+        self.step = None
+        self.lots = None
+        self.error = None
+        self.outputs = []
+        self.events = []
+        self.created_at = time.time()
+        self.finished_at = None
+        self.changed = threading.Condition()
+
+    @property
+    def done(self):
+        """bool: Whether the job has finished or failed."""
+        return self.status in ('finished', 'failed')
+
+    def add_event(self, event):
+        """
+        Record a progress event and wake the streams waiting for it.
+
+        Args:
+            event (dict): The event.
+        """
+        with self.changed:
+            self.events.append(event)
+            self.changed.notify_all()
+
+    def set_status(self, status, **fields):
+        """
+        Move the job to a new status and wake everyone waiting on it.
+
+        Args:
+            status (str): The new status.
+            **fields: Other attributes to set at the same time, such as error or lots.
+        """
+        with self.changed:
+            for name, value in fields.items():
+                setattr(self, name, value)
+            self.status = status
+            if self.done:
+                self.finished_at = time.time()
+            self.changed.notify_all()
+
+    def wait_for_events(self, start, timeout):
+        """
+        Wait until there are events past an index, or the job is done.
+
+        Args:
+            start (int): The number of events already seen.
+            timeout (float): The longest wait, in seconds.
+
+        Returns:
+            tuple: (list of dict, bool) the new events and whether the job is done.
+        """
+        with self.changed:
+            self.changed.wait_for(lambda: len(self.events) > start or self.done, timeout)
+            return self.events[start:], self.done
+
+    def wait(self):
+        """Wait until the job is done."""
+        with self.changed:
+            self.changed.wait_for(lambda: self.done)
+
+    def to_dict(self):
+        """
+        Convert the job into a JSON object.
+
+        Returns:
+            dict: The job, without its events.
+        """
+        with self.changed:
+            return {'job_id': self.job_id, 'pipeline': self.pipeline, 'input_file': os.path.basename(self.input_file),
+                    'options': self.options, 'status': self.status, 'step': self.step, 'lots': self.lots, 'error': self.error,
+                    'outputs': list(self.outputs), 'events': len(self.events), 'created_at': self.created_at,
+                    'finished_at': self.finished_at}
+
+
+class JobEventHandler(logging.Handler):
+    """Turns the INFO and higher log records of the worker thread into progress events of the running job."""
+
+    def __init__(self, job, thread_id):
+        """
+        Initialize the JobEventHandler.
+
+        Args:
+            job (Job): The running job.
+            thread_id (int): The ident of the worker thread, so records of the HTTP threads are left out.
+        """
+        super().__init__(logging.INFO)
+        self.job = job
+        self.thread_id = thread_id
+
+    def emit(self, record):
+        """Add the record to the events of the job."""
+        if record.thread != self.thread_id:
+            return
+        self.job.add_event({'time': record.created, 'level': record.levelname, 'message': record.getMessage()})
+
+
+class StepJournal(RunJournal):
+    """A RunJournal that also shows the step the run has reached on its job."""
+
+    def __init__(self, job, *args, **kwargs):
+        """
+        Initialize the StepJournal.
+
+        Args:
+            job (Job): The job of the run.
+            *args: The arguments of RunJournal.
+            **kwargs: The keyword arguments of RunJournal.
+        """
+        self.job = job
+        super().__init__(*args, **kwargs)
+
+    def begin_step(self, step):
+        """Record that the run has reached a step, on its job too."""
+        super().begin_step(step)
+        self.job.step = step
+
+
+class JobRunner:
+    """
+    Runs the submitted jobs one at a time on a worker thread that owns the warm database, engine, cache and parse pool.
+
+    Attributes:
+        work_dir (str): The directory holding a subdirectory per job.
+        database_file (str): Path to the SQLite database file.
+        http_cache_file (str): Path to the SQLite file caching raw web responses, or None to disable the cache.
+        workers (int): Maximum number of web requests in flight at once.
+        parse_workers (int): Number of processes parsing BrickLink pages.
+        log_file (str): Path to the log file of the server, used between jobs.
+        level (int): The log level.
+        jobs (dict): Maps job IDs to their jobs, in the order they were submitted.
+    """
+
+    def __init__(self, work_dir, database_file, http_cache_file=DEFAULT_CACHE_FILE, workers=DEFAULT_CONCURRENCY,
+                 parse_workers=DEFAULT_PARSE_WORKERS, log_file=None, level=logging.INFO):
+        """
+        Initialize the JobRunner.
+
+        Args:
+            work_dir (str): The directory holding a subdirectory per job.
+            database_file (str): Path to the SQLite database file.
+            http_cache_file (str): Path to the SQLite file caching raw web responses, or None to disable the cache.
+            workers (int): Maximum number of web requests in flight at once.
+            parse_workers (int): Number of processes parsing BrickLink pages.
+            log_file (str): Path to the log file of the server, used between jobs.
+            level (int): The log level.
+        """
+        self.work_dir = work_dir
+        self.database_file = database_file
+        self.http_cache_file = http_cache_file
+        self.workers = workers
+        self.parse_workers = parse_workers
+        self.log_file = log_file
+        self.level = level
+        self.jobs = {}
+        self._queue = queue.Queue()
+        self._lock = threading.Lock()
+        self._ids = itertools.count(1)
+        self._ready = threading.Event()
+        self._error = None
+        self._thread = threading.Thread(target=self._run, name='job-runner', daemon=True)
+
+    def start(self):
+        """
+        Start the worker thread, and wait until the database, engine and parse pool are open.
+
+        Raises:
+            Exception: Whatever stopped the worker thread from opening them.
+        """
+        self._thread.start()
+        self._ready.wait()
+        if self._error is not None:
+            raise self._error
+
+    def stop(self):
+        """Let the worker thread finish the queued jobs, then close everything it owns."""
+        self._queue.put(None)
+        self._thread.join()
+
+    def submit(self, pipeline, filename, content, options):
+        """
+        Queue a job on an uploaded input file.
+
+        Args:
+            pipeline (str): The pipeline, 'convert' or 'save_me_money'.
+            filename (str): The name of the input file, which the output file names are based on, or None for the default.
+            content (bytes): The contents of the input file.
+            options (dict): The options of the pipeline.
+
+        Raises:
+            ValueError: The file name is empty or starts with a dot.
+
+        Returns:
+            Job: The queued job.
+        """
+        filename = DEFAULT_FILENAMES[pipeline] if filename is None else os.path.basename(filename)
+        if not filename or filename.startswith('.'):
+            raise ValueError(f"Invalid input file name: {filename!r}")
+        with self._lock:
+            job_id = f"{datetime.now().strftime('%Y%m%d_%H%M%S')}_{next(self._ids)}"
+        job_dir = os.path.join(self.work_dir, job_id)
+        os.makedirs(job_dir)
+        input_file = os.path.join(job_dir, filename)
+        with open(input_file, 'wb') as file:
+            file.write(content)
+        job = Job(job_id, pipeline, input_file, options)
+        with self._lock:
+            self.jobs[job_id] = job
+        self._queue.put(job)
+        logging.info(f"Queued {pipeline} job {job_id} on {os.path.basename(input_file)}")
+        return job
+
+    def get(self, job_id):
+        """
+        Get a job by its ID.
+
+        Args:
+            job_id (str): The ID of the job.
+
+        Returns:
+            Job: The job, or None if there is none with that ID.
+        """
+        with self._lock:
+            return self.jobs.get(job_id)
+
+    def list(self):
+        """
+        Get every job, in the order they were submitted.
+
+        Returns:
+            list of Job: The jobs.
+        """
+        with self._lock:
+            return list(self.jobs.values())
+
+    def queued(self):
+        """
+        Get the number of jobs waiting for the worker thread.
+
+        Returns:
+            int: The number of queued jobs.
+        """
+        return self._queue.qsize()
+
+    def _run(self):
+        """Open the database, engine, response cache and parse pool, and run jobs until stopped."""
+        database = http_cache = engine = None
+        try:
+            database = DatabaseManager(self.database_file, logging.getLogger())
+            http_cache = ResponseCache(self.http_cache_file) if self.http_cache_file else None
+            engine = FetchEngine(self.workers, http_cache)
+            with open_parse_pool(self.parse_workers) as parse_pool:
+                self._ready.set()
+                while True:
+                    job = self._queue.get()
+                    if job is None:
+                        break
+                    self._run_job(job, database, engine, parse_pool)
+        except Exception as exc:
+            # Hand the error to start() if it is still waiting, instead of leaving it blocked forever
+            if self._ready.is_set():
+                raise
+            self._error = exc
+        finally:
+            self._ready.set()
+            if database:
+                database.close()
+            if engine:
+                engine.close()
+            if http_cache:
+                http_cache.close()
+
+    def _run_job(self, job, database, engine, parse_pool):
+        """
+        Run one job with the warm database, engine and parse pool, logging to a file in its directory.
+
+        Args:
+            job (Job): The job.
+            database (DatabaseManager): The database to cache the lookups in.
+            engine (request_session.FetchEngine): The engine to make the requests with.
+            parse_pool (concurrent.futures.ProcessPoolExecutor): The pool to parse the BrickLink pages in.
+        """
+        job_dir = os.path.dirname(job.input_file)
+        input_basename = os.path.splitext(os.path.basename(job.input_file))[0]
+        logfile_name = os.path.join(job_dir, f"{job.pipeline}_{input_basename}.txt")
+        metrics_file_name = os.path.join(job_dir, f"{job.pipeline}_{input_basename}_metrics.json")
+        inputs = set(os.listdir(job_dir))
+
+        setup_logger(logfile_name, self.level)
+        metrics.reset()
+        handler = JobEventHandler(job, threading.get_ident())
+        logging.getLogger().addHandler(handler)
+        job.set_status('running')
+        try:
+            journal = StepJournal(job, database, job.pipeline, job.input_file, job.options.get('resume', False))
+            try:
+                if job.pipeline == 'convert':
+                    lots = convert_partslist(job.input_file, database, engine, journal, self.parse_workers, job.options.get('stream', False),
+                                             job.options.get('condition', 'X'), choose_highest_max_order_quantity, parse_pool)
+                else:
+                    lots = split_cart(job.input_file, database, engine, journal, self.parse_workers, parse_pool)
+            except Exception:
+                journal.stop()
+                raise
+            journal.finish()
+            metrics.registry.write_json(metrics_file_name, pipeline=job.pipeline, input_file=job.input_file, lots=lots, job_id=job.job_id)
+        except Exception as exc:
+            logging.exception(f"Job {job.job_id} failed: {exc}")
+            # Leave nothing of the failed job running on the engine, which the next job reuses
+            engine.cancel_pending()
+            job.set_status('failed', error=str(exc))
+        else:
+            logging.info(f"Job {job.job_id} finished - {lots} lots in {metrics.format_duration(time.time() - job.created_at)}")
+            outputs = sorted(set(os.listdir(job_dir)) - inputs - {os.path.basename(logfile_name), os.path.basename(metrics_file_name)})
+            job.set_status('finished', lots=lots, outputs=outputs)
+        finally:
+            logging.getLogger().removeHandler(handler)
+            if self.log_file:
+                setup_logger(self.log_file, self.level)
+
+
+class JobRequestHandler(BaseHTTPRequestHandler):
+    """Answers the JSON API of the server, handing uploads to its JobRunner."""
+
+    def do_GET(self):
+        """Answer the health check, the job list, a job, its events or one of its output files."""
+        parts = urlsplit(self.path).path.strip('/').split('/')
+        runner = self.server.runner
+        if parts == ['health']:
+            self.send_json({'status': 'ok', 'jobs': len(runner.list()), 'queued': runner.queued()})
+            return
+        if parts == ['jobs']:
+            self.send_json({'jobs': [job.to_dict() for job in runner.list()]})
+            return
+        if len(parts) < 2 or parts[0] != 'jobs':
+            self.send_error_json(404, f"Not found: {self.path}")
+            return
+        job = runner.get(parts[1])
+        if job is None:
+            self.send_error_json(404, f"No job {parts[1]}")
+        elif len(parts) == 2:
+            self.send_json(job.to_dict())
+        elif parts[2:] == ['events']:
+            self.send_events(job)
+        elif len(parts) == 4 and parts[2] == 'files' and parts[3] in job.outputs:
+            self.send_file(os.path.join(os.path.dirname(job.input_file), parts[3]))
+        else:
+            self.send_error_json(404, f"Not found: {self.path}")
+
+    def do_POST(self):
+        """Queue a job on the uploaded input file, and answer with the job, once done if asked to wait."""
+        url = urlsplit(self.path)
+        if url.path.strip('/') != 'jobs':
+            self.send_error_json(404, f"Not found: {self.path}")
+            return
+        query = {name: values[-1] for name, values in parse_qs(url.query, keep_blank_values=True).items()}
+        pipeline = query.get('pipeline', 'convert')
+        if pipeline not in DEFAULT_FILENAMES:
+            self.send_error_json(400, f"Unknown pipeline: {pipeline}")
+            return
+        condition = query.get('condition', 'X').upper()
+        if condition not in ('N', 'U', 'X'):
+            self.send_error_json(400, f"Unknown condition: {condition}")
+            return
+        length = int(self.headers.get('Content-Length') or 0)
+        if length <= 0 or length > MAX_UPLOAD_BYTES:
+            self.send_error_json(400 if length <= 0 else 413, f"The input file must be sent as the body, up to {MAX_UPLOAD_BYTES} bytes")
+            return
+        content = self.rfile.read(length)
+
+        options = {'resume': is_true(query.get('resume'))}
+        if pipeline == 'convert':
+            options.update(stream=is_true(query.get('stream')), condition=condition)
+        try:
+            job = self.server.runner.submit(pipeline, query.get('filename'), content, options)
+        except ValueError as exc:
+            self.send_error_json(400, str(exc))
+            return
+        if is_true(query.get('wait')):
+            job.wait()
+        self.send_json(job.to_dict(), 200 if job.done else 202, {'Location': f"/jobs/{job.job_id}"})
+
+    def send_json(self, data, status=200, headers=None):
+        """
+        Send a JSON response.
+
+        Args:
+            data (dict): The JSON object.
+            status (int): The HTTP status code.
+            headers (dict): Extra headers, if any.
+        """
+        body = json.dumps(data).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_error_json(self, status, message):
+        """
+        Send an error as a JSON response.
+
+        Args:
+            status (int): The HTTP status code.
+            message (str): What went wrong.
+        """
+        self.send_json({'error': message}, status)
+
+    def send_events(self, job):
+        """
+        Stream the events of a job as newline-delimited JSON until it is done, ending with the job itself.
+
+        Args:
+            job (Job): The job.
+        """
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/x-ndjson')
+        self.send_header('Cache-Control', 'no-cache')
+        self.end_headers()
+        seen = 0
+        done = False
+        try:
+            while not done:
+                events, done = job.wait_for_events(seen, EVENTS_POLL_INTERVAL)
+                seen += len(events)
+                for event in events:
+                    self.wfile.write(json.dumps(event).encode('utf-8') + b'\n')
+                self.wfile.flush()
+            self.wfile.write(json.dumps(job.to_dict()).encode('utf-8') + b'\n')
+        except (BrokenPipeError, ConnectionResetError):
+            # The caller stopped listening, the job carries on
+            pass
+
+    def send_file(self, path):
+        """
+        Send an output file of a job.
+
+        Args:
+            path (str): The path of the file.
+        """
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/octet-stream')
+        self.send_header('Content-Length', str(os.path.getsize(path)))
+        self.send_header('Content-Disposition', f'attachment; filename="{os.path.basename(path)}"')
+        self.end_headers()
+        with open(path, 'rb') as file:
+            shutil.copyfileobj(file, self.wfile)
+
+    def log_message(self, format, *args):
+        """Log the requests at DEBUG instead of writing them to stderr."""
+        logging.debug("%s - %s", self.address_string(), format % args)
+
+
+def is_true(value):
+    """
+    Read a flag of the query string.
+
+    Args:
+        value (str): The value of the flag, or None if it was not given.
+
+    Returns:
+        bool: Whether the flag is set, to 1, true, yes or on.
+    """
+    return value is not None and value.lower() in ('1', 'true', 'yes', 'on')
+
+
+def main():
+    """Parse command-line arguments, open the warm database, engine and cache, and serve until stopped with Ctrl-C."""
+    parser = argparse.ArgumentParser(description='Run convert and save_me_money jobs from a local HTTP/JSON API.')
+    parser.add_argument('-H', '--host', default=DEFAULT_HOST, help='Address to listen on')
+    parser.add_argument('-p', '--port', type=int, default=DEFAULT_PORT, help='Port to listen on')
+    parser.add_argument('-wd', '--work_dir', default='jobs', help='Path to the folder where the inputs, outputs and logs of each job are kept')
+    parser.add_argument('-ld', '--log_dir', default='logs', help='Path to the folder where the server log file will be created')
+    parser.add_argument('-db', '--database_file', default='part_info.db', help='Path to the SQLite database file')
+    parser.add_argument('-w', '--workers', type=int, default=DEFAULT_CONCURRENCY, help='Maximum number of web requests in flight at once')
+    parser.add_argument('-pw', '--parse_workers', type=int, default=DEFAULT_PARSE_WORKERS, help='Number of processes parsing BrickLink pages')
+    parser.add_argument('-hc', '--http_cache_file', default=DEFAULT_CACHE_FILE, help='Path to the SQLite file caching raw web responses')
+    parser.add_argument('-nc', '--no_http_cache', action='store_true', help='Do not cache raw web responses')
+    parser.add_argument('--debug', action='store_true', help='Enable debug logging')
+    parser.add_argument('--trace', action='store_true', help='Enable debug logging, and log every partslist, ID set and bucket in full')
+    args = parser.parse_args()
+
+    timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
+    logfile_name = os.path.join(args.log_dir, f"server_{timestamp}.txt")
+    level = get_level(args.debug, args.trace)
+    setup_logger(logfile_name, level)
+    os.makedirs(args.work_dir, exist_ok=True)
+
+    runner = JobRunner(args.work_dir, args.database_file, None if args.no_http_cache else args.http_cache_file, args.workers,
+                       args.parse_workers, logfile_name, level)
+    runner.start()
+    server = ThreadingHTTPServer((args.host, args.port), JobRequestHandler)
+    server.daemon_threads = True
+    server.runner = runner
+    logging.info(f"Serving on http://{args.host}:{server.server_port}, keeping jobs in {args.work_dir}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        logging.info("Stopping, after the queued jobs")
+    finally:
+        server.server_close()
+        runner.stop()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,25 @@
+"""
+Tests for the query plan check of cache.py.
+"""
+
+import logging
+import cache
+from database import DatabaseManager
+
+
+def test_hot_queries_use_index_lookups():
+    """A freshly migrated database looks the rows of every hot query up through an index."""
+    assert cache.check_query_plans(logging.getLogger()) == []
+
+
+def test_scan_is_reported_without_the_index(tmp_path):
+    """Dropping the design and color index makes a hot query scan bricklink_entries, which the check reports."""
+    database_file = str(tmp_path / 'part_info.db')
+    database = DatabaseManager(database_file, logging.getLogger())
+    database.cursor.execute('DROP INDEX bricklink_entries_design_color')
+    database.close()
+    # Reopen the database, as the plans of statements prepared before the drop are cached by the connection
+    database = DatabaseManager(database_file, logging.getLogger())
+    scans = database.check_query_plans()
+    database.close()
+    assert any(detail.startswith('SCAN bricklink_entries') for _, detail in scans)
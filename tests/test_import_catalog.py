@@ -0,0 +1,128 @@
+"""
+Tests for the incremental imports of import_catalog.py.
+"""
+
+import os
+import time
+import logging
+import pytest
+from database import DatabaseManager, DAY
+from import_catalog import import_catalog
+
+CODES_TXT = 'Item No\tColor\tCode\n3001\tWhite\t300101\n3023\tRed\t302321\n'
+
+# Modification time of the catalog file, older than the maximum age of the BrickLink table
+FILE_AGE = 200 * DAY
+
+
+@pytest.fixture
+def database():
+    """An in-memory database, closed after the test."""
+    database = DatabaseManager(':memory:', logging.getLogger())
+    yield database
+    database.close()
+
+
+@pytest.fixture
+def codes_file(tmp_path):
+    """A tiny Codes.txt, last modified long before the maximum age of the BrickLink table."""
+    path = tmp_path / 'Codes.txt'
+    path.write_text(CODES_TXT)
+    mtime = time.time() - FILE_AGE
+    os.utime(path, (mtime, mtime))
+    return str(path)
+
+
+def get_fetched_at(database, element_id):
+    """
+    Get when a BrickLink entry was fetched or imported.
+
+    Args:
+        database (DatabaseManager): The database.
+        element_id (str): The element ID.
+
+    Returns:
+        float: The fetched_at timestamp of the entry.
+    """
+    return database.cursor.execute('SELECT fetched_at FROM bricklink_entries WHERE element_id = ?', (element_id,)).fetchone()[0]
+
+
+def age_last_import(database, path, seconds):
+    """
+    Move the last import of a catalog file and the entries it wrote back in time.
+
+    Args:
+        database (DatabaseManager): The database.
+        path (str): The path of the catalog file.
+        seconds (float): How far back to move them.
+    """
+    with database.connection:
+        database.cursor.execute('UPDATE catalog_imports SET imported_at = imported_at - ? WHERE path = ?', (seconds, os.path.abspath(path)))
+        database.cursor.execute('UPDATE bricklink_entries SET fetched_at = fetched_at - ?', (seconds,))
+
+
+def test_old_file_is_fresh_once_imported(database, codes_file):
+    """Entries are stamped with the import time, so even a file older than the maximum age leaves nothing to scrape."""
+    assert import_catalog(database, codes_file) == 2
+    assert database.get_missing_design_ids({'3001', '3023', '3004'}) == {'3004'}
+    assert get_fetched_at(database, '300101') > time.time() - 60
+
+
+def test_unchanged_file_is_skipped(database, codes_file):
+    """A file with the same modification time and size is skipped without being read."""
+    import_catalog(database, codes_file)
+    assert import_catalog(database, codes_file) is None
+
+
+def test_touched_file_with_the_same_contents_is_skipped(database, codes_file):
+    """A file that was touched but hashes the same is skipped, and recorded with its new modification time."""
+    import_catalog(database, codes_file)
+    os.utime(codes_file)
+    assert import_catalog(database, codes_file) is None
+    assert database.get_catalog_import(os.path.abspath(codes_file))[0] == os.stat(codes_file).st_mtime
+
+
+def test_force_imports_an_unchanged_file(database, codes_file):
+    """force imports a file even if it is unchanged."""
+    import_catalog(database, codes_file)
+    assert import_catalog(database, codes_file, force=True) == 2
+
+
+def test_unchanged_file_is_imported_again_once_stale(database, codes_file):
+    """Once the entries of the last import have gone stale, an unchanged file is imported again and they are fresh again."""
+    import_catalog(database, codes_file)
+    age_last_import(database, codes_file, 100 * DAY)
+    assert database.get_missing_design_ids({'3001', '3023'}) == {'3001', '3023'}
+    assert import_catalog(database, codes_file) == 2
+    assert database.get_missing_design_ids({'3001', '3023'}) == set()
+
+
+def test_import_keeps_fresh_entries_scraped_after_the_file(database, codes_file):
+    """An entry scraped after the file was modified and still fresh is kept, with its own design and fetch time."""
+    database.insert_bricklink_entry('300101', '3001b', '1')
+    database.commit_changes()
+    scraped_at = get_fetched_at(database, '300101')
+    import_catalog(database, codes_file)
+    assert database.cursor.execute('SELECT design_id FROM bricklink_entries WHERE element_id = ?', ('300101',)).fetchone()[0] == '3001b'
+    assert get_fetched_at(database, '300101') == scraped_at
+
+
+def test_import_replaces_entries_scraped_before_the_file(database, codes_file):
+    """An entry scraped before the file was modified is replaced by the imported one."""
+    database.insert_bricklink_entry('300101', '3001b', '1')
+    database.commit_changes()
+    with database.connection:
+        database.cursor.execute('UPDATE bricklink_entries SET fetched_at = ?', (time.time() - FILE_AGE - DAY,))
+    import_catalog(database, codes_file)
+    assert database.cursor.execute('SELECT design_id FROM bricklink_entries WHERE element_id = ?', ('300101',)).fetchone()[0] == '3001'
+    assert get_fetched_at(database, '300101') > time.time() - 60
+
+
+def test_import_replaces_stale_entries_scraped_after_the_file(database, codes_file):
+    """An entry scraped after the file was modified but gone stale since is replaced by the imported one."""
+    database.insert_bricklink_entry('300101', '3001b', '1')
+    database.commit_changes()
+    with database.connection:
+        database.cursor.execute('UPDATE bricklink_entries SET fetched_at = ?', (time.time() - 100 * DAY,))
+    import_catalog(database, codes_file)
+    assert database.cursor.execute('SELECT design_id FROM bricklink_entries WHERE element_id = ?', ('300101',)).fetchone()[0] == '3001'
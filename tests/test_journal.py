@@ -0,0 +1,68 @@
+"""
+Tests for resuming runs with journal.py.
+"""
+
+import logging
+import pytest
+from database import DatabaseManager
+from journal import RunJournal
+
+
+@pytest.fixture
+def database():
+    """An in-memory database, closed after the test."""
+    database = DatabaseManager(':memory:', logging.getLogger())
+    yield database
+    database.close()
+
+
+@pytest.fixture
+def input_file(tmp_path):
+    """A partslist to journal runs of."""
+    path = tmp_path / 'wanted.xml'
+    path.write_text('<INVENTORY></INVENTORY>')
+    return str(path)
+
+
+def test_resume_skips_done_keys_and_retries_the_others(database, input_file):
+    """A resumed run leaves out the keys it had done, even if they are found again, and looks up the pending and failed ones."""
+    journal = RunJournal(database, 'convert', input_file)
+    assert journal.get_keys('3', lambda: {'3001', '3002', '3003', ('s1', 'l1')}) == {'3001', '3002', '3003', ('s1', 'l1')}
+    journal.mark_done('3', '3001')
+    journal.mark_done('3', ('s1', 'l1'))
+    journal.mark_failed('3', '3002')
+    # The marks are buffered with the rows they go with, and only written once the run is stopped
+    assert set(database.get_run_keys(journal.run_id, '3').values()) == {'pending'}
+    journal.stop()
+    assert sorted(database.get_run_keys(journal.run_id, '3').values()) == ['done', 'done', 'failed', 'pending']
+
+    resumed = RunJournal(database, 'convert', input_file, resume=True)
+    assert resumed.resumed and resumed.run_id == journal.run_id and resumed.step == '3'
+    assert resumed.get_keys('3', lambda: {'3001', '3004'}) == {'3002', '3003', '3004'}
+
+
+def test_resume_without_an_unfinished_run_starts_a_new_one(database, input_file):
+    """A finished run is not resumed, so every key is looked up again."""
+    journal = RunJournal(database, 'convert', input_file)
+    journal.get_keys('3', lambda: {'3001'})
+    journal.mark_done('3', '3001')
+    database.commit_changes()
+    journal.finish()
+
+    resumed = RunJournal(database, 'convert', input_file, resume=True)
+    assert not resumed.resumed and resumed.run_id != journal.run_id
+    assert resumed.get_keys('3', lambda: {'3001'}) == {'3001'}
+
+
+def test_resume_of_keys_added_as_they_are_found(database, input_file):
+    """Keys added a few at a time are left out once done, while the others are looked up again when found again."""
+    journal = RunJournal(database, 'convert', input_file)
+    assert journal.add_keys('6', {'300101', '300121'}) == {'300101', '300121'}
+    assert journal.add_keys('6', {'302321'}) == {'302321'}
+    journal.mark_done('6', '300101')
+    journal.mark_failed('6', '302321')
+    journal.stop()
+
+    resumed = RunJournal(database, 'convert', input_file, resume=True)
+    assert resumed.add_keys('6', {'300101', '300121'}) == {'300121'}
+    assert resumed.add_keys('6', {'302321', '300105'}) == {'302321', '300105'}
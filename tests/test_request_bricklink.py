@@ -0,0 +1,69 @@
+"""
+Tests for the color table parsing of request_bricklink.py.
+
+Each saved page in fixtures/catalog_pages is parsed with the lxml fast path and
+the BeautifulSoup fallback, and both must give the color dictionary recorded
+for it in expected.json, or None for a page without a color table.
+"""
+
+import os
+import json
+import pytest
+from request_bricklink import find_color_rows_with_lxml, find_color_table_in_page, convert_rows_to_dict, convert_table_to_dict
+
+PAGES_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'fixtures', 'catalog_pages')
+
+with open(os.path.join(PAGES_DIR, 'expected.json')) as expected_file:
+    EXPECTED = json.load(expected_file)
+
+
+def read_page(filename):
+    """
+    Read a saved catalog page.
+
+    Args:
+        filename (str): The name of the page in the fixtures directory.
+
+    Returns:
+        bytes: The content of the page.
+    """
+    with open(os.path.join(PAGES_DIR, filename), 'rb') as page_file:
+        return page_file.read()
+
+
+def with_string_keys(color_dict):
+    """
+    Convert the color IDs of a color dictionary to strings, as the keys of expected.json are.
+
+    Args:
+        color_dict (dict): A dictionary mapping color IDs to lists of element IDs, or None.
+
+    Returns:
+        dict: The dictionary with string keys, or None.
+    """
+    if color_dict is None:
+        return None
+    return {str(color_id): element_ids for color_id, element_ids in color_dict.items()}
+
+
+def test_every_page_has_an_expected_result():
+    """Every saved page has an expected result, and one of them is a page without a color table."""
+    pages = {filename for filename in os.listdir(PAGES_DIR) if filename.endswith('.html')}
+    assert pages == set(EXPECTED)
+    assert None in EXPECTED.values()
+
+
+@pytest.mark.parametrize('filename', sorted(EXPECTED))
+def test_lxml_matches_expected(filename):
+    """The lxml fast path parses each page into its expected color dictionary."""
+    rows = find_color_rows_with_lxml(read_page(filename))
+    result = convert_rows_to_dict(rows) if rows is not None else None
+    assert with_string_keys(result) == EXPECTED[filename]
+
+
+@pytest.mark.parametrize('filename', sorted(EXPECTED))
+def test_beautifulsoup_matches_expected(filename):
+    """The BeautifulSoup fallback parses each page into its expected color dictionary."""
+    table = find_color_table_in_page(read_page(filename))
+    result = convert_table_to_dict(table) if table else None
+    assert with_string_keys(result) == EXPECTED[filename]
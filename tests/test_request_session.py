@@ -0,0 +1,89 @@
+"""
+Tests for the coalescing of in-flight lookups by request_session.SingleFlight.
+"""
+
+import gc
+import asyncio
+from request_session import SingleFlight
+
+
+def run(coroutine):
+    """
+    Run a coroutine on a new event loop, collecting whatever the loop reports as unhandled.
+
+    Args:
+        coroutine (coroutine): The coroutine.
+
+    Returns:
+        tuple: (object, list of dict) the result of the coroutine and the contexts the loop reported.
+    """
+    reported = []
+
+    async def main():
+        asyncio.get_running_loop().set_exception_handler(lambda loop, context: reported.append(context))
+        result = await coroutine
+        # Let the done callbacks run and the abandoned futures be collected while the handler is still set
+        await asyncio.sleep(0.01)
+        gc.collect()
+        return result
+
+    return asyncio.run(main()), reported
+
+
+def test_do_coalesces_concurrent_lookups_of_a_key():
+    """Concurrent lookups of the same key share one call, and a later lookup starts a new one."""
+    calls = []
+
+    async def lookup():
+        calls.append('3001')
+        await asyncio.sleep(0.01)
+        return 'result'
+
+    async def main():
+        single_flight = SingleFlight()
+        results = await asyncio.gather(single_flight.do('3001', lookup), single_flight.do('3001', lookup))
+        return results, await single_flight.do('3001', lookup), single_flight.calls
+
+    (results, later, calls_left), reported = run(main())
+    assert results == ['result', 'result'] and later == 'result'
+    assert len(calls) == 2 and calls_left == {} and reported == []
+
+
+def test_do_many_shares_keys_and_raises_for_every_waiter():
+    """A key shared by two batches is looked up once, and the error of its batch reaches both callers without being reported unretrieved."""
+    batches = []
+
+    async def failing_lookup(keys):
+        batches.append(keys)
+        await asyncio.sleep(0.01)
+        raise RuntimeError('batch failed')
+
+    async def lookup(keys):
+        batches.append(keys)
+        await asyncio.sleep(0)
+        return {key: f"result {key}" for key in keys if key != 'e4'}
+
+    async def main():
+        single_flight = SingleFlight()
+        first = asyncio.ensure_future(single_flight.do_many(['e1', 'e2', 'e3'], failing_lookup))
+        await asyncio.sleep(0)
+        second = asyncio.ensure_future(single_flight.do_many(['e3', 'e4', 'e5'], lookup))
+        results = await asyncio.gather(first, second, return_exceptions=True)
+        return results, single_flight.calls
+
+    (results, calls_left), reported = run(main())
+    assert batches == [['e1', 'e2', 'e3'], ['e4', 'e5']]
+    assert all(isinstance(result, RuntimeError) for result in results)
+    assert calls_left == {} and reported == []
+
+
+def test_do_many_leaves_out_keys_the_lookup_did_not_return():
+    """A key missing from the results of its batch is left out of the results instead of failing the others."""
+    async def lookup(keys):
+        return {key: key.upper() for key in keys if key != 'e2'}
+
+    async def main():
+        return await SingleFlight().do_many(['e1', 'e2', 'e1'], lookup)
+
+    results, reported = run(main())
+    assert results == {'e1': 'E1'} and reported == []
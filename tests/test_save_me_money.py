@@ -0,0 +1,26 @@
+"""
+Tests for Steps 7 and 8 of save_me_money.py.
+"""
+
+import csv
+import logging
+from database import DatabaseManager
+from journal import RunJournal
+from records import CartLot
+from save_me_money import compare_and_export_cart
+
+
+def test_lot_whose_lookup_failed_stays_on_bricklink(tmp_path):
+    """A cart lot with no store lot row is kept in the BrickLink cart with a decision saying its lookup failed."""
+    input_cart_file = tmp_path / 'my.cart'
+    input_cart_file.write_text('')
+    database = DatabaseManager(':memory:', logging.getLogger())
+    journal = RunJournal(database, 'save_me_money', str(input_cart_file))
+    compare_and_export_cart(str(input_cart_file), [CartLot('p', '1', '2', 3)], database, journal)
+    database.close()
+
+    with open(tmp_path / 'my_decisions.csv', newline='') as decisions_file:
+        decisions = list(csv.DictReader(decisions_file))
+    assert [(row['storeId'], row['lotId'], row['destination'], row['reason']) for row in decisions] == [
+        ('1', '2', 'bricklink', 'BrickLink lookup failed')]
+    assert (tmp_path / 'my_updated_bricklink_cart.cart').read_text() != ''